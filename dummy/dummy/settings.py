@@ -158,3 +158,7 @@ LOGGING = {
 PBANDJ_SERVICE_MODULES = {
     'pbandj_test' : 'pbandj_service', 
 }
+
+PBANDJ_BENCH_MODULES = {
+    'pbandj_test' : 'pbandj_test.pbandj_bench',
+}
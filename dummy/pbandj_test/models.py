@@ -82,6 +82,22 @@ class ManyToManyTest(models.Model):
     m2m_test = models.ManyToManyField(Simple)
 
 
+@protocol_buffer_message
+class NestedParentTest(models.Model):
+    val = models.IntegerField()
+
+
+@protocol_buffer_message
+class NestedTagTest(models.Model):
+    name = models.CharField(max_length=10)
+
+
+@protocol_buffer_message
+class NestedTest(models.Model):
+    fkey_test = models.ForeignKey(NestedParentTest)
+    m2m_test = models.ManyToManyField(NestedTagTest)
+
+
 @protocol_buffer_message
 class ManyToManyThroughTest(models.Model):
     test_val = models.IntegerField()
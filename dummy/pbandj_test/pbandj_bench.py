@@ -0,0 +1,93 @@
+'''pbandj_test.pbandj_bench - Benchmark cases of the pbandj_test models run
+by the bench_protobuf management command
+'''
+
+import decimal
+from datetime import datetime
+
+from pbandj.benchmark import BenchmarkCase
+
+import models
+
+
+def bulk_create(dj_model, objs):
+    dj_model._default_manager.bulk_create(objs)
+
+
+def create_simple(size):
+    bulk_create(models.Simple, [models.Simple(id=i + 1, val=i) for i in range(size)])
+
+
+def create_one_of_everything(size):
+    stamp = datetime(2010, 6, 5, 4, 3, 2, 1)
+    bulk_create(models.OneOfEverything,
+                [models.OneOfEverything(bool_test=True, char_test='abc', comma_test='1,2',
+                                        date_test=stamp.date(), date_time_test=stamp,
+                                        decimal_test=decimal.Decimal('1.25'), email_test='a@b.c',
+                                        file_test='file', file_path_test='path', float_test=1.5,
+                                        image_test='image', int_test=i, ip_test='10.0.0.1',
+                                        null_bool_test=None, pos_int_test=i, pos_sm_int_test=1,
+                                        slug_test='slug', sm_int_test=-1, text_test='text',
+                                        time_test=stamp.time(), url_test='http://lcogt.net')
+                 for i in range(size)])
+
+
+def create_enum(size):
+    bulk_create(models.EnumTest, [models.EnumTest(enum_test=('Val1', 'Val2')[i % 2]) for i in range(size)])
+
+
+def create_foreign_key(size):
+    create_simple(size)
+    bulk_create(models.ForeignKeyTest, [models.ForeignKeyTest(fkey_test_id=i + 1) for i in range(size)])
+
+
+def create_many_to_many(size):
+    create_simple(size)
+    bulk_create(models.ManyToManyTest,
+                [models.ManyToManyTest(id=i + 1, test_val=i) for i in range(size)])
+    through = models.ManyToManyTest.m2m_test.through
+    # Two related objects each
+    bulk_create(through, [through(manytomanytest_id=i + 1, simple_id=(i + j) % size + 1)
+                          for i in range(size) for j in range(min(size, 2))])
+
+
+def create_nested(size):
+    bulk_create(models.NestedParentTest, [models.NestedParentTest(id=i + 1, val=i) for i in range(size)])
+    bulk_create(models.NestedTagTest,
+                [models.NestedTagTest(id=i + 1, name='tag%d' % i) for i in range(size)])
+    bulk_create(models.NestedTest,
+                [models.NestedTest(id=i + 1, fkey_test_id=i + 1) for i in range(size)])
+    through = models.NestedTest.m2m_test.through
+    # Five related objects each
+    bulk_create(through, [through(nestedtest_id=i + 1, nestedtagtest_id=(i + j) % size + 1)
+                          for i in range(size) for j in range(min(size, 5))])
+
+
+def create_through(size):
+    create_simple(size)
+    bulk_create(models.ManyToManyThroughTest,
+                [models.ManyToManyThroughTest(id=i + 1, test_val=i) for i in range(size)])
+    bulk_create(models.M2MAssocTest,
+                [models.M2MAssocTest(assoc_test=j, m2m_fk_id=i + 1, simple_fk_id=(i + j) % size + 1)
+                 for i in range(size) for j in range(2)])
+
+
+def create_recursive(size):
+    # A chain where each object refers to the one before it and the first
+    # to itself
+    bulk_create(models.ForeignKeyRecursionTest,
+                [models.ForeignKeyRecursionTest(id=i + 1, fkey_test_id=max(i, 1)) for i in range(size)])
+
+
+CASES = [
+    BenchmarkCase('flat_one_of_everything', models.OneOfEverything, create_one_of_everything),
+    BenchmarkCase('flat_simple', models.Simple, create_simple),
+    BenchmarkCase('enum', models.EnumTest, create_enum),
+    BenchmarkCase('foreign_key', models.ForeignKeyTest, create_foreign_key),
+    BenchmarkCase('many_to_many', models.ManyToManyTest, create_many_to_many),
+    # A ForeignKey message and five ManyToMany messages per object
+    BenchmarkCase('nested', models.NestedTest, create_nested),
+    BenchmarkCase('through', models.ManyToManyThroughTest, create_through),
+    # Conversion of the chain stops 3 levels down
+    BenchmarkCase('recursive', models.ForeignKeyRecursionTest, create_recursive, max_depth=3),
+]
@@ -6,10 +6,17 @@ Replace this with more appropriate tests for your application.
 """
 
 import decimal
+import io
+import os
+import pickle
+import socket
+import tempfile
+import threading
 from datetime import datetime
 
 from django.db import models
 from django.test import TestCase
+from django.utils import timezone
 
 from pbandj.modelish import types
 from pbandj.modelish import mapper
@@ -18,7 +25,13 @@ from pbandj.modelish import dj
 from pbandj.modelish.types import PB_TYPE_DOUBLE
 from pbandj import decorator
 from pbandj import util
-from pbandj.conversion import Converter
+from pbandj import conversion
+from pbandj import profiling
+from pbandj import parallel
+from pbandj import stream
+from pbandj import container
+from pbandj.cache import MessageCache, get_cache
+from pbandj.conversion import Converter, normalize_mask
 
 import pbandj_test.models as test_models
 
@@ -238,6 +251,53 @@ class TestDjangoFieldConversion(TestCase):
         proto_ooe = self.converter.djtopb(self.django_ooe)
         self.assertEqual('14:30:00.999999', proto_ooe.time_test)
         self.assertEqual(datetime(1980, 6, 10, 14, 30, 0, 999999).time(), self.converter.pbtodj(proto_ooe).time_test)
+
+    def test_date_time_before_1900_conversion(self):
+        self.django_ooe.date_time_test = datetime(1850, 1, 2, 3, 4, 5, 6)
+        self.django_ooe.date_test = datetime(1850, 1, 2).date()
+        proto_ooe = self.converter.djtopb(self.django_ooe)
+        self.assertEqual('1850-01-02 03:04:05.000006', proto_ooe.date_time_test)
+        self.assertEqual('1850-01-02', proto_ooe.date_test)
+        django_ooe = self.converter.pbtodj(proto_ooe)
+        self.assertEqual(datetime(1850, 1, 2, 3, 4, 5, 6), django_ooe.date_time_test)
+        self.assertEqual(datetime(1850, 1, 2).date(), django_ooe.date_test)
+
+    def test_aware_date_time_conversion(self):
+        self.django_ooe.date_time_test = datetime(1980, 6, 10, 14, 30, 0, tzinfo=timezone.utc)
+        proto_ooe = self.converter.djtopb(self.django_ooe)
+        self.assertEqual('1980-06-10 14:30:00.000000', proto_ooe.date_time_test)
+
+    def test_date_time_fallback_conversion(self):
+        # Strings not in the fixed width layout pbandj writes are parsed
+        # by strptime
+        proto_ooe = self.pb2.OneOfEverything()
+        proto_ooe.date_time_test = '1980-6-10 14:30:00.5'
+        proto_ooe.date_test = '1980-6-1'
+        proto_ooe.time_test = '4:30:00.25'
+        django_ooe = self.converter.pbtodj(proto_ooe)
+        self.assertEqual(datetime(1980, 6, 10, 14, 30, 0, 500000), django_ooe.date_time_test)
+        self.assertEqual(datetime(1980, 6, 1).date(), django_ooe.date_test)
+        self.assertEqual(datetime(1980, 6, 1, 4, 30, 0, 250000).time(), django_ooe.time_test)
+
+        proto_ooe.date_time_test = '1980-06-10T14:30:00.000000'
+        self.assertRaises(ValueError, self.converter.pbtodj, proto_ooe)
+        proto_ooe.date_time_test = '1980-13-10 14:30:00.000000'
+        self.assertRaises(ValueError, self.converter.pbtodj, proto_ooe)
+
+    def test_date_time_malformed_conversion(self):
+        # Strings in the fixed width layout with fields int() would take
+        # but strptime doesn't are rejected
+        for name, val in (('date_time_test', '+980-06-10 14:30:00.000000'),
+                          ('date_time_test', ' 980-06-10 14:30:00.000000'),
+                          ('date_time_test', '1980-06-10 14:30:00.-00001'),
+                          ('date_test', '1980-+6-10'),
+                          ('date_test', u'\u0661\u0669\u0668\u0660-06-10'),
+                          ('time_test', '+4:30:00.000000'),
+                          ('time_test', '14:30: 0.000000')):
+            proto_ooe = self.pb2.OneOfEverything()
+            setattr(proto_ooe, name, val)
+            for converter in (self.converter, Converter(self.mapped_module, compiled=False)):
+                self.assertRaises(ValueError, converter.pbtodj, proto_ooe)
   
 #    def test_decimal_conversion_python27(self):
 #        self.django_ooe.decimal_test = 0.0
@@ -282,15 +342,19 @@ class TestDjangoFieldConversion(TestCase):
         self.assertEqual(0, proto_ooe.float_test)
         self.assertEqual(0, self.converter.pbtodj(proto_ooe).float_test)
         
+        # Float fields hold 32 bit floats
         self.django_ooe.float_test = -1.2345
         proto_ooe = self.converter.djtopb(self.django_ooe)
-        self.assertEqual(-1.2345, proto_ooe.float_test)
+        self.assertEqual(-1.2345000505447388, proto_ooe.float_test)
         self.assertEqual(-1.2345, self.converter.pbtodj(proto_ooe).float_test)
         
         self.django_ooe.float_test = 1.2345
         proto_ooe = self.converter.djtopb(self.django_ooe)
-        self.assertEqual(1.2345, proto_ooe.float_test)
+        self.assertEqual(1.2345000505447388, proto_ooe.float_test)
         self.assertEqual(1.2345, self.converter.pbtodj(proto_ooe).float_test)
+        
+        interpreted = Converter(self.mapped_module, compiled=False)
+        self.assertEqual(1.2345, interpreted.pbtodj(proto_ooe).float_test)
     
     def test_email_conversion(self):
         self.django_ooe.email_test = 'zwalker@lcogt.net'
@@ -420,7 +484,56 @@ class TestDjangoFieldConversion(TestCase):
         proto_ooe = self.converter.djtopb(self.django_ooe)
         self.assertEqual('http://lcogt.net', proto_ooe.url_test)
         self.assertEqual('http://lcogt.net', self.converter.pbtodj(proto_ooe).url_test)
-    
+
+    def test_char_conversion_truncates_to_max_length(self):
+        proto_ooe = self.pb2.OneOfEverything()
+        proto_ooe.char_test = 'abcdefghijklmnop'
+        self.assertEqual('abcdefghij', self.converter.pbtodj(proto_ooe).char_test)
+
+    def test_compiled_matches_interpreted_conversion(self):
+        interpreted = Converter(self.mapped_module, compiled=False)
+        self.django_ooe.bool_test = True
+        self.django_ooe.char_test = 'abc123'
+        self.django_ooe.date_test = datetime(1980, 6, 10).date()
+        self.django_ooe.date_time_test = datetime(1980, 6, 10, 14, 30, 0, 999999)
+        self.django_ooe.time_test = datetime(1980, 6, 10, 14, 30, 0, 999999).time()
+        self.django_ooe.decimal_test = '-1.2345'
+        self.django_ooe.file_test = '/random/path/tofile.ext'
+        self.django_ooe.int_test = -1
+        self.django_ooe.url_test = 'http://lcogt.net'
+        proto_ooe = self.converter.djtopb(self.django_ooe)
+        self.assertEqual(interpreted.djtopb(self.django_ooe), proto_ooe)
+        compiled_ooe = self.converter.pbtodj(proto_ooe)
+        interpreted_ooe = interpreted.pbtodj(proto_ooe)
+        for name in self.converter.registry.for_message(proto_ooe).pb_to_dj_field_map.keys():
+            self.assertEqual(getattr(interpreted_ooe, name), getattr(compiled_ooe, name))
+        # Strings over max_length are truncated either way
+        proto_ooe.char_test = 'abcdefghijklmnop'
+        self.assertEqual('abcdefghij', self.converter.pbtodj(proto_ooe).char_test)
+        self.assertEqual('abcdefghij', interpreted.pbtodj(proto_ooe).char_test)
+            
+    def test_values_conversion(self):
+        for i in range(3):
+            test_models.OneOfEverything.objects.create(
+                bool_test=True, char_test='abc%d' % i, comma_test='1,2',
+                date_test=datetime(1980, 6, 10).date(),
+                date_time_test=datetime(1980, 6, 10, 14, 30, 0, 999999),
+                decimal_test=decimal.Decimal('-1.25'), email_test='a@lcogt.net',
+                file_test='/random/path/tofile.ext', file_path_test='/random/path',
+                float_test=1.5, image_test='/random/path/image.png', int_test=-i,
+                ip_test='127.0.0.1', null_bool_test=None, pos_int_test=i,
+                pos_sm_int_test=i, slug_test='slug', sm_int_test=-i,
+                text_test='text', time_test=datetime(1980, 6, 10, 14, 30, 0, 999999).time(),
+                url_test='http://lcogt.net')
+        queryset = test_models.OneOfEverything.objects.order_by('id')
+        expected = [self.converter.djtopb(ooe) for ooe in queryset]
+        with self.assertNumQueries(1):
+            protos = self.converter.djtopb_values(queryset)
+        self.assertEqual(expected, protos)
+        protos = self.converter.djtopb_values(queryset, excludes=['char_test'])
+        self.assertFalse(protos[0].HasField('char_test'))
+        self.assertEqual(expected[0].text_test, protos[0].text_test)
+
 #    def test_xml_conversion(self):
 #        self.django_ooe.xml_test = '<abc>123</abc>'
 #        proto_ooe = self.converter.djtopb(self.django_ooe)
@@ -760,3 +873,1595 @@ class TestDjangoOneToOneFieldConversion(TestCase):
         proto_o2oct = self.converter.djtopb(self.django_o2oct)
         self.assertEqual(proto_o2opt, proto_o2oct.o2o_test)
         self.assertEqual(self.django_o2opt, self.converter.pbtodj(proto_o2oct).o2o_test)
+
+
+
+@decorator.protocol_buffer_message
+class RegistryTestModel(models.Model):
+    val = models.IntegerField()
+
+
+class ProxyRegistryTestModel(RegistryTestModel):
+    class Meta:
+        proxy = True
+
+
+class TestConversionRegistry(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestConversionRegistry')
+        cls.mapped_module.add_mapped_model(RegistryTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def test_lookup_by_msg_name(self):
+        mapped_model = self.converter.registry.for_msg_name('RegistryTestModel')
+        self.assertEqual(RegistryTestModel, mapped_model.dj_model)
+        self.assertEqual(None, self.converter.registry.for_msg_name('DoesNotExist'))
+        
+    def test_lookup_by_message(self):
+        mapped_model = self.converter.registry.for_message(self.pb2.RegistryTestModel())
+        self.assertEqual(RegistryTestModel, mapped_model.dj_model)
+        self.assertIn(self.pb2.RegistryTestModel.DESCRIPTOR, self.converter.registry.by_descriptor)
+        
+    def test_lookup_by_dj_type(self):
+        mapped_model = self.converter.registry.for_dj_type(RegistryTestModel)
+        self.assertEqual('RegistryTestModel', mapped_model.pbandj_pb_msg.name)
+        self.assertEqual(None, self.converter.registry.for_dj_type(ExcludeTest))
+        
+    def test_proxy_model_conversion(self):
+        self.assertEqual(self.converter.registry.for_dj_type(RegistryTestModel),
+                         self.converter.registry.for_dj_type(ProxyRegistryTestModel))
+        django_proxy = ProxyRegistryTestModel(val=7)
+        proto_proxy = self.converter.djtopb(django_proxy)
+        self.assertIsInstance(proto_proxy, self.pb2.RegistryTestModel)
+        self.assertEqual(7, proto_proxy.val)
+
+
+@decorator.protocol_buffer_message
+class AotParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class AotChildTestModel(models.Model):
+    state_choices = (('On', 'On'), ('Off', 'Off'))
+    state = models.CharField(max_length=3, choices=state_choices)
+    name = models.CharField(max_length=5)
+    decimal_test = models.DecimalField(decimal_places=2, max_digits=6)
+    date_time_test = models.DateTimeField()
+    parent = models.ForeignKey(AotParentTestModel)
+
+
+@decorator.protocol_buffer_message
+class AotTargetTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message(follow_related=False)
+class AotReferenceTestModel(models.Model):
+    target = models.ForeignKey(AotTargetTestModel)
+
+
+class TestAheadOfTimeConversion(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestAheadOfTimeConversion')
+        cls.mapped_module.add_mapped_model(AotParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(AotChildTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(AotReferenceTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(AotTargetTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        util.generate_conv_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def setUp(self):
+        self.django_parent = AotParentTestModel(val=3)
+        self.django_parent.save()
+        self.django_child = AotChildTestModel(state='Off', name='abc',
+                                              decimal_test=decimal.Decimal('1.25'),
+                                              date_time_test=datetime(2010, 6, 5, 4, 3, 2, 1),
+                                              parent=self.django_parent)
+        self.django_child.save()
+        
+    def test_uses_aot_module(self):
+        self.assertTrue(self.converter.uses_aot_module)
+        
+    def test_aot_matches_compiled_conversion(self):
+        plan_converter = Converter(self.mapped_module)
+        plan_converter.add_conv_helper(types.PB_TYPE_BOOL, models.BooleanField,
+                                      lambda input_type, output_type, val: val)
+        self.assertFalse(plan_converter.uses_aot_module)
+        proto_child = self.converter.djtopb(self.django_child)
+        self.assertEqual(plan_converter.djtopb(self.django_child), proto_child)
+        self.assertEqual(self.pb2.AotChildTestModel.Off, proto_child.state)
+        self.assertEqual(3, proto_child.parent.val)
+        django_child = self.converter.pbtodj(proto_child)
+        plan_django_child = plan_converter.pbtodj(proto_child)
+        for name in ('id', 'state', 'name', 'decimal_test', 'date_time_test', 'parent'):
+            self.assertEqual(getattr(plan_django_child, name), getattr(django_child, name))
+        self.assertEqual('Off', django_child.state)
+        self.assertEqual(self.django_parent, django_child.parent)
+        
+    def test_pk_relation_conversion(self):
+        converter = Converter(self.mapped_module)
+        self.assertTrue(converter.uses_aot_module)
+        target = AotTargetTestModel.objects.create(val=5)
+        proto_reference = converter.djtopb(AotReferenceTestModel(target=target))
+        self.assertEqual(target.pk, proto_reference.target)
+        self.assertEqual(target, converter.pbtodj(proto_reference).target)
+        # Every field of the module is inlined
+        self.assertTrue(converter._Converter__helpers is None)
+        
+    def test_out_of_date_module_ignored(self):
+        stale_module = mapper.MappedModule('TestAheadOfTimeConversion')
+        stale_module.add_mapped_model(self.mapped_module.mapped_models[0])
+        self.assertNotEqual(self.mapped_module.schema_fingerprint(), stale_module.schema_fingerprint())
+        self.assertFalse(Converter(stale_module).uses_aot_module)
+
+
+@decorator.protocol_buffer_message
+class BatchParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class BatchTagTestModel(models.Model):
+    name = models.CharField(max_length=10)
+
+
+@decorator.protocol_buffer_message
+class BatchChildTestModel(models.Model):
+    val = models.IntegerField()
+    parent = models.ForeignKey(BatchParentTestModel)
+    tags = models.ManyToManyField(BatchTagTestModel)
+
+
+class TestDjangoBatchConversion(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestDjangoBatchConversion')
+        cls.mapped_module.add_mapped_model(BatchParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(BatchTagTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(BatchChildTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def setUp(self):
+        parents = [BatchParentTestModel.objects.create(val=i) for i in range(3)]
+        tags = [BatchTagTestModel.objects.create(name='tag%d' % i) for i in range(3)]
+        for i in range(10):
+            child = BatchChildTestModel.objects.create(val=i, parent=parents[i % 3])
+            child.tags.add(tags[i % 3], tags[(i + 1) % 3])
+        
+    def test_relation_paths(self):
+        mapped_model = self.converter.registry.for_dj_type(BatchChildTestModel)
+        self.assertEqual((['parent'], ['tags']), self.converter.relation_paths(mapped_model))
+        self.assertEqual(([], ['tags']), self.converter.relation_paths(mapped_model, excludes=['parent']))
+        
+    def test_djtopb_many(self):
+        queryset = BatchChildTestModel.objects.order_by('id')
+        expected = [self.converter.djtopb(child) for child in queryset]
+        # One query for the children joined to their parents and one for the tags
+        with self.assertNumQueries(2):
+            protos = self.converter.djtopb_many(queryset)
+        self.assertEqual(expected, protos)
+        self.assertEqual(10, len(protos))
+        self.assertEqual(2, len(protos[0].tags))
+        
+    def test_djtopb_many_excludes(self):
+        with self.assertNumQueries(1):
+            protos = self.converter.djtopb_many(BatchChildTestModel.objects.all(),
+                                                excludes=['parent', 'tags'])
+        self.assertFalse(protos[0].HasField('parent'))
+        self.assertEqual(0, len(protos[0].tags))
+        
+    def test_mask_conversion(self):
+        child = BatchChildTestModel.objects.all()[0]
+        proto_child = self.converter.djtopb(child, mask=['val', 'parent.val'])
+        self.assertEqual(child.val, proto_child.val)
+        self.assertEqual(child.parent.val, proto_child.parent.val)
+        self.assertFalse(proto_child.HasField('id'))
+        self.assertFalse(proto_child.parent.HasField('id'))
+        self.assertEqual(0, len(proto_child.tags))
+        proto_child = self.converter.djtopb(child, mask=['parent', 'tags.name'])
+        self.assertEqual(self.converter.djtopb(child.parent), proto_child.parent)
+        self.assertEqual(sorted(tag.name for tag in child.tags.all()),
+                         sorted(tag.name for tag in proto_child.tags))
+        self.assertFalse(proto_child.tags[0].HasField('id'))
+        
+    def test_mask_errors(self):
+        child = BatchChildTestModel.objects.all()[0]
+        self.assertRaises(Exception, self.converter.djtopb, child, mask=['bogus'])
+        self.assertRaises(Exception, self.converter.djtopb, child, mask=['val.bogus'])
+        
+    def test_mask_lookups(self):
+        mapped_model = self.converter.registry.for_dj_type(BatchChildTestModel)
+        self.assertEqual((['parent', 'parent__val', 'val'], ['parent'], []),
+                         self.converter.mask_lookups(mapped_model, normalize_mask(['val', 'parent.val'])))
+        self.assertEqual((['parent'], ['parent'], ['tags']),
+                         self.converter.mask_lookups(mapped_model, normalize_mask(['parent', 'tags.name'])))
+        self.assertEqual((None, ['val'], ['parent'], []),
+                         self.converter.load_lookups(mapped_model, excludes=['val', 'tags']))
+        
+    def test_djtopb_many_mask(self):
+        queryset = BatchChildTestModel.objects.order_by('id')
+        mask = ['val', 'parent.val']
+        expected = [self.converter.djtopb(child, mask=mask) for child in queryset]
+        with self.assertNumQueries(1):
+            protos = self.converter.djtopb_many(queryset, mask=mask)
+        self.assertEqual(expected, protos)
+        with self.assertNumQueries(1):
+            self.assertEqual(expected, list(self.converter.iter_djtopb(queryset, mask=mask)))
+        with self.assertNumQueries(2):
+            protos = self.converter.djtopb_many(queryset, mask=['tags.name'])
+        self.assertEqual(2, len(protos[0].tags))
+        
+    def test_values_mask(self):
+        queryset = BatchChildTestModel.objects.order_by('id')
+        expected = [self.converter.djtopb(child, mask=['val']) for child in queryset]
+        with self.assertNumQueries(1):
+            self.assertEqual(expected, self.converter.djtopb_values(queryset, mask=['val']))
+        
+    def test_iter_djtopb(self):
+        queryset = BatchChildTestModel.objects.order_by('id')
+        expected = [self.converter.djtopb(child) for child in queryset]
+        # One query for the children and one tag prefetch per chunk of 4
+        with self.assertNumQueries(4):
+            protos = list(self.converter.iter_djtopb(queryset, chunk_size=4))
+        self.assertEqual(expected, protos)
+        
+    def test_iter_djtopb_serialize(self):
+        queryset = BatchChildTestModel.objects.order_by('id')
+        expected = [self.converter.djtopb(child).SerializeToString() for child in queryset]
+        self.assertEqual(expected, list(self.converter.iter_djtopb(queryset, serialize=True)))
+
+        
+    def test_nested_conversion_matches_interpreted(self):
+        interpreted = Converter(self.mapped_module, compiled=False)
+        for child in BatchChildTestModel.objects.all():
+            proto_child = self.converter.djtopb(child)
+            self.assertEqual(interpreted.djtopb(child), proto_child)
+            self.assertEqual(child.parent.val, proto_child.parent.val)
+            self.assertEqual(sorted(tag.name for tag in child.tags.all()),
+                             sorted(tag.name for tag in proto_child.tags))
+        
+    def test_session_reuses_related_messages(self):
+        children = list(BatchChildTestModel.objects.order_by('id'))
+        expected = [self.converter.djtopb(child) for child in children]
+        children = list(BatchChildTestModel.objects.order_by('id'))
+        # One query per distinct parent and one tag query per child
+        with self.assertNumQueries(3 + 10):
+            with self.converter.session() as session:
+                protos = [self.converter.djtopb(child) for child in children]
+        self.assertEqual(expected, protos)
+        self.assertEqual(None, self.converter.current_session)
+        self.assertEqual(3 + 3, len(session.messages))
+        
+    def test_session_evicts_least_recently_used(self):
+        session = self.converter.session(max_size=2)
+        session.add_instance(BatchParentTestModel, 1, 'one')
+        session.add_instance(BatchParentTestModel, 2, 'two')
+        session.instance(BatchParentTestModel, 1)
+        session.add_instance(BatchParentTestModel, 3, 'three')
+        self.assertEqual('one', session.instance(BatchParentTestModel, 1))
+        self.assertEqual(None, session.instance(BatchParentTestModel, 2))
+        self.assertEqual('three', session.instance(BatchParentTestModel, 3))
+
+
+@decorator.protocol_buffer_message
+class BulkParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message(follow_related=False)
+class BulkChildTestModel(models.Model):
+    val = models.IntegerField()
+    parent = models.ForeignKey(BulkParentTestModel)
+
+
+@decorator.protocol_buffer_message
+class BulkGrandchildTestModel(models.Model):
+    child = models.ForeignKey(BulkChildTestModel)
+
+
+class TestProtocolBufferBatchConversion(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestProtocolBufferBatchConversion')
+        # Map the child first so its ForeignKey is mapped to an int
+        cls.mapped_module.add_mapped_model(BulkChildTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(BulkParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(BulkGrandchildTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def setUp(self):
+        self.parents = [BulkParentTestModel.objects.create(val=i) for i in range(3)]
+        self.children = [BulkChildTestModel.objects.create(val=i, parent=self.parents[i % 3])
+                         for i in range(6)]
+        self.grandchildren = [BulkGrandchildTestModel.objects.create(child=child)
+                              for child in self.children]
+        
+    def test_int_fk_resolves_related_object(self):
+        proto_child = self.converter.djtopb(self.children[1])
+        self.assertEqual(self.parents[1].pk, proto_child.parent)
+        self.assertEqual(self.parents[1], self.converter.pbtodj(proto_child).parent)
+        
+    def test_pbtodj_many(self):
+        protos = [self.converter.djtopb(child) for child in self.children]
+        # One in_bulk query for all of the parents
+        with self.assertNumQueries(1):
+            django_children = self.converter.pbtodj_many(protos)
+            self.assertEqual([child.parent for child in self.children],
+                             [child.parent for child in django_children])
+        self.assertEqual([child.val for child in self.children],
+                         [child.val for child in django_children])
+        
+    def test_pbtodj_many_nested(self):
+        protos = [self.converter.djtopb(grandchild) for grandchild in self.grandchildren]
+        with self.assertNumQueries(1):
+            django_grandchildren = self.converter.pbtodj_many(protos)
+            self.assertEqual([grandchild.child.parent for grandchild in self.grandchildren],
+                             [grandchild.child.parent for grandchild in django_grandchildren])
+                             
+    def test_session_reuses_related_objects(self):
+        protos = [self.converter.djtopb(child) for child in self.children]
+        # One query per distinct parent
+        with self.assertNumQueries(3):
+            with self.converter.session():
+                django_children = [self.converter.pbtodj(proto) for proto in protos]
+        self.assertTrue(django_children[0].parent is django_children[3].parent)
+        self.assertEqual(self.parents[0], django_children[0].parent)
+        
+    def test_session_reuses_nested_instances(self):
+        protos = [self.converter.djtopb(grandchild) for grandchild in self.grandchildren]
+        protos.append(self.converter.djtopb(self.grandchildren[0]))
+        with self.converter.session():
+            django_grandchildren = [self.converter.pbtodj(proto) for proto in protos]
+        self.assertTrue(django_grandchildren[0].child is django_grandchildren[-1].child)
+
+        
+    def test_values_conversion(self):
+        queryset = BulkChildTestModel.objects.order_by('id')
+        expected = [self.converter.djtopb(child) for child in queryset]
+        with self.assertNumQueries(1):
+            protos = self.converter.djtopb_values(queryset)
+        self.assertEqual(expected, protos)
+        
+    def test_values_conversion_needs_instances(self):
+        queryset = BulkGrandchildTestModel.objects.order_by('id')
+        self.assertEqual(['child'], list(self.converter.values_plan(
+            self.converter.registry.for_dj_type(BulkGrandchildTestModel))[1]))
+        self.assertEqual([self.converter.djtopb(grandchild) for grandchild in queryset],
+                         self.converter.djtopb_values(queryset))
+
+
+@decorator.protocol_buffer_message
+class ToFieldTargetTestModel(models.Model):
+    code = models.IntegerField(unique=True)
+
+
+@decorator.protocol_buffer_message(follow_related=False)
+class ToFieldTestModel(models.Model):
+    target = models.ForeignKey(ToFieldTargetTestModel, to_field='code')
+
+
+class TestToFieldForeignKeyConversion(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestToFieldForeignKeyConversion')
+        # Map the child first so its ForeignKey is mapped to an int
+        cls.mapped_module.add_mapped_model(ToFieldTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(ToFieldTargetTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        util.generate_conv_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def setUp(self):
+        # The key column holds the code, which differs from the pk
+        self.target = ToFieldTargetTestModel.objects.create(code=1000)
+        self.django_obj = ToFieldTestModel.objects.create(target=self.target)
+        
+    def test_to_field_conversion(self):
+        self.assertTrue(self.converter.uses_aot_module)
+        for converter in (self.converter, Converter(self.mapped_module, profile=True),
+                          Converter(self.mapped_module, compiled=False)):
+            proto_obj = converter.djtopb(self.django_obj)
+            self.assertEqual(self.target.pk, proto_obj.target)
+            self.assertEqual(self.target, converter.pbtodj(proto_obj).target)
+        queryset = ToFieldTestModel.objects.all()
+        self.assertEqual([self.target.pk],
+                         [msg.target for msg in self.converter.djtopb_values(queryset)])
+        self.assertEqual([self.target.pk],
+                         [msg.target for msg in self.converter.djtopb_many(queryset)])
+
+
+@decorator.protocol_buffer_message(temporal_type=types.TEMPORAL_EPOCH)
+class EpochTimeTestModel(models.Model):
+    date_time_test = models.DateTimeField()
+    date_test = models.DateField()
+    time_test = models.TimeField()
+
+
+@decorator.protocol_buffer_message
+class EpochModuleTestModel(models.Model):
+    date_time_test = models.DateTimeField()
+
+
+@decorator.protocol_buffer_message(temporal_type=types.TEMPORAL_STRING)
+class EpochStringTestModel(models.Model):
+    date_time_test = models.DateTimeField()
+
+
+class TestEpochTemporalConversion(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestEpochTemporalConversion')
+        cls.mapped_module.add_mapped_model(EpochTimeTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(EpochModuleTestModel.generate_protocol_buffer(temporal_type=types.TEMPORAL_EPOCH))
+        cls.mapped_module.add_mapped_model(EpochStringTestModel.generate_protocol_buffer(temporal_type=types.TEMPORAL_EPOCH))
+        util.generate_pb2_module(cls.mapped_module)
+        util.generate_conv_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def field_type(self, mapped_model, name):
+        return mapped_model.pb_to_dj_field_map[name][1].pb_type
+        
+    def test_field_types(self):
+        epoch_model, module_model, string_model = self.mapped_module.mapped_models
+        for name in ('date_time_test', 'date_test', 'time_test'):
+            self.assertEqual(types.PB_TYPE_SINT64, self.field_type(epoch_model, name))
+        self.assertEqual(types.PB_TYPE_SINT64, self.field_type(module_model, 'date_time_test'))
+        self.assertEqual(types.PB_TYPE_STRING, self.field_type(string_model, 'date_time_test'))
+        
+    def test_unknown_temporal_type(self):
+        self.assertRaises(Exception, types.dj2pb, models.DateField, 'bogus')
+        
+    def test_epoch_conversion(self):
+        django_epoch = EpochTimeTestModel(date_time_test=datetime(1970, 1, 2, 0, 0, 1, 5, tzinfo=timezone.utc),
+                                          date_test=datetime(1969, 12, 31).date(),
+                                          time_test=datetime(1980, 6, 10, 1, 2, 3, 4).time())
+        proto_epoch = self.converter.djtopb(django_epoch)
+        self.assertTrue(self.converter.uses_aot_module)
+        self.assertEqual((86400 + 1) * 1000000 + 5, proto_epoch.date_time_test)
+        self.assertEqual(-1, proto_epoch.date_test)
+        self.assertEqual(((1 * 60 + 2) * 60 + 3) * 1000000 + 4, proto_epoch.time_test)
+        django_epoch = self.converter.pbtodj(proto_epoch)
+        self.assertEqual(datetime(1970, 1, 2, 0, 0, 1, 5, tzinfo=timezone.utc), django_epoch.date_time_test)
+        self.assertEqual(datetime(1969, 12, 31).date(), django_epoch.date_test)
+        self.assertEqual(datetime(1980, 6, 10, 1, 2, 3, 4).time(), django_epoch.time_test)
+        
+    def test_epoch_conversion_matches_plans(self):
+        django_epoch = EpochTimeTestModel(date_time_test=datetime(2010, 6, 5, 4, 3, 2, 1, tzinfo=timezone.utc),
+                                          date_test=datetime(2010, 6, 5).date(),
+                                          time_test=datetime(2010, 6, 5, 4, 3, 2, 1).time())
+        plan_converter = Converter(self.mapped_module, compiled=False)
+        proto_epoch = self.converter.djtopb(django_epoch)
+        self.assertEqual(plan_converter.djtopb(django_epoch), proto_epoch)
+        self.assertEqual(len(proto_epoch.SerializeToString()), proto_epoch.ByteSize())
+        self.assertTrue(proto_epoch.ByteSize() < 26)
+        django_epoch = plan_converter.pbtodj(proto_epoch)
+        self.assertEqual(datetime(2010, 6, 5, 4, 3, 2, 1, tzinfo=timezone.utc), django_epoch.date_time_test)
+
+
+@decorator.protocol_buffer_message(decimal_type=types.DECIMAL_SCALED)
+class ScaledDecimalTestModel(models.Model):
+    decimal_test = models.DecimalField(decimal_places=2, max_digits=18)
+    whole_test = models.DecimalField(decimal_places=0, max_digits=4)
+
+
+class TestScaledDecimalConversion(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestScaledDecimalConversion')
+        cls.mapped_module.add_mapped_model(ScaledDecimalTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        util.generate_conv_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def test_field_types(self):
+        mapped_model = self.mapped_module.mapped_models[0]
+        self.assertEqual(types.PB_TYPE_SINT64, mapped_model.pb_to_dj_field_map['decimal_test'][1].pb_type)
+        
+    def test_scaled_conversion(self):
+        django_decimal = ScaledDecimalTestModel(decimal_test=decimal.Decimal('1234567890123456.78'),
+                                                whole_test=decimal.Decimal('-12'))
+        proto_decimal = self.converter.djtopb(django_decimal)
+        self.assertTrue(self.converter.uses_aot_module)
+        self.assertEqual(123456789012345678, proto_decimal.decimal_test)
+        self.assertEqual(-12, proto_decimal.whole_test)
+        plan_converter = Converter(self.mapped_module, compiled=False)
+        self.assertEqual(plan_converter.djtopb(django_decimal), proto_decimal)
+        for converter in (self.converter, plan_converter):
+            django_decimal = converter.pbtodj(proto_decimal)
+            self.assertEqual(decimal.Decimal('1234567890123456.78'), django_decimal.decimal_test)
+            self.assertEqual(decimal.Decimal('-12'), django_decimal.whole_test)
+        
+    def test_scaling(self):
+        self.assertEqual(-5, conversion.decimal_to_scaled(decimal.Decimal('-0.05'), 2))
+        self.assertEqual(150, conversion.decimal_to_scaled(decimal.Decimal('1.5'), 2))
+        self.assertEqual(1200, conversion.decimal_to_scaled(decimal.Decimal('1.2E+1'), 2))
+        self.assertEqual(12, conversion.decimal_to_scaled(decimal.Decimal('0.125'), 2))
+        self.assertEqual(-14, conversion.decimal_to_scaled(decimal.Decimal('-0.135'), 2))
+        self.assertEqual(125, conversion.decimal_to_scaled(1.25, 2))
+        self.assertRaises(ValueError, conversion.decimal_to_scaled, decimal.Decimal('NaN'), 2)
+        self.assertEqual(decimal.Decimal('-0.05'), conversion.scaled_to_decimal(-5, 2))
+        self.assertEqual('0.00', str(conversion.scaled_to_decimal(0, 2)))
+
+
+class TestSharedConverter(TestCase):
+    
+    def setUp(self):
+        self.mapped_module = mapper.MappedModule('TestSharedConverter')
+        self.mapped_module.add_mapped_model(test_models.Simple.generate_protocol_buffer())
+        
+    def test_converter_is_shared(self):
+        converter = self.mapped_module.converter()
+        self.assertTrue(converter is self.mapped_module.converter())
+        converters = []
+        threads = [threading.Thread(target=lambda: converters.append(self.mapped_module.converter()))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([converter] * 4, converters)
+        
+    def test_add_mapped_model_invalidates(self):
+        converter = self.mapped_module.converter()
+        self.mapped_module.add_mapped_model(test_models.EnumTest.generate_protocol_buffer())
+        new_converter = self.mapped_module.converter()
+        self.assertFalse(converter is new_converter)
+        self.assertNotEqual(None, new_converter.registry.for_dj_type(test_models.EnumTest))
+        self.mapped_module.reset_converter()
+        self.assertFalse(new_converter is self.mapped_module.converter())
+        
+    def test_pickle(self):
+        self.mapped_module.converter()
+        restored = pickle.loads(pickle.dumps(self.mapped_module))
+        self.assertNotEqual(None, restored.converter().registry.for_dj_type(test_models.Simple))
+
+
+@decorator.protocol_buffer_message
+class DepthNodeTestModel(models.Model):
+    val = models.IntegerField()
+    parent = models.ForeignKey('self', null=True)
+
+
+class TestBoundedConversion(TestCase):
+    
+    mapped_module = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestBoundedConversion')
+        cls.mapped_module.add_mapped_model(DepthNodeTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        
+    def setUp(self):
+        # A chain of 5 nodes with the root as the parent of the first
+        self.nodes = []
+        parent = None
+        for i in range(5):
+            parent = DepthNodeTestModel.objects.create(val=i, parent=parent)
+            self.nodes.append(parent)
+        self.nodes[0].parent = self.nodes[4]
+        self.nodes[0].save()
+        
+    def chain_depth(self, msg):
+        depth = 0
+        while msg.parent.HasField('val'):
+            msg = msg.parent
+            depth += 1
+        return depth, msg
+        
+    def test_max_depth(self):
+        for compiled in (True, False):
+            converter = Converter(self.mapped_module, compiled=compiled, max_depth=2)
+            proto_node = converter.djtopb(self.nodes[4])
+            depth, last = self.chain_depth(proto_node)
+            self.assertEqual(2, depth)
+            self.assertEqual(self.nodes[1].pk, last.parent.id)
+            self.assertEqual([], last.parent.ListFields()[1:])
+            
+    def test_memo_ends_cycles(self):
+        for compiled in (True, False):
+            converter = Converter(self.mapped_module, compiled=compiled, memo=True)
+            proto_node = converter.djtopb(self.nodes[4])
+            depth, last = self.chain_depth(proto_node)
+            # Around the cycle back to the top level node
+            self.assertEqual(4, depth)
+            self.assertEqual(self.nodes[4].pk, last.parent.id)
+            self.assertFalse(last.parent.HasField('val'))
+            # The memo is per top level message
+            self.assertEqual(proto_node, converter.djtopb(self.nodes[4]))
+            self.assertEqual(None, converter.current_session)
+
+
+@decorator.protocol_buffer_message(reverse_relations=['reversechildtestmodel',
+                                                     'reverseprofiletestmodel'])
+class ReverseParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class ReverseChildTestModel(models.Model):
+    val = models.IntegerField()
+    parent = models.ForeignKey(ReverseParentTestModel)
+
+
+@decorator.protocol_buffer_message
+class ReverseProfileTestModel(models.Model):
+    name = models.CharField(max_length=10)
+    parent = models.OneToOneField(ReverseParentTestModel)
+
+
+class TestReverseRelationConversion(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestReverseRelationConversion')
+        cls.mapped_module.add_mapped_model(ReverseParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(ReverseChildTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(ReverseProfileTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        util.generate_conv_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def setUp(self):
+        self.parents = [ReverseParentTestModel.objects.create(val=i) for i in range(3)]
+        for i in range(6):
+            ReverseChildTestModel.objects.create(val=i, parent=self.parents[i % 2])
+        ReverseProfileTestModel.objects.create(name='first', parent=self.parents[0])
+        
+    def check_parents(self, proto_parents):
+        self.assertEqual([0, 2, 4], [child.val for child in proto_parents[0].reversechildtestmodel])
+        self.assertEqual([1, 3, 5], [child.val for child in proto_parents[1].reversechildtestmodel])
+        self.assertEqual([], list(proto_parents[2].reversechildtestmodel))
+        self.assertEqual('first', proto_parents[0].reverseprofiletestmodel.name)
+        self.assertFalse(proto_parents[1].HasField('reverseprofiletestmodel'))
+        # Related messages don't point back at the parent
+        self.assertFalse(proto_parents[0].reversechildtestmodel[0].HasField('parent'))
+        self.assertFalse(proto_parents[0].reverseprofiletestmodel.HasField('parent'))
+        
+    def test_unknown_relation(self):
+        self.assertRaises(Exception, mapper.MappedModel,
+                          ReverseParentTestModel, reverse_relations=['nothing'])
+        
+    def test_reverse_relations(self):
+        self.assertTrue(self.converter.uses_aot_module)
+        self.check_parents([self.converter.djtopb(parent) for parent in self.parents])
+        for compiled in (True, False):
+            converter = Converter(self.mapped_module, compiled=compiled)
+            self.check_parents([converter.djtopb(parent) for parent in self.parents])
+        
+    def test_reverse_relations_batched(self):
+        queryset = ReverseParentTestModel.objects.order_by('id')
+        # One query per converted relation
+        with self.assertNumQueries(3):
+            proto_parents = self.converter.djtopb_many(queryset)
+        self.check_parents(proto_parents)
+        with self.assertNumQueries(3):
+            self.check_parents(self.converter.djtopb_values(queryset))
+        
+    def test_excluded_reverse_relation(self):
+        queryset = ReverseParentTestModel.objects.order_by('id')
+        with self.assertNumQueries(2):
+            proto_parents = self.converter.djtopb_many(queryset, excludes=['reversechildtestmodel'])
+        self.assertEqual([], list(proto_parents[0].reversechildtestmodel))
+        self.assertEqual('first', proto_parents[0].reverseprofiletestmodel.name)
+        with self.assertNumQueries(2):
+            proto_parents = self.converter.djtopb_many(queryset, mask=['val', 'reversechildtestmodel'])
+        self.assertEqual([0, 2, 4], [child.val for child in proto_parents[0].reversechildtestmodel])
+        self.assertFalse(proto_parents[0].HasField('reverseprofiletestmodel'))
+
+
+@decorator.protocol_buffer_message
+class SaveParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class SaveTagTestModel(models.Model):
+    name = models.CharField(max_length=10)
+
+
+@decorator.protocol_buffer_message
+class SaveChildTestModel(models.Model):
+    val = models.IntegerField()
+    parent = models.ForeignKey(SaveParentTestModel)
+    tags = models.ManyToManyField(SaveTagTestModel)
+
+
+@decorator.protocol_buffer_message
+class SaveMembershipTestModel(models.Model):
+    rank = models.IntegerField()
+    parent = models.ForeignKey(SaveParentTestModel)
+    tag = models.ForeignKey(SaveTagTestModel)
+
+
+class SaveTopicTestModel(models.Model):
+    name = models.CharField(max_length=10)
+
+
+@decorator.protocol_buffer_message
+class SaveBoardTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message(follow_related=False)
+class SaveNoteTestModel(models.Model):
+    board = models.ForeignKey(SaveBoardTestModel)
+    topic = models.ForeignKey(SaveTopicTestModel)
+
+
+class TestProtocolBufferGraphSave(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestProtocolBufferGraphSave')
+        cls.mapped_module.add_mapped_model(SaveParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(SaveTagTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(SaveChildTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(SaveMembershipTestModel.generate_protocol_buffer())
+        # Map the note first so its topic is mapped to an int
+        cls.mapped_module.add_mapped_model(SaveNoteTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(SaveBoardTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def test_save_graph(self):
+        existing_tag = SaveTagTestModel.objects.create(name='old')
+        proto_parent = self.pb2.SaveParentTestModel(val=1)
+        for i in range(3):
+            proto_child = proto_parent.savechildtestmodel.add(val=i)
+            proto_child.tags.add(name='new%d' % i)
+            proto_child.tags.add(id=existing_tag.pk, name='ignored')
+        proto_membership = proto_parent.savemembershiptestmodel.add(rank=7)
+        proto_membership.tag.name = 'member'
+        
+        parent = self.converter.pbtodj_save(proto_parent)
+        self.assertEqual(parent, SaveParentTestModel.objects.get(val=1))
+        children = list(parent.savechildtestmodel_set.order_by('val'))
+        self.assertEqual([0, 1, 2], [child.val for child in children])
+        for i, child in enumerate(children):
+            self.assertEqual(['new%d' % i, 'old'], sorted(tag.name for tag in child.tags.all()))
+        # Existing rows are referred to rather than rewritten
+        self.assertEqual('old', SaveTagTestModel.objects.get(pk=existing_tag.pk).name)
+        membership = SaveMembershipTestModel.objects.get(parent=parent)
+        self.assertEqual((7, 'member'), (membership.rank, membership.tag.name))
+        
+    def test_children_bulk_created(self):
+        proto_parents = []
+        for i in range(2):
+            proto_parent = self.pb2.SaveParentTestModel(val=i)
+            for j in range(5):
+                proto_parent.savechildtestmodel.add(val=j)
+            proto_parents.append(proto_parent)
+        # A save per parent and one insert for all of the children
+        with self.assertNumQueries(3):
+            parents = self.converter.pbtodj_save_many(proto_parents)
+        self.assertEqual([5, 5], [parent.savechildtestmodel_set.count() for parent in parents])
+        
+    def test_nested_references_batched(self):
+        topics = [SaveTopicTestModel.objects.create(name='topic%d' % i) for i in range(3)]
+        proto_board = self.pb2.SaveBoardTestModel(val=1)
+        for topic in topics:
+            proto_board.savenotetestmodel.add(topic=topic.pk)
+        # One lookup of the topics, the board and one insert of the notes
+        with self.assertNumQueries(3):
+            board = self.converter.pbtodj_save(proto_board)
+        self.assertEqual([topic.pk for topic in topics],
+                         [note.topic_id for note in board.savenotetestmodel_set.order_by('id')])
+        
+    def test_save_with_pks(self):
+        proto_child = self.pb2.SaveChildTestModel(id=20, val=1)
+        proto_child.parent.id = 10
+        proto_child.parent.val = 2
+        proto_child.tags.add(id=30, name='tag')
+        # One existence check per model, one insert per model and the
+        # through rows
+        with self.assertNumQueries(7):
+            child = self.converter.pbtodj_save(proto_child)
+        self.assertEqual((20, 10), (child.pk, child.parent_id))
+        self.assertEqual([30], [tag.pk for tag in SaveChildTestModel.objects.get(pk=20).tags.all()])
+        # Saving again only refers to the saved rows
+        with self.assertNumQueries(3):
+            self.converter.pbtodj_save(proto_child)
+        self.assertEqual(1, SaveChildTestModel.objects.count())
+
+
+class UpdateParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message(follow_related=False)
+class UpdateTestModel(models.Model):
+    name = models.CharField(max_length=10)
+    val = models.IntegerField()
+    amount = models.DecimalField(decimal_places=2, max_digits=6)
+    parent = models.ForeignKey(UpdateParentTestModel)
+
+
+@decorator.protocol_buffer_message
+class UpdateOwnerTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class UpdateStampTestModel(models.Model):
+    val = models.IntegerField()
+    owner = models.ForeignKey(UpdateOwnerTestModel)
+    modified = models.DateTimeField(auto_now=True)
+
+
+class TestProtocolBufferUpdate(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestProtocolBufferUpdate')
+        cls.mapped_module.add_mapped_model(UpdateTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(UpdateOwnerTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(UpdateStampTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def setUp(self):
+        self.parents = [UpdateParentTestModel.objects.create(val=i) for i in range(2)]
+        self.objs = [UpdateTestModel.objects.create(name='obj%d' % i, val=i,
+                                                    amount=decimal.Decimal('1.50'),
+                                                    parent=self.parents[0])
+                     for i in range(4)]
+        
+    def test_update_changed_fields(self):
+        obj = self.objs[0]
+        # Changed behind the back of obj
+        UpdateTestModel.objects.filter(pk=obj.pk).update(name='other')
+        proto_obj = self.pb2.UpdateTestModel(id=obj.pk, val=5, amount=1.5, parent=self.parents[1].pk)
+        with self.assertNumQueries(1):
+            changed = self.converter.pbtodj_update(proto_obj, obj)
+        self.assertEqual(['parent', 'val'], sorted(changed))
+        obj = UpdateTestModel.objects.get(pk=obj.pk)
+        self.assertEqual(('other', 5, self.parents[1].pk), (obj.name, obj.val, obj.parent_id))
+        
+    def test_unchanged_skips_write(self):
+        obj = self.objs[0]
+        proto_obj = self.pb2.UpdateTestModel(id=obj.pk, name='obj0', amount=1.5, parent=self.parents[0].pk)
+        with self.assertNumQueries(0):
+            self.assertEqual([], self.converter.pbtodj_update(proto_obj, obj))
+        
+    def test_update_many(self):
+        proto_objs = [self.pb2.UpdateTestModel(id=obj.pk, val=9) for obj in self.objs[:3]]
+        proto_objs.append(self.pb2.UpdateTestModel(id=self.objs[3].pk, name='obj3'))
+        proto_objs[0].name = 'renamed'
+        # A load, one update for the rows getting val 9 only and one for
+        # the renamed row.  The unchanged row isn't written
+        with self.assertNumQueries(3):
+            results = self.converter.pbtodj_update_many(proto_objs)
+        self.assertEqual([['name', 'val'], ['val'], ['val'], []],
+                         [sorted(changed) for obj, changed in results])
+        self.assertEqual([('renamed', 9), ('obj1', 9), ('obj2', 9), ('obj3', 3)],
+                         list(UpdateTestModel.objects.order_by('id').values_list('name', 'val')))
+        self.assertRaises(UpdateTestModel.DoesNotExist, self.converter.pbtodj_update_many,
+                          [self.pb2.UpdateTestModel(id=1000, val=1)])
+        
+    def create_stamps(self):
+        self.owners = [UpdateOwnerTestModel.objects.create(val=i) for i in range(2)]
+        stamps = [UpdateStampTestModel.objects.create(val=i, owner=self.owners[0]) for i in range(3)]
+        self.old = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        UpdateStampTestModel.objects.update(modified=self.old)
+        return list(UpdateStampTestModel.objects.order_by('id'))
+        
+    def test_update_auto_now(self):
+        stamps = self.create_stamps()
+        changed = self.converter.pbtodj_update(self.pb2.UpdateStampTestModel(id=stamps[0].pk, val=7),
+                                               stamps[0])
+        self.assertEqual(['val'], changed)
+        self.assertTrue(UpdateStampTestModel.objects.get(pk=stamps[0].pk).modified > self.old)
+        # A load and one update for both rows
+        with self.assertNumQueries(2):
+            self.converter.pbtodj_update_many([self.pb2.UpdateStampTestModel(id=stamp.pk, val=9)
+                                               for stamp in stamps[1:]])
+        modified = [stamp.modified for stamp in UpdateStampTestModel.objects.order_by('id')]
+        self.assertTrue(modified[1] > self.old)
+        self.assertEqual(modified[1], modified[2])
+        
+    def test_update_nested_message(self):
+        stamp = self.create_stamps()[0]
+        proto_stamp = self.pb2.UpdateStampTestModel(id=stamp.pk)
+        proto_stamp.owner.id = self.owners[1].pk
+        proto_stamp.owner.val = 1
+        self.assertEqual(['owner'], self.converter.pbtodj_update(proto_stamp, stamp))
+        self.assertEqual(self.owners[1].pk, UpdateStampTestModel.objects.get(pk=stamp.pk).owner_id)
+        # A nested message without a pk would be written as a NULL key
+        proto_stamp.owner.ClearField('id')
+        self.assertRaises(Exception, self.converter.pbtodj_update, proto_stamp, stamp)
+        self.assertRaises(Exception, self.converter.pbtodj_update_many, [proto_stamp])
+        self.assertEqual(self.owners[1].pk, UpdateStampTestModel.objects.get(pk=stamp.pk).owner_id)
+
+
+@decorator.protocol_buffer_message
+class ProfileParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class ProfileTestModel(models.Model):
+    name = models.CharField(max_length=10)
+    amount = models.DecimalField(decimal_places=2, max_digits=6)
+    parent = models.ForeignKey(ProfileParentTestModel)
+
+
+class TestConversionProfiling(TestCase):
+    
+    mapped_module = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestConversionProfiling')
+        cls.mapped_module.add_mapped_model(ProfileParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(ProfileTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        
+    def setUp(self):
+        parent = ProfileParentTestModel.objects.create(val=1)
+        self.obj = ProfileTestModel.objects.create(name='abc', amount=decimal.Decimal('1.25'), parent=parent)
+        
+    def test_off_by_default(self):
+        self.assertEqual(None, Converter(self.mapped_module).profiler)
+        os.environ[profiling.ENV_VAR] = 'on'
+        try:
+            self.assertNotEqual(None, Converter(self.mapped_module).profiler)
+        finally:
+            del os.environ[profiling.ENV_VAR]
+        
+    def test_profile(self):
+        converter = Converter(self.mapped_module, profile=True)
+        profiler = converter.profiler
+        for i in range(3):
+            proto_obj = converter.djtopb(self.obj)
+        converter.pbtodj(proto_obj)
+        stats = profiler.snapshot()
+        self.assertEqual(3, stats['fields'][('ProfileTestModel', 'name', profiling.DJTOPB)][0])
+        self.assertEqual(3, stats['fields'][('ProfileParentTestModel', 'val', profiling.DJTOPB)][0])
+        self.assertEqual(1, stats['fields'][('ProfileTestModel', 'amount', profiling.PBTODJ)][0])
+        self.assertEqual(3, stats['helpers']['decimal_to_double'][0])
+        self.assertEqual(1, stats['helpers']['double_to_decimal'][0])
+        # The id and val fields of the parent message are converted one
+        # level down in both directions
+        self.assertEqual(3 * 2 + 2, stats['depths'][1])
+        self.assertTrue('ProfileTestModel.amount' in profiler.report())
+        profiler.reset()
+        self.assertEqual({'fields': {}, 'helpers': {}, 'depths': {}}, profiler.snapshot())
+
+
+@decorator.protocol_buffer_message
+class ThroughMemberTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class ThroughOwnerTestModel(models.Model):
+    val = models.IntegerField()
+    members = models.ManyToManyField(ThroughMemberTestModel, through='ThroughLinkTestModel')
+
+
+@decorator.protocol_buffer_message
+class ThroughLinkTestModel(models.Model):
+    rank = models.IntegerField()
+    owner = models.ForeignKey(ThroughOwnerTestModel)
+    member = models.ForeignKey(ThroughMemberTestModel)
+
+
+class TestThroughModelConversion(TestCase):
+    
+    mapped_module = None
+    converter = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestThroughModelConversion')
+        cls.mapped_module.add_mapped_model(ThroughMemberTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(ThroughOwnerTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(ThroughLinkTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        util.generate_conv_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def setUp(self):
+        members = [ThroughMemberTestModel.objects.create(val=i) for i in range(3)]
+        self.owners = [ThroughOwnerTestModel.objects.create(val=i) for i in range(2)]
+        for i, owner in enumerate(self.owners):
+            for j in range(2):
+                ThroughLinkTestModel.objects.create(rank=j, owner=owner, member=members[i + j])
+        
+    def check_owner(self, proto_owner, i):
+        self.assertEqual([(0, i), (1, i + 1)],
+                         [(link.rank, link.member.val) for link in proto_owner.members])
+        # The through rows don't point back at the owner
+        self.assertFalse(proto_owner.members[0].HasField('owner'))
+        
+    def test_through_rows(self):
+        self.assertTrue(self.converter.uses_aot_module)
+        for converter in (self.converter, Converter(self.mapped_module, profile=True),
+                          Converter(self.mapped_module, compiled=False)):
+            for i, owner in enumerate(self.owners):
+                self.check_owner(converter.djtopb(owner), i)
+        
+    def test_through_rows_batched(self):
+        queryset = ThroughOwnerTestModel.objects.order_by('id')
+        # The owners, their through rows and the members of the rows
+        with self.assertNumQueries(3):
+            proto_owners = self.converter.djtopb_many(queryset)
+        for i, proto_owner in enumerate(proto_owners):
+            self.check_owner(proto_owner, i)
+        with self.assertNumQueries(2):
+            proto_owners = self.converter.djtopb_many(queryset, mask=['members.rank'])
+        self.assertEqual([0, 1], [link.rank for link in proto_owners[0].members])
+        
+    def test_save_through_rows(self):
+        proto_owner = self.pb2.ThroughOwnerTestModel(val=7)
+        proto_link = proto_owner.members.add(rank=3)
+        proto_link.member.val = 8
+        owner = self.converter.pbtodj_save(proto_owner)
+        link = ThroughLinkTestModel.objects.get(owner=owner)
+        self.assertEqual((3, 8), (link.rank, link.member.val))
+
+
+@decorator.protocol_buffer_message
+class ExportParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class ExportTestModel(models.Model):
+    name = models.CharField(max_length=10)
+    parent = models.ForeignKey(ExportParentTestModel)
+
+
+class TestParallelExport(TestCase):
+    
+    mapped_module = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestParallelExport')
+        cls.mapped_module.add_mapped_model(ExportParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(ExportTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        
+    def setUp(self):
+        parent = ExportParentTestModel.objects.create(val=1)
+        for i in range(25):
+            ExportTestModel.objects.create(name=str(i), parent=parent)
+        
+    def decode(self, blocks):
+        names = []
+        for block in blocks:
+            for record in parallel.iter_block_records(block):
+                msg = self.pb2.ExportTestModel()
+                msg.ParseFromString(record)
+                names.append(msg.name)
+        return names
+        
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 - 1):
+            encoded = parallel.encode_varint(value)
+            self.assertEqual((value, len(encoded)), parallel.decode_varint(encoded, 0))
+        
+    def test_pk_ranges(self):
+        queryset = ExportTestModel.objects.filter(name__in=['1', '3', '4'])
+        pks = sorted(queryset.values_list('pk', flat=True))
+        self.assertEqual([(pks[0], pks[1]), (pks[2], pks[2])],
+                         parallel.pk_ranges(queryset, 2))
+        self.assertEqual([], parallel.pk_ranges(queryset.none(), 2))
+        
+    def test_export(self):
+        queryset = ExportTestModel.objects.all()
+        expected = [str(i) for i in range(25)]
+        for processes in (1, 2):
+            blocks = list(parallel.export(self.mapped_module, queryset,
+                                          processes=processes, range_size=10))
+            self.assertEqual(3, len(blocks))
+            self.assertEqual(expected, self.decode(blocks))
+        blocks = parallel.export(self.mapped_module, queryset, processes=2,
+                                 range_size=10, ordered=False)
+        self.assertEqual(sorted(expected), sorted(self.decode(blocks)))
+        
+    def test_export_filtered_and_masked(self):
+        queryset = ExportTestModel.objects.filter(name__startswith='1')
+        blocks = list(parallel.export(self.mapped_module, queryset, processes=2,
+                                      range_size=4, mask=['name']))
+        records = [record for block in blocks for record in parallel.iter_block_records(block)]
+        self.assertEqual([msg.SerializeToString() for msg in
+                          Converter(self.mapped_module).djtopb_many(queryset.order_by('pk'),
+                                                                    mask=['name'])],
+                         records)
+        
+    def test_export_errors(self):
+        self.assertRaises(Exception, parallel.export, self.mapped_module,
+                          ExportTestModel.objects.all()[:5])
+
+
+@decorator.protocol_buffer_message
+class PoolParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class PoolTestModel(models.Model):
+    name = models.CharField(max_length=10)
+    note = models.CharField(max_length=10, null=True)
+    parent = models.ForeignKey(PoolParentTestModel, null=True)
+
+
+class TestMessagePool(TestCase):
+    
+    mapped_module = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestMessagePool')
+        cls.mapped_module.add_mapped_model(PoolParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(PoolTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        
+    def setUp(self):
+        parent = PoolParentTestModel.objects.create(val=1)
+        # Alternate set and unset fields so a message that isn't cleared
+        # carries values over
+        for i in range(6):
+            if i % 2:
+                PoolTestModel.objects.create(name=str(i))
+            else:
+                PoolTestModel.objects.create(name=str(i), note='n', parent=parent)
+        self.queryset = PoolTestModel.objects.order_by('pk')
+        
+    def test_pool(self):
+        pool = conversion.MessagePool(max_size=1)
+        msg = pool.acquire(self.pb2.PoolTestModel)
+        msg.name = 'abc'
+        pool.release(msg)
+        self.assertTrue(pool.acquire(self.pb2.PoolTestModel) is msg)
+        self.assertFalse(msg.HasField('name'))
+        other = self.pb2.PoolTestModel()
+        pool.release(msg)
+        pool.release(other)
+        self.assertTrue(pool.acquire(self.pb2.PoolTestModel) is msg)
+        self.assertFalse(pool.acquire(self.pb2.PoolTestModel) is other)
+        
+    def test_pooled_stream(self):
+        for converter in (Converter(self.mapped_module), Converter(self.mapped_module, compiled=False)):
+            expected = list(converter.iter_djtopb(self.queryset, serialize=True))
+            self.assertEqual(expected, list(converter.iter_djtopb(self.queryset, serialize=True,
+                                                                  pooled=True, chunk_size=4)))
+            msgs = []
+            for msg in converter.iter_djtopb(self.queryset, pooled=True):
+                self.assertEqual(expected[len(msgs)], msg.SerializeToString())
+                msgs.append(msg)
+            # One message is filled over and over
+            self.assertEqual(1, len(set(id(msg) for msg in msgs)))
+        
+    def test_pooled_batch(self):
+        converter = Converter(self.mapped_module)
+        expected = [msg.SerializeToString() for msg in converter.djtopb_many(self.queryset)]
+        self.assertEqual(expected, converter.djtopb_many(self.queryset, serialize=True))
+        self.assertEqual(expected, converter.djtopb_many(self.queryset, serialize=True,
+                                                         pooled=True))
+        self.assertEqual([msg.SerializeToString() for msg in
+                          converter.djtopb_many(self.queryset, mask=['name'])],
+                         converter.djtopb_many(self.queryset, mask=['name'], serialize=True,
+                                               pooled=True))
+        self.assertRaises(Exception, converter.djtopb_many, self.queryset, pooled=True)
+
+
+@decorator.protocol_buffer_message
+class CacheParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class CacheTagTestModel(models.Model):
+    name = models.CharField(max_length=10)
+
+
+@decorator.protocol_buffer_message
+class CacheTestModel(models.Model):
+    name = models.CharField(max_length=10)
+    parent = models.ForeignKey(CacheParentTestModel)
+    tags = models.ManyToManyField(CacheTagTestModel)
+
+
+class TestMessageCache(TestCase):
+    
+    mapped_module = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestMessageCache')
+        cls.mapped_module.add_mapped_model(CacheParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(CacheTagTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(CacheTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        
+    def setUp(self):
+        self.parent = CacheParentTestModel.objects.create(val=1)
+        self.tag = CacheTagTestModel.objects.create(name='a')
+        self.obj = CacheTestModel.objects.create(name='abc', parent=self.parent)
+        self.obj.tags.add(self.tag)
+        self.cache = MessageCache()
+        self.converter = Converter(self.mapped_module, cache=self.cache)
+        self.mapped_model = self.converter.registry.for_dj_type(CacheTestModel)
+        
+    def convert(self, converter=None, **kwargs):
+        obj = CacheTestModel.objects.get(pk=self.obj.pk)
+        return (converter or self.converter).djtopb(obj, **kwargs)
+        
+    def test_hit(self):
+        expected = Converter(self.mapped_module).djtopb(self.obj).SerializeToString()
+        self.assertEqual(expected, self.convert().SerializeToString())
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+        obj = CacheTestModel.objects.get(pk=self.obj.pk)
+        # Nothing is loaded for the parent or the tags
+        with self.assertNumQueries(0):
+            msg = self.converter.djtopb(obj)
+            data = self.converter.djtopb_serialized(obj)
+        self.assertEqual(expected, msg.SerializeToString())
+        self.assertEqual(expected, data)
+        self.assertEqual(2, self.cache.hits)
+        
+    def test_mask_and_excludes(self):
+        self.convert()
+        msg = self.convert(mask=['name'])
+        self.assertEqual(['name'], [desc.name for desc, val in msg.ListFields()])
+        self.assertEqual(['name'], [desc.name for desc, val in self.convert(mask=['name']).ListFields()])
+        self.assertEqual(1, self.cache.hits)
+        # Excludes bypass the cache
+        self.assertFalse(self.convert(excludes=['name']).HasField('name'))
+        self.assertEqual((1, 2), (self.cache.hits, self.cache.misses))
+        
+    def test_invalidation(self):
+        self.convert()
+        self.obj.name = 'def'
+        self.obj.save()
+        self.assertEqual('def', self.convert().name)
+        self.parent.val = 2
+        self.parent.save()
+        self.assertEqual(2, self.convert().parent.val)
+        self.tag.name = 'b'
+        self.tag.save()
+        self.assertEqual(['b'], [tag.name for tag in self.convert().tags])
+        other = CacheTagTestModel.objects.create(name='c')
+        self.obj.tags.add(other)
+        self.assertEqual(['b', 'c'], sorted(tag.name for tag in self.convert().tags))
+        other.cachetestmodel_set.clear()
+        self.assertEqual(['b'], [tag.name for tag in self.convert().tags])
+        self.assertEqual(0, self.cache.hits)
+        self.obj.delete()
+        self.assertEqual(None, self.cache.get(self.mapped_model, self.obj.pk))
+        
+    def test_bulk_writes(self):
+        self.convert()
+        proto_obj = self.pb2.CacheTestModel(id=self.obj.pk, name='xyz')
+        self.converter.pbtodj_update_many([proto_obj])
+        self.assertEqual('xyz', self.convert().name)
+        
+    def test_lru(self):
+        cache = MessageCache(max_size=1)
+        converter = Converter(self.mapped_module, cache=cache)
+        other = CacheTestModel.objects.create(name='other', parent=self.parent)
+        self.convert(converter)
+        converter.djtopb(other)
+        self.convert(converter)
+        self.assertEqual((0, 3), (cache.hits, cache.misses))
+        
+    def test_streams(self):
+        CacheTestModel.objects.create(name='other', parent=self.parent)
+        queryset = CacheTestModel.objects.order_by('pk')
+        expected = list(Converter(self.mapped_module).iter_djtopb(queryset, serialize=True))
+        self.assertEqual(expected, list(self.converter.iter_djtopb(queryset, serialize=True)))
+        self.assertEqual(expected, list(self.converter.iter_djtopb(queryset, serialize=True,
+                                                                   pooled=True)))
+        self.assertEqual(expected, self.converter.djtopb_many(queryset, serialize=True))
+        self.assertEqual((4, 2), (self.cache.hits, self.cache.misses))
+        
+    def test_backend(self):
+        backend = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        first = MessageCache(backend=backend)
+        second = MessageCache(backend=backend)
+        self.convert(Converter(self.mapped_module, cache=first))
+        converter = Converter(self.mapped_module, cache=second)
+        self.assertEqual('abc', self.convert(converter).name)
+        self.assertEqual(1, second.hits)
+        # Another process invalidating through the backend
+        first.invalidate(self.mapped_model, self.obj.pk)
+        CacheTestModel.objects.filter(pk=self.obj.pk).update(name='def')
+        self.assertEqual('def', self.convert(converter).name)
+        first.invalidate_model(self.converter.registry.for_dj_type(CacheTestModel))
+        CacheTestModel.objects.filter(pk=self.obj.pk).update(name='ghi')
+        self.assertEqual('ghi', self.convert(converter).name)
+        self.assertEqual(1, second.hits)
+
+
+@decorator.protocol_buffer_message
+class StreamParentTestModel(models.Model):
+    val = models.IntegerField()
+
+
+@decorator.protocol_buffer_message
+class StreamTestModel(models.Model):
+    name = models.CharField(max_length=200)
+    parent = models.ForeignKey(StreamParentTestModel)
+
+
+class ReadOnlyFile(object):
+    """A file like object with only read()
+    """
+    
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+        
+    def read(self, size):
+        return self.data.read(size)
+
+
+class TestMessageStream(TestCase):
+    
+    mapped_module = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestMessageStream')
+        cls.mapped_module.add_mapped_model(StreamParentTestModel.generate_protocol_buffer())
+        cls.mapped_module.add_mapped_model(StreamTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def setUp(self):
+        parent = StreamParentTestModel.objects.create(val=1)
+        # Names of mixed lengths so records straddle small buffers
+        for i in range(20):
+            StreamTestModel.objects.create(name='n' * (i * 9 % 150), parent=parent)
+        self.queryset = StreamTestModel.objects.order_by('pk')
+        self.expected = [msg.SerializeToString()
+                         for msg in self.converter.djtopb_many(self.queryset)]
+        
+    def write(self, buffer_size=stream.DEFAULT_BUFFER_SIZE):
+        out = io.BytesIO()
+        writer = stream.StreamWriter(out, self.converter, buffer_size)
+        self.assertEqual(20, writer.write_queryset(self.queryset))
+        writer.flush()
+        return out.getvalue()
+        
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 - 1):
+            encoded = stream.encode_varint(value)
+            self.assertEqual((value, len(encoded)), stream.decode_varint(encoded, 0))
+            self.assertEqual(None, stream.decode_varint(encoded, 0, len(encoded) - 1))
+        self.assertRaises(Exception, stream.decode_varint, '\xff' * 11, 0)
+        
+    def test_round_trip(self):
+        for buffer_size in (stream.DEFAULT_BUFFER_SIZE, 16, 1):
+            data = self.write(buffer_size)
+            reader = stream.StreamReader(io.BytesIO(data), buffer_size)
+            self.assertEqual(self.expected, [record.tobytes() for record in reader])
+            self.assertEqual(20, reader.count)
+            reader = stream.StreamReader(ReadOnlyFile(data), buffer_size)
+            self.assertEqual(self.expected, [msg.SerializeToString()
+                                             for msg in reader.messages(self.pb2.StreamTestModel)])
+        
+    def test_objects(self):
+        out = io.BytesIO()
+        with stream.StreamWriter(out, self.converter) as writer:
+            for obj in self.queryset[:3]:
+                writer.write_object(obj)
+            writer.write(self.pb2.StreamTestModel(name='msg'))
+        reader = stream.StreamReader(io.BytesIO(out.getvalue()))
+        objs = list(reader.objects(self.converter, self.pb2.StreamTestModel))
+        self.assertEqual([obj.name for obj in self.queryset[:3]] + ['msg'],
+                         [obj.name for obj in objs])
+        self.assertTrue(isinstance(objs[0], StreamTestModel))
+        self.assertEqual(objs[0].parent_id, self.queryset[0].parent_id)
+        
+    def test_truncated(self):
+        data = self.write()
+        reader = stream.StreamReader(io.BytesIO(data[:-1]), 32)
+        self.assertRaises(Exception, list, reader)
+        self.assertEqual([], list(stream.StreamReader(io.BytesIO(''))))
+        
+    def test_socket(self):
+        sender, receiver = socket.socketpair()
+        try:
+            def send():
+                writer = stream.StreamWriter(sender, self.converter, 64)
+                for data in self.expected:
+                    writer.write_serialized(data)
+                writer.flush()
+                sender.shutdown(socket.SHUT_WR)
+            thread = threading.Thread(target=send)
+            thread.start()
+            records = [record.tobytes() for record in stream.StreamReader(receiver, 64)]
+            thread.join()
+        finally:
+            sender.close()
+            receiver.close()
+        self.assertEqual(self.expected, records)
+
+
+@decorator.protocol_buffer_message
+class ContainerTestModel(models.Model):
+    name = models.CharField(max_length=200)
+
+
+class TestMessageContainer(TestCase):
+    
+    mapped_module = None
+    pb2 = None
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.mapped_module = mapper.MappedModule('TestMessageContainer')
+        cls.mapped_module.add_mapped_model(ContainerTestModel.generate_protocol_buffer())
+        util.generate_pb2_module(cls.mapped_module)
+        cls.pb2 = cls.mapped_module.load_pb2()
+        cls.converter = Converter(cls.mapped_module)
+        
+    def setUp(self):
+        for i in range(30):
+            ContainerTestModel.objects.create(name='n%d' % i * (i % 7))
+        # Leave gaps in the pks
+        ContainerTestModel.objects.filter(name__in=['n3' * 3, 'n10' * 3]).delete()
+        self.queryset = ContainerTestModel.objects.order_by('pk')
+        self.pks = list(self.queryset.values_list('pk', flat=True))
+        self.expected = [(msg.id, msg.SerializeToString())
+                         for msg in self.converter.djtopb_many(self.queryset)]
+        handle, self.path = tempfile.mkstemp(suffix='.pbjc')
+        os.close(handle)
+        
+    def tearDown(self):
+        os.remove(self.path)
+        
+    def write(self, **kwargs):
+        writer = container.ContainerWriter(open(self.path, 'wb'), self.converter, **kwargs)
+        self.assertEqual(28, writer.write_queryset(self.queryset.reverse()))
+        writer.close()
+        return container.ContainerReader(self.path)
+        
+    def test_round_trip(self):
+        for kwargs in ({}, {'block_size': 64}, {'block_size': 64, 'compress': False}):
+            with self.write(**kwargs) as reader:
+                self.assertEqual(28, len(reader))
+                self.assertEqual(self.expected, list(reader))
+                for pk, data in self.expected:
+                    self.assertEqual(data, reader.get(pk))
+                for pk in (0, self.pks[0] - 1, self.pks[-1] + 1, 4, 11):
+                    if pk not in self.pks:
+                        self.assertEqual(None, reader.get(pk))
+                self.assertEqual(ContainerTestModel.objects.get(pk=self.pks[5]).name,
+                                 reader.get_message(self.pks[5], self.pb2.ContainerTestModel).name)
+        self.assertTrue(len(reader.index) > 1)
+        
+    def test_range(self):
+        reader = self.write(block_size=64)
+        self.assertTrue(len(reader.index) > 2)
+        first, last = self.pks[2], self.pks[20]
+        self.assertEqual(self.expected[2:21], list(reader.range(first, last)))
+        # Bounds between pks
+        self.assertEqual(self.expected[3:], list(reader.range(self.pks[2] + 0.5)))
+        self.assertEqual(self.expected[:4], list(reader.range(None, self.pks[3])))
+        self.assertEqual(self.expected[25:], list(reader.range(self.pks[25])))
+        self.assertEqual([], list(reader.range(self.pks[-1] + 1)))
+        objs = list(reader.objects(self.converter, self.pb2.ContainerTestModel, first, last))
+        self.assertEqual([name for name in self.queryset.values_list('name', flat=True)][2:21],
+                         [obj.name for obj in objs])
+        reader.close()
+        
+    def test_checksum(self):
+        self.write(block_size=64).close()
+        data = bytearray(open(self.path, 'rb').read())
+        # A byte of the stored data of the first block
+        data[container.HEADER.size + container.BLOCK_HEADER.size + 2] ^= 0xff
+        open(self.path, 'wb').write(data)
+        reader = container.ContainerReader(self.path)
+        self.assertRaises(Exception, reader.get, self.pks[0])
+        reader.close()
+        
+    def test_errors(self):
+        writer = container.ContainerWriter(open(self.path, 'wb'))
+        writer.write(5, 'abc')
+        self.assertRaises(Exception, writer.write, 5, 'def')
+        writer.close()
+        reader = container.ContainerReader(self.path)
+        self.assertEqual([(5, 'abc')], list(reader))
+        reader.close()
+        container.ContainerWriter(open(self.path, 'wb')).close()
+        reader = container.ContainerReader(self.path)
+        self.assertEqual((0, None, []), (len(reader), reader.get(1), list(reader)))
+        reader.close()
+        open(self.path, 'wb').write('not a container file')
+        self.assertRaises(Exception, container.ContainerReader, self.path)
+        
+    def test_writer_error_closes_file(self):
+        fileobj = open(self.path, 'wb')
+        try:
+            with container.ContainerWriter(fileobj, block_size=4) as writer:
+                writer.write(1, 'abcdef')
+                writer.write(2, 'abcdef')
+                raise ValueError('interrupted')
+        except ValueError:
+            pass
+        self.assertTrue(fileobj.closed)
+        # The partial container has no index
+        self.assertRaises(Exception, container.ContainerReader, self.path)
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+# Copyright (C) 2009  Las Cumbres Observatory <lcogt.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''benchmark.py - Throughput and latency benchmarks of the conversions
+of mapped models.
+
+An app lists its BenchmarkCases in CASES of its benchmark module and the
+bench_protobuf management command runs them against a test database at
+each of a list of sizes.  See pbandj_test.pbandj_bench for an example.
+run_codec_benchmarks times the value codecs on their own.
+'''
+
+import decimal
+import gc
+import os
+from datetime import datetime
+from timeit import default_timer
+
+from django.db import connection
+
+import conversion
+from conversion import Converter
+
+# Numbers of objects each case is run with
+DEFAULT_SIZES = (1, 10, 100, 1000, 10000, 100000)
+
+# Most objects converted one at a time when measuring latency
+LATENCY_SAMPLE = 1000
+
+
+class BenchmarkCase(object):
+    """A mapped model converted by the benchmarks with the data it is
+    converted from
+    """
+
+    def __init__(self, name, dj_model, populate, **converter_kwargs):
+        '''Create a BenchmarkCase
+
+        Args:
+        name - (str) name of the case in results
+        dj_model - (Model class) mapped Django model that is converted
+        populate - (callable) populate(size) creates size objects of
+                   dj_model and the objects they relate to in an empty
+                   database
+        converter_kwargs - keyword args of the Converter of the case, like
+                           max_depth for recursive models
+        '''
+        self.name = name
+        self.dj_model = dj_model
+        self.populate = populate
+        self.converter_kwargs = converter_kwargs
+
+
+def best_time(fn, repeat, setup=None):
+    """Get the shortest time in seconds of repeat calls of fn.  When setup
+    is given fn is called with what setup returns and setup isn't timed.
+    """
+    best = None
+    gc_enabled = gc.isenabled()
+    for i in range(repeat):
+        args = () if setup is None else (setup(),)
+        gc.disable()
+        try:
+            start = default_timer()
+            fn(*args)
+            elapsed = default_timer() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory_kb(fn):
+    """Get how many KB the peak RSS grows while fn runs.  fn runs in a
+    forked child so earlier runs don't hide the growth.  None where fork
+    or the resource module isn't available.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    if not hasattr(os, 'fork'):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Child.  Never returns to the caller
+        try:
+            os.close(read_fd)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            fn()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_fd, str(after - before))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    try:
+        data = os.read(read_fd, 64)
+    finally:
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+    if not data:
+        return None
+    return int(data)
+
+
+def clear_tables(dj_models):
+    """Delete every row of the tables of a list of Django models without
+    loading them
+    """
+    cursor = connection.cursor()
+    for dj_model in dj_models:
+        cursor.execute('DELETE FROM %s' % connection.ops.quote_name(dj_model._meta.db_table))
+
+
+def run_case(case, mapped_module, size, repeat=3, tables=(), memory=False):
+    """Populate the database for a case and measure its conversions
+
+    Args:
+    case - (BenchmarkCase) case to run
+    mapped_module - (MappedModule) module mapping the model of the case
+    size - (int) number of objects converted
+    repeat - (int) best of this many runs is reported
+    tables - (list) Django models whose rows are deleted first
+    memory - (bool) also measure the peak RSS growth of djtopb_many and
+             iter_djtopb
+
+    Returns:
+    dict of the measurements.  Times per object are in microseconds.
+    """
+    clear_tables(tables)
+    case.populate(size)
+    converter = Converter(mapped_module, **case.converter_kwargs)
+    queryset = case.dj_model._default_manager.order_by('pk')
+    sample = min(size, LATENCY_SAMPLE)
+    
+    msgs = converter.djtopb_many(queryset.all())
+    djtopb_many_s = best_time(lambda: converter.djtopb_many(queryset.all()), repeat)
+    djtopb_s = best_time(lambda objs: [converter.djtopb(obj) for obj in objs], repeat,
+                         setup=lambda: list(queryset[:sample]))
+    stream_s = best_time(lambda: list(converter.iter_djtopb(queryset.all(), serialize=True)),
+                         repeat)
+    stream_pooled_s = best_time(lambda: list(converter.iter_djtopb(queryset.all(), serialize=True,
+                                                                   pooled=True)),
+                                repeat)
+    pbtodj_many_s = best_time(lambda: converter.pbtodj_many(msgs), repeat)
+    pbtodj_s = best_time(lambda: [converter.pbtodj(msg) for msg in msgs[:sample]], repeat)
+    serialized = [msg.SerializeToString() for msg in msgs]
+    
+    # One object converted and serialized per request, with the shared
+    # converter of the module and with a new one.  The shared converter
+    # has no converter_kwargs so cases with some are left out.
+    if case.converter_kwargs:
+        request_shared_s = request_new_s = None
+    else:
+        def request_shared(objs):
+            for obj in objs:
+                mapped_module.converter().djtopb(obj).SerializeToString()
+        def request_new(objs):
+            for obj in objs:
+                Converter(mapped_module).djtopb(obj).SerializeToString()
+        mapped_module.reset_converter()
+        request_shared_s = best_time(request_shared, repeat, setup=lambda: list(queryset[:sample]))
+        request_new_s = best_time(request_new, repeat, setup=lambda: list(queryset[:sample]))
+    
+    result = {'case': case.name,
+            'message': case.dj_model.__name__,
+            'size': size,
+            'aot': converter.uses_aot_module,
+            'djtopb_many_s': djtopb_many_s,
+            'djtopb_many_rows_per_s': size / djtopb_many_s if djtopb_many_s else None,
+            'djtopb_us': djtopb_s * 1e6 / sample,
+            'stream_rows_per_s': size / stream_s if stream_s else None,
+            'stream_pooled_rows_per_s': size / stream_pooled_s if stream_pooled_s else None,
+            'pbtodj_many_s': pbtodj_many_s,
+            'pbtodj_many_rows_per_s': size / pbtodj_many_s if pbtodj_many_s else None,
+            'pbtodj_us': pbtodj_s * 1e6 / sample,
+            'request_shared_us': request_shared_s * 1e6 / sample if request_shared_s else None,
+            'request_new_converter_us': request_new_s * 1e6 / sample if request_new_s else None,
+            'bytes_per_msg': sum(len(data) for data in serialized) / float(size)}
+    if memory:
+        # Objects are loaded inside the measured call
+        msgs = serialized = None
+        gc.collect()
+        result['djtopb_many_peak_kb'] = peak_memory_kb(
+            lambda: len(converter.djtopb_many(queryset.all())))
+        result['stream_peak_kb'] = peak_memory_kb(
+            lambda: sum(1 for data in converter.iter_djtopb(queryset.all(), serialize=True)))
+    return result
+
+
+def run_benchmarks(cases, mapped_module, sizes=DEFAULT_SIZES, repeat=3, tables=(), log=None,
+                   memory=False):
+    """Run each case at each size.  Returns the list of run_case results
+
+    Args:
+    cases - (list) BenchmarkCases to run
+    mapped_module - (MappedModule) module mapping the models of the cases
+    sizes - (list) numbers of objects each case is run with
+    repeat - (int) best of this many runs is reported
+    tables - (list) Django models whose rows are deleted before each run
+    log - (callable) called with each result as it is measured
+    memory - (bool) also measure peak RSS growth.  See run_case
+    """
+    results = []
+    for case in cases:
+        for size in sizes:
+            result = run_case(case, mapped_module, size, repeat, tables, memory)
+            results.append(result)
+            if log is not None:
+                log(result)
+    return results
+
+
+# Codecs timed by run_codec_benchmarks as (name, value, encode, decode,
+# reference encode, reference decode).  The references are the
+# strftime/strptime and float conversions the codecs replace.
+CODEC_STAMP = datetime(2010, 6, 5, 4, 3, 2, 1)
+CODECS = [
+    ('datetime', CODEC_STAMP,
+     lambda val: conversion.datetime_to_string(None, None, val),
+     lambda val: conversion.string_to_datetime(None, None, val),
+     lambda val: val.strftime(conversion.DATETIME_FORMAT),
+     lambda val: datetime.strptime(val, conversion.DATETIME_FORMAT)),
+    ('date', CODEC_STAMP.date(),
+     lambda val: conversion.date_to_string(None, None, val),
+     lambda val: conversion.string_to_date(None, None, val),
+     lambda val: val.strftime(conversion.DATE_FORMAT),
+     lambda val: datetime.strptime(val, conversion.DATE_FORMAT).date()),
+    ('time', CODEC_STAMP.time(),
+     lambda val: conversion.time_to_string(None, None, val),
+     lambda val: conversion.string_to_time(None, None, val),
+     lambda val: val.strftime(conversion.TIME_FORMAT),
+     lambda val: datetime.strptime(val, conversion.TIME_FORMAT).time()),
+    ('datetime_epoch', CODEC_STAMP,
+     lambda val: conversion.datetime_to_epoch_micros(None, None, val),
+     lambda val: conversion.epoch_micros_to_datetime(None, None, val),
+     lambda val: val.strftime(conversion.DATETIME_FORMAT),
+     lambda val: datetime.strptime(val, conversion.DATETIME_FORMAT)),
+    ('decimal_scaled', decimal.Decimal('12345.67'),
+     lambda val: conversion.decimal_to_scaled(val, 2),
+     lambda val: conversion.scaled_to_decimal(val, 2),
+     lambda val: conversion.decimal_to_double(None, None, val),
+     lambda val: conversion.double_to_decimal(None, None, val)),
+]
+
+
+def run_codec_benchmarks(repeat=3, number=100000, log=None):
+    """Time each of CODECS.  Returns a list of dicts with the times per
+    value in microseconds
+
+    Args:
+    repeat - (int) best of this many runs is reported
+    number - (int) values encoded and decoded per run
+    log - (callable) called with each result as it is measured
+    """
+    results = []
+    for name, val, encode, decode, ref_encode, ref_decode in CODECS:
+        times = []
+        for fn, arg in ((encode, val), (decode, encode(val)),
+                        (ref_encode, val), (ref_decode, ref_encode(val))):
+            elapsed = best_time(lambda: [fn(arg) for i in xrange(number)], repeat)
+            times.append(elapsed * 1e6 / number)
+        result = {'codec': name,
+                  'encode_us': times[0],
+                  'decode_us': times[1],
+                  'reference_encode_us': times[2],
+                  'reference_decode_us': times[3]}
+        results.append(result)
+        if log is not None:
+            log(result)
+    return results
@@ -0,0 +1,281 @@
+#!/usr/bin/python
+# Copyright (C) 2009  Las Cumbres Observatory <lcogt.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''cache.py - Cache of serialized messages of Django objects.
+
+A Converter created with cache=MessageCache() looks up serialized
+messages by (MappedModel, pk, field mask) before converting an object and
+stores what it converts.  Entries are dropped when the post_save,
+post_delete and m2m_changed signals report a change to the object or to
+an object embedded in its message.  Since a change to an embedded object
+doesn't say which messages embed it, every entry of the models embedding
+it is dropped.
+
+Entries live in a bounded in-process LRU.  With a Django cache backend
+they are shared by every process using the backend, and the LRU only
+keeps copies that are checked against the backend before being used.
+'''
+
+import hashlib
+import threading
+import uuid
+
+from django.db.models import signals
+
+from modelish.pb.message import Message
+
+from conversion import ConversionRegistry, LRUCache
+
+try:
+    # Django 1.7 and later
+    from django.core.cache import caches
+    get_cache = caches.__getitem__
+except ImportError:
+    from django.core.cache import get_cache
+
+
+class MessageCache(object):
+    """Serialized messages keyed by (MappedModel, pk, field mask)
+    """
+
+    def __init__(self, max_size=10000, backend=None, timeout=None, key_prefix='pbandj'):
+        '''Create a MessageCache
+
+        Args:
+        max_size - (int) Number of objects whose messages are kept in
+                   process.  The least recently used are dropped beyond that.
+        backend - Alias of a cache in the CACHES setting or a Django cache
+                  object to share entries through.  None keeps entries in
+                  process only.
+        timeout - (int) Seconds entries are kept by the backend.  Defaults
+                  to the timeout of the backend.
+        key_prefix - (str) Prefix of the backend keys
+        '''
+        if isinstance(backend, basestring):
+            backend = get_cache(backend)
+        self.backend = backend
+        self.timeout = timeout
+        # Older backends take None for their default timeout, newer ones
+        # for no timeout
+        self.__timeout_kwargs = {} if timeout is None else {'timeout': timeout}
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        # {(MappedModel, pk): {mask: (token, serialized message)}}
+        self.__local = LRUCache(max_size)
+        # Bumped to drop every in process entry of a MappedModel
+        self.__generations = {}
+        self.__modules = []
+        self.__registries = []
+        # {MappedModel: backend key prefix}
+        self.__key_bases = {}
+        # {MappedModel: MappedModels whose messages embed it}
+        self.__embedded_by = {}
+        self.__connected = False
+
+    def watch(self, mapped_module):
+        """Cache the messages of the models of a MappedModule and connect
+        the signals invalidating them.  Converters call this for their
+        module.  Models of modules that aren't watched aren't cached.
+        """
+        with self.__lock:
+            if any(module is mapped_module for module in self.__modules):
+                return
+            registry = ConversionRegistry(mapped_module.mapped_models)
+            fingerprint = mapped_module.schema_fingerprint()[:12]
+            embeds = {}
+            for mapped_model in mapped_module.mapped_models:
+                self.__key_bases[mapped_model] = '%s:%s:%s' % (
+                    self.key_prefix, fingerprint, mapped_model.pbandj_pb_msg.name)
+                fields = list(mapped_model.pb_to_dj_field_map.values())
+                fields.extend(mapped_model.pb_to_dj_relation_map[name]
+                              for name in mapped_model.converted_relations)
+                embeds[mapped_model] = set()
+                for dj_field, pb_field in fields:
+                    if isinstance(pb_field.pb_type, Message):
+                        child = registry.for_msg_name(pb_field.pb_type.name)
+                        if child is not None:
+                            embeds[mapped_model].add(child)
+            # Invert the closure of embeds so a change reaches the messages
+            # embedding a model at any depth
+            for mapped_model in mapped_module.mapped_models:
+                seen = set()
+                pending = list(embeds[mapped_model])
+                while pending:
+                    child = pending.pop()
+                    if child in seen:
+                        continue
+                    seen.add(child)
+                    pending.extend(embeds.get(child, ()))
+                for child in seen:
+                    self.__embedded_by.setdefault(child, set()).add(mapped_model)
+            self.__modules.append(mapped_module)
+            self.__registries.append(registry)
+            if not self.__connected:
+                signals.post_save.connect(self._object_changed)
+                signals.post_delete.connect(self._object_changed)
+                signals.m2m_changed.connect(self._m2m_changed)
+                self.__connected = True
+
+    def watches(self, mapped_model):
+        """True if messages of a MappedModel are cached
+        """
+        return mapped_model in self.__key_bases
+
+    def mask_key(self, mask):
+        if mask is None:
+            return 'all'
+        return hashlib.md5(repr(mask)).hexdigest()[:16]
+
+    def __backend_keys(self, mapped_model, pk):
+        base = self.__key_bases[mapped_model]
+        return '%s:m' % base, '%s:r:%s' % (base, pk)
+
+    def __backend_token(self, mapped_model, pk, create):
+        """Get the (model token, object token) of the backend entries of
+        an object or None.  Invalidation deletes a token so entries stored
+        under the old one are never read again.
+        """
+        model_key, row_key = self.__backend_keys(mapped_model, pk)
+        tokens = self.backend.get_many([model_key, row_key])
+        if len(tokens) < 2:
+            if not create:
+                return None
+            for key in (model_key, row_key):
+                if key not in tokens:
+                    self.backend.add(key, uuid.uuid4().hex, **self.__timeout_kwargs)
+            tokens = self.backend.get_many([model_key, row_key])
+            if len(tokens) < 2:
+                return None
+        return tokens[model_key], tokens[row_key]
+
+    def __local_token(self, mapped_model):
+        return self.__generations.get(mapped_model, 0)
+
+    def get(self, mapped_model, pk, mask=None):
+        """Get the serialized message of an object or None
+
+        Args:
+        mapped_model - (MappedModel) mapping of the object
+        pk - primary key of the object
+        mask - normalized field mask the message was converted with
+        """
+        if mapped_model not in self.__key_bases:
+            return None
+        key = (mapped_model, pk)
+        if self.backend is None:
+            token = self.__local_token(mapped_model)
+        else:
+            token = self.__backend_token(mapped_model, pk, False)
+            if token is None:
+                self.misses += 1
+                return None
+        with self.__lock:
+            entries = self.__local.get(key)
+        entry = entries.get(mask) if entries is not None else None
+        if entry is not None and entry[0] == token:
+            self.hits += 1
+            return entry[1]
+        data = None
+        if self.backend is not None:
+            data = self.backend.get(self.__data_key(mapped_model, pk, mask, token))
+            if data is not None:
+                self.__put_local(key, mask, token, data)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def set(self, mapped_model, pk, mask, data):
+        """Store the serialized message of an object.  See get
+        """
+        if mapped_model not in self.__key_bases:
+            return
+        if self.backend is None:
+            token = self.__local_token(mapped_model)
+        else:
+            token = self.__backend_token(mapped_model, pk, True)
+            if token is None:
+                return
+            self.backend.set(self.__data_key(mapped_model, pk, mask, token), data,
+                             **self.__timeout_kwargs)
+        self.__put_local((mapped_model, pk), mask, token, data)
+
+    def __data_key(self, mapped_model, pk, mask, token):
+        return '%s:d:%s:%s:%s:%s' % (self.__key_bases[mapped_model], pk,
+                                     token[0], token[1], self.mask_key(mask))
+
+    def __put_local(self, key, mask, token, data):
+        with self.__lock:
+            entries = self.__local.get(key)
+            if entries is None:
+                entries = {}
+                self.__local.put(key, entries)
+            entries[mask] = (token, data)
+
+    def invalidate(self, mapped_model, pk):
+        """Drop the messages of an object
+        """
+        with self.__lock:
+            self.__local.discard((mapped_model, pk))
+        if self.backend is not None and mapped_model in self.__key_bases:
+            self.backend.delete(self.__backend_keys(mapped_model, pk)[1])
+
+    def invalidate_model(self, mapped_model):
+        """Drop the messages of every object of a MappedModel
+        """
+        with self.__lock:
+            self.__generations[mapped_model] = self.__generations.get(mapped_model, 0) + 1
+        if self.backend is not None and mapped_model in self.__key_bases:
+            self.backend.delete(self.__backend_keys(mapped_model, None)[0])
+
+    def clear(self):
+        """Drop every in process entry.  Backend entries are dropped by
+        clearing the backend.
+        """
+        with self.__lock:
+            self.__local.clear()
+
+    def changed(self, dj_type, pk):
+        """Drop the messages of a Django object and of every object whose
+        message may embed it
+        """
+        for registry in self.__registries:
+            mapped_model = registry.for_dj_type(dj_type)
+            if mapped_model is None:
+                continue
+            if pk is None:
+                self.invalidate_model(mapped_model)
+            else:
+                self.invalidate(mapped_model, pk)
+            for parent in self.__embedded_by.get(mapped_model, ()):
+                self.invalidate_model(parent)
+
+    def _object_changed(self, sender, instance, **kwargs):
+        self.changed(sender, instance.pk)
+
+    def _m2m_changed(self, sender, instance, action, reverse, model, pk_set, **kwargs):
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+        self.changed(type(instance), instance.pk)
+        if pk_set is None:
+            # A clear doesn't say which objects were on the other side
+            self.changed(model, None)
+        else:
+            for pk in pk_set:
+                self.changed(model, pk)
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# Copyright (C) 2009  Las Cumbres Observatory <lcogt.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''codegen.py - Generate a python module of straight line conversion
+functions for the models of a mapped module.
+
+The generated <module>_pbandj_conv.py has one djtopb_<Message> and one
+pbtodj_<Message> function per mapped model with the conversion helpers
+inlined where possible.  A Converter uses the generated module in place
+of its compiled plans when the FINGERPRINT in the module matches the
+schema fingerprint of the mapped module.
+
+Fields whose helper isn't a module level function of conversion, or
+whose Django or protocol buffer type isn't one of django.db.models or
+modelish.types, get their converter from the Converter when the module
+is bound.  Only modules with such fields build Converter.helpers.
+'''
+
+import sys
+
+from django.db import models
+
+from modelish import types
+from modelish.pb import field
+from modelish.pb.message import Message
+from modelish.dj.field import ManyToMany
+
+# Increment when the code of generated modules changes so modules
+# generated by an older pbandj are regenerated rather than loaded
+FORMAT_VERSION = 9
+
+# Conversion directions
+DJTOPB = 'djtopb'
+PBTODJ = 'pbtodj'
+
+
+def type_reference(a_type):
+    """Get an expression referencing a Django field class or pbandj pb
+    type from a generated module or None if the type has no stable name
+    """
+    name = getattr(a_type, '__name__', None)
+    if name and getattr(models, name, None) is a_type:
+        return '_models.' + name
+    name = getattr(a_type, 'name', None)
+    if isinstance(name, str) and getattr(types, name, None) is a_type:
+        return '_types.' + name
+    return None
+
+
+class _ModuleWriter(object):
+    """Accumulates the source of a generated conversion module
+    """
+
+    def __init__(self, converter):
+        self.converter = converter
+        self.conversion = sys.modules[type(converter).__module__]
+        self.constants = []
+        self.constant_names = {}
+        self.bindings = []
+        self.functions = []
+        self.exports = []
+
+    def constant(self, value):
+        name = self.constant_names.get(id(value))
+        if name is None:
+            name = self.constant_names[id(value)] = '_ENUM_%d' % len(self.constants)
+            self.constants.append('%s = %r' % (name, value))
+        return name
+
+    def binding(self, msg_name, pb_field_name, direction):
+        """Get the name of the value converter of a field looked up when
+        the module is bound.  Looking it up builds Converter.helpers.
+        """
+        name = '_v%d' % len(self.bindings)
+        self.bindings.append("%s = converter.value_converter('%s', '%s', '%s')" %
+                             (name, msg_name, pb_field_name, direction))
+        return name
+
+    def model_binding(self, msg_name, pb_field_name):
+        """Get the name of the Django model a relation field refers to,
+        looked up when the module is bound
+        """
+        name = '_m%d' % len(self.bindings)
+        self.bindings.append("%s = converter.related_model('%s', '%s')" %
+                             (name, msg_name, pb_field_name))
+        return name
+
+    def helper_call(self, conv, in_type, out_type):
+        """Get a call expression of val for a module level helper function
+        or None if the helper can't be referenced by name
+        """
+        name = getattr(conv, '__name__', None)
+        if not name or getattr(self.conversion, name, None) is not conv:
+            return None
+        in_ref = type_reference(in_type)
+        out_ref = type_reference(out_type)
+        if in_ref is None or out_ref is None:
+            return None
+        return '_conversion.%s(%s, %s, val)' % (name, in_ref, out_ref)
+
+    def value_expression(self, msg_name, infield, outfield, in_type, out_type, direction):
+        """Get an expression converting val between a pair of fields
+        """
+        converter = self.converter
+        conversion = self.conversion
+        helper = converter.helpers[(infield, outfield)]
+        if helper == converter.protocol_buffer_message_to_django_foreign_key_field:
+            return 'pbtodj_related(val)'
+        if helper == converter.django_foreign_key_field_to_protocol_buffer_int32:
+            # val is read from the key column unless it holds a to_field.
+            # See attribute_name
+            if converter.pk_attname(infield):
+                return 'val'
+            return 'val.pk'
+        if helper == converter.django_many_to_many_field_to_protocol_buffer_int32:
+            return 'val.pk'
+        if (helper == converter.protocol_buffer_int32_to_django_foreign_key_field or
+            helper == converter.protocol_buffer_int32_to_django_many_to_many_field):
+            return 'related_object(%s, val)' % self.model_binding(msg_name, infield.name)
+        if helper == converter.django_decimal_field_to_protocol_buffer_sint64:
+            return '_conversion.decimal_to_scaled(val, %d)' % infield.decimal_places
+        if helper == converter.protocol_buffer_sint64_to_django_decimal_field:
+            return '_conversion.scaled_to_decimal(val, %d)' % outfield.decimal_places
+        if (helper == converter.generic_django_field_to_generic_protocol_buffer_field or
+            helper == converter.generic_protocol_buffer_field_to_generic_django_field):
+            conv = converter.helpers.get((in_type, out_type))
+            if conv is None:
+                return 'val'
+            if conv is conversion.truncate_string:
+                max_length = getattr(outfield, 'max_length', None)
+                if max_length:
+                    return 'val[0:%d]' % max_length
+                return 'val'
+            if conv is conversion.char_to_enum:
+                return '%s[str(val)]' % self.constant(out_type.values)
+            if conv is conversion.enum_to_char:
+                return '%s[val]' % self.constant(in_type.values)
+            call = self.helper_call(conv, in_type, out_type)
+            if call is not None:
+                return call
+        # Anything else is resolved by the Converter when the module is
+        # bound.  See binding
+        pb_field = outfield if direction == DJTOPB else infield
+        return '%s(val)' % self.binding(msg_name, pb_field.name, direction)
+
+    def attribute_name(self, dj_field, pb_field):
+        """Get the Django object attribute read for a field.  ForeignKeys
+        mapped to ints read the key column so the object isn't fetched,
+        unless the column holds a to_field rather than the pk.
+        """
+        helper = self.converter.helpers[(dj_field, pb_field)]
+        if helper == self.converter.django_foreign_key_field_to_protocol_buffer_int32:
+            return self.converter.pk_attname(dj_field) or dj_field.name
+        return dj_field.name
+
+    def is_nested(self, dj_field, pb_field):
+        """True if a related object is converted straight into the sub
+        message of a field
+        """
+        converter = self.converter
+        helper = converter.helpers[(dj_field, pb_field)]
+        return (helper == converter.django_foreign_key_field_to_protocol_buffer_message or
+                helper == converter.django_many_to_many_field_to_protocol_buffer_message)
+
+    def relation_lines(self, dj_relation, pb_field):
+        """Get the djtopb lines converting a reverse relation.  The field of
+        the related model pointing back is left out of nested messages.
+        """
+        accessor_name = dj_relation.related_accessor_name
+        is_message = isinstance(pb_field.pb_type, Message)
+        if pb_field.usage != field.REPEATED:
+            lines = ['try:',
+                     '    val = obj.%s' % accessor_name,
+                     'except _ObjectDoesNotExist:',
+                     '    val = None',
+                     'if val is not None:']
+            if is_message:
+                lines.append("    djtopb(val, msg.%s, excludes=('%s',))" % (pb_field.name, dj_relation.name))
+            else:
+                lines.append('    msg.%s = val.pk' % pb_field.name)
+            return lines
+        lines = ['for val in obj.%s.all():' % accessor_name]
+        if is_message:
+            lines.append("    djtopb(val, msg.%s.add(), excludes=('%s',))" % (pb_field.name, dj_relation.name))
+        else:
+            lines.append('    msg.%s.append(val.pk)' % pb_field.name)
+        return lines
+
+    def add_mapped_model(self, mapped_model):
+        msg_name = mapped_model.pbandj_pb_msg.name
+        djtopb_lines = []
+        pbtodj_lines = []
+        for dj_field, pb_field in mapped_model.pb_to_dj_field_map.values():
+            is_message = isinstance(pb_field.pb_type, Message)
+            if pb_field.usage == field.REPEATED:
+                # Only ManyToMany relations have values to convert and
+                # relations can't be set on an unsaved Django object
+                if not isinstance(dj_field, ManyToMany):
+                    continue
+                through = self.converter.through_relation(dj_field, pb_field)
+                if through is not None:
+                    # Rows of the custom through model, which leave out
+                    # the field pointing back at obj
+                    djtopb_lines.append('for val in obj.%s.all():' % through[0])
+                    djtopb_lines.append("    djtopb(val, msg.%s.add(), excludes=('%s',))" %
+                                        (pb_field.name, through[1]))
+                    continue
+                djtopb_lines.append('for val in obj.%s.all():' % dj_field.name)
+                if self.is_nested(dj_field, pb_field):
+                    djtopb_lines.append('    djtopb(val, msg.%s.add())' % pb_field.name)
+                    continue
+                expr = self.value_expression(msg_name, dj_field, pb_field,
+                                             dj_field.dj_type, pb_field.pb_type, DJTOPB)
+                if is_message:
+                    djtopb_lines.append('    msg.%s.add().ParseFromString(%s.SerializeToString())' % (pb_field.name, expr))
+                else:
+                    djtopb_lines.append('    msg.%s.append(%s)' % (pb_field.name, expr))
+                continue
+
+            djtopb_lines.append('val = obj.%s' % self.attribute_name(dj_field, pb_field))
+            djtopb_lines.append('if val is not None and val != "":')
+            if self.is_nested(dj_field, pb_field):
+                djtopb_lines.append('    djtopb(val, msg.%s)' % pb_field.name)
+            else:
+                expr = self.value_expression(msg_name, dj_field, pb_field,
+                                             dj_field.dj_type, pb_field.pb_type, DJTOPB)
+                if is_message:
+                    djtopb_lines.append('    msg.%s.ParseFromString(%s.SerializeToString())' % (pb_field.name, expr))
+                else:
+                    djtopb_lines.append('    msg.%s = %s' % (pb_field.name, expr))
+
+            expr = self.value_expression(msg_name, pb_field, dj_field,
+                                         pb_field.pb_type, dj_field.dj_type, PBTODJ)
+            pbtodj_lines.append("if msg.HasField('%s'):" % pb_field.name)
+            pbtodj_lines.append('    val = msg.%s' % pb_field.name)
+            pbtodj_lines.append("    values['%s'] = %s" % (dj_field.name, expr))
+
+        for name in mapped_model.converted_relations:
+            dj_relation, pb_field = mapped_model.pb_to_dj_relation_map[name]
+            djtopb_lines += self.relation_lines(dj_relation, pb_field)
+
+        function = ['def djtopb_%s(obj, msg):' % msg_name]
+        function += ['    ' + line for line in djtopb_lines or ['pass']]
+        function.append('')
+        function.append('def pbtodj_%s(msg):' % msg_name)
+        function.append('    values = {}')
+        function += ['    ' + line for line in pbtodj_lines]
+        function.append('    return values')
+        self.functions.append(function)
+        self.exports.append("'%s': (djtopb_%s, pbtodj_%s)," % (msg_name, msg_name, msg_name))
+
+    def source(self, mapped_module):
+        out = ['# Generated by pbandj.  DO NOT EDIT!',
+               '# Straight line converters for the mapped module %s' % mapped_module.module_name,
+               '',
+               'from django.core.exceptions import ObjectDoesNotExist as _ObjectDoesNotExist',
+               'from django.db import models as _models',
+               '',
+               'from pbandj import conversion as _conversion',
+               'from pbandj.modelish import types as _types',
+               '',
+               'FORMAT_VERSION = %d' % FORMAT_VERSION,
+               'FINGERPRINT = %r' % mapped_module.schema_fingerprint(),
+               '']
+        out += self.constants
+        out += ['',
+                '',
+                'def bind(converter):',
+                '    """Return {message name: (djtopb, pbtodj)} converting with converter',
+                '    """',
+                '    djtopb = converter.djtopb',
+                '    pbtodj_related = converter.pbtodj_related',
+                '    related_object = converter.related_object']
+        out += ['    ' + line for line in self.bindings]
+        for function in self.functions:
+            out.append('')
+            out += [('    ' + line).rstrip() for line in function]
+        out.append('')
+        out.append('    return {')
+        out += ['        ' + line for line in self.exports]
+        out.append('    }')
+        return '\n'.join(out) + '\n'
+
+
+def conversion_module_source(mapped_module, converter=None):
+    """Get the source of the generated conversion module for a mapped module
+
+    Args:
+    mapped_module - (MappedModule) module to generate converters for
+    converter - (Converter) converter whose helpers are inlined.  A default
+                Converter for the mapped module is used if not supplied.
+    """
+    if converter is None:
+        converter = mapped_module.converter()
+    writer = _ModuleWriter(converter)
+    for mapped_model in mapped_module.mapped_models:
+        writer.add_mapped_model(mapped_model)
+    return writer.source(mapped_module)
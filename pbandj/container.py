@@ -0,0 +1,366 @@
+#!/usr/bin/python
+# Copyright (C) 2009  Las Cumbres Observatory <lcogt.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''container.py - Files of serialized messages indexed by pk.
+
+A container holds the serialized messages of objects with integer pks in
+ascending pk order, grouped into blocks of about block_size bytes.  The
+footer indexes the pk range and offset of every block so ContainerReader
+finds the block of a pk with a binary search of the index and a record
+with a binary search of the pks of the block, without scanning the file.
+
+Layout (integers are little endian)
+  'PBJC' version:B
+  blocks:  flags:B stored size:I raw size:I crc32:I stored data
+  index:   per block first pk:q last pk:q offset:Q stored size:I raw size:I
+           records:I flags:B crc32:I
+  trailer: index offset:Q blocks:I 'PBJI'
+
+The raw data of a block is its number of records:I, their pks:q, the end
+offsets of the records:I and the records one after another.  The stored
+data is the raw data, compressed with zlib when flags has COMPRESSED set.
+The crc32 is of the stored data.
+'''
+
+import bisect
+import mmap
+import struct
+import sys
+import threading
+import zlib
+from array import array
+
+from conversion import LRUCache
+
+MAGIC = 'PBJC'
+INDEX_MAGIC = 'PBJI'
+VERSION = 1
+
+# Block flags
+COMPRESSED = 0x1
+
+# Raw bytes of records per block unless a writer is given a block size
+DEFAULT_BLOCK_SIZE = 16384
+
+HEADER = struct.Struct('<4sB')
+BLOCK_HEADER = struct.Struct('<BIII')
+INDEX_ENTRY = struct.Struct('<qqQIIIBI')
+TRAILER = struct.Struct('<QI4s')
+COUNT = struct.Struct('<I')
+
+
+def _array_typecode(typecodes, itemsize):
+    for typecode in typecodes:
+        try:
+            if array(typecode).itemsize == itemsize:
+                return typecode
+        except ValueError:
+            # 'q' needs Python 3.3
+            pass
+    raise ImportError("No array type of %d byte integers" % itemsize)
+
+# Array types of pks and of the end offsets of records
+PK_TYPECODE = _array_typecode('ql', 8)
+END_TYPECODE = _array_typecode('IL', 4)
+
+
+def _to_little_endian(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _from_little_endian(typecode, data):
+    values = array(typecode)
+    values.fromstring(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+class ContainerWriter(object):
+    """Writes serialized messages with their pks to a container file.  pks
+    must be integers written in ascending order.
+    """
+
+    def __init__(self, fileobj, converter=None, block_size=DEFAULT_BLOCK_SIZE,
+                 compress=True, level=6):
+        '''Create a ContainerWriter
+
+        Args:
+        fileobj - file like object opened for binary writing
+        converter - (Converter) converts the objects of write_queryset
+        block_size - (int) Raw bytes of records per block.  Smaller blocks
+                     make point lookups cheaper and compress worse.
+        compress - (bool) Compress blocks with zlib
+        level - (int) zlib compression level
+        '''
+        self.fileobj = fileobj
+        self.converter = converter
+        self.block_size = block_size
+        self.compress = compress
+        self.level = level
+        self.count = 0
+        self.__index = []
+        self.__pks = array(PK_TYPECODE)
+        self.__ends = array(END_TYPECODE)
+        self.__records = []
+        self.__size = 0
+        self.__last_pk = None
+        self.__finished = False
+        fileobj.write(HEADER.pack(MAGIC, VERSION))
+        self.__offset = HEADER.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # After an error the file is closed without the index, which
+        # readers reject
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.fileobj.close()
+        return False
+
+    def write(self, pk, data):
+        """Add the serialized message of the object with pk
+        """
+        if self.__last_pk is not None and pk <= self.__last_pk:
+            raise Exception("pk %s isn't above the last pk written, %s" % (pk, self.__last_pk))
+        self.__last_pk = pk
+        self.__pks.append(pk)
+        self.__size += len(data)
+        self.__ends.append(self.__size)
+        self.__records.append(data)
+        self.count += 1
+        if self.__size >= self.block_size:
+            self.__write_block()
+
+    def write_message(self, pk, msg):
+        """Add a protocol buffer message of the object with pk
+        """
+        self.write(pk, msg.SerializeToString())
+
+    def write_queryset(self, queryset, chunk_size=1000, excludes=[], mask=None):
+        """Convert and add every object of a QuerySet in pk order.  See
+        Converter.iter_djtopb
+
+        Returns:
+        number of records written
+        """
+        count = self.count
+        queryset = queryset.order_by('pk')
+        if not queryset.query.standard_ordering:
+            # order_by() keeps a reverse()
+            queryset = queryset.reverse()
+        for pk, data in self.converter.iter_djtopb(queryset, chunk_size, excludes,
+                                                   serialize=True, mask=mask, pooled=True,
+                                                   with_pk=True):
+            self.write(pk, data)
+        return self.count - count
+
+    def __write_block(self):
+        pks = self.__pks
+        if not pks:
+            return
+        raw = ''.join([COUNT.pack(len(pks)), _to_little_endian(pks),
+                       _to_little_endian(self.__ends)] + self.__records)
+        flags = 0
+        stored = raw
+        if self.compress:
+            flags |= COMPRESSED
+            stored = zlib.compress(raw, self.level)
+        crc = zlib.crc32(stored) & 0xffffffff
+        self.fileobj.write(BLOCK_HEADER.pack(flags, len(stored), len(raw), crc))
+        self.fileobj.write(stored)
+        self.__index.append(INDEX_ENTRY.pack(pks[0], pks[-1], self.__offset + BLOCK_HEADER.size,
+                                             len(stored), len(raw), len(pks), flags, crc))
+        self.__offset += BLOCK_HEADER.size + len(stored)
+        self.__pks = array(PK_TYPECODE)
+        self.__ends = array(END_TYPECODE)
+        self.__records = []
+        self.__size = 0
+
+    def finish(self):
+        """Write the last block and the index.  Nothing can be added after.
+        """
+        if self.__finished:
+            return
+        self.__write_block()
+        self.fileobj.write(''.join(self.__index))
+        self.fileobj.write(TRAILER.pack(self.__offset, len(self.__index), INDEX_MAGIC))
+        self.fileobj.flush()
+        self.__finished = True
+
+    def close(self):
+        """Finish the container and close the file
+        """
+        self.finish()
+        self.fileobj.close()
+
+
+class ContainerBlock(object):
+    """The pks and records of a block read by ContainerReader
+    """
+
+    def __init__(self, pks, ends, data, start):
+        self.pks = pks
+        self.ends = ends
+        # Records are data[start + end of previous record:start + end]
+        self.data = data
+        self.start = start
+
+    def record(self, i):
+        ends = self.ends
+        return self.data[self.start + (ends[i - 1] if i else 0):self.start + ends[i]]
+
+
+class ContainerReader(object):
+    """Random access to the records of a container file through mmap.
+    Decoded blocks are kept in an LRU so lookups of nearby pks don't
+    decompress their block again.  Readers can be shared by threads.
+    """
+
+    def __init__(self, path, verify=True, cached_blocks=16):
+        '''Open a container
+
+        Args:
+        path - (str) path of the container file
+        verify - (bool) Check the crc32 of each block when it is decoded
+        cached_blocks - (int) Number of decoded blocks kept
+        '''
+        self.verify = verify
+        self.__lock = threading.Lock()
+        self.__blocks = LRUCache(cached_blocks)
+        fileobj = open(path, 'rb')
+        try:
+            self.__mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fileobj.close()
+        mm = self.__mmap
+        if len(mm) < HEADER.size + TRAILER.size or HEADER.unpack_from(mm, 0)[0] != MAGIC:
+            raise Exception("%s isn't a pbandj container" % path)
+        version = HEADER.unpack_from(mm, 0)[1]
+        if version != VERSION:
+            raise Exception("Unsupported container version %s" % version)
+        index_offset, block_count, magic = TRAILER.unpack_from(mm, len(mm) - TRAILER.size)
+        if magic != INDEX_MAGIC:
+            raise Exception("%s has no container index" % path)
+        self.index = [INDEX_ENTRY.unpack_from(mm, index_offset + i * INDEX_ENTRY.size)
+                      for i in range(block_count)]
+        self.first_pks = array(PK_TYPECODE, [entry[0] for entry in self.index])
+
+    def __len__(self):
+        return sum(entry[5] for entry in self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.__mmap.close()
+
+    def block(self, i):
+        """Get the decoded ContainerBlock at position i of the index
+        """
+        with self.__lock:
+            block = self.__blocks.get(i)
+        if block is not None:
+            return block
+        first_pk, last_pk, offset, stored_size, raw_size, count, flags, crc = self.index[i]
+        mm = self.__mmap
+        if flags & COMPRESSED or self.verify:
+            stored = mm[offset:offset + stored_size]
+            if self.verify and zlib.crc32(stored) & 0xffffffff != crc:
+                raise Exception("Checksum mismatch in container block %d" % i)
+        if flags & COMPRESSED:
+            data = zlib.decompress(stored)
+            if len(data) != raw_size:
+                raise Exception("Container block %d has the wrong size" % i)
+            start = 0
+        else:
+            # Records are sliced straight out of the mmap
+            data = mm
+            start = offset
+        pks_start = start + COUNT.size
+        ends_start = pks_start + 8 * count
+        records_start = ends_start + 4 * count
+        block = ContainerBlock(_from_little_endian(PK_TYPECODE, data[pks_start:ends_start]),
+                               _from_little_endian(END_TYPECODE, data[ends_start:records_start]),
+                               data, records_start)
+        with self.__lock:
+            self.__blocks.put(i, block)
+        return block
+
+    def get(self, pk):
+        """Get the serialized message of the object with pk or None
+        """
+        i = bisect.bisect_right(self.first_pks, pk) - 1
+        if i < 0 or pk > self.index[i][1]:
+            return None
+        block = self.block(i)
+        j = bisect.bisect_left(block.pks, pk)
+        if j == len(block.pks) or block.pks[j] != pk:
+            return None
+        return block.record(j)
+
+    def get_message(self, pk, msg_type):
+        """Get the message of the object with pk parsed as msg_type or None
+        """
+        data = self.get(pk)
+        if data is None:
+            return None
+        msg = msg_type()
+        msg.ParseFromString(data)
+        return msg
+
+    def range(self, first_pk=None, last_pk=None):
+        """Generate (pk, serialized message) pairs of the objects with
+        first_pk <= pk <= last_pk in pk order.  None leaves a side open.
+        """
+        if first_pk is None:
+            i = 0
+        else:
+            i = max(bisect.bisect_right(self.first_pks, first_pk) - 1, 0)
+        for i in xrange(i, len(self.index)):
+            if last_pk is not None and self.index[i][0] > last_pk:
+                return
+            block = self.block(i)
+            pks = block.pks
+            j = 0 if first_pk is None else bisect.bisect_left(pks, first_pk)
+            for j in xrange(j, len(pks)):
+                pk = pks[j]
+                if last_pk is not None and pk > last_pk:
+                    return
+                yield pk, block.record(j)
+
+    def __iter__(self):
+        return self.range()
+
+    def objects(self, converter, msg_type, first_pk=None, last_pk=None):
+        """Generate the unsaved Django objects of a pk range.  See
+        Converter.pbtodj
+        """
+        for pk, data in self.range(first_pk, last_pk):
+            msg = msg_type()
+            msg.ParseFromString(data)
+            yield converter.pbtodj(msg)
@@ -23,11 +23,22 @@ Dec 2009
 
 from __future__ import division
 
+import collections
 import decimal
-from datetime import datetime, time
+from datetime import date, datetime, time, timedelta
+import functools
+import inspect
+import itertools
+import operator
+import struct
+import threading
 import traceback
 
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models, transaction
+from django.db.models.query import prefetch_related_objects
+from django.utils import timezone
 
 from modelish import types
 from modelish.pb.enum import Enum
@@ -36,105 +47,639 @@ from modelish.pb import field
 
 from modelish.dj.field import ForeignKey, ManyToMany
 
+import codegen
+import profiling
 
-class Converter(object):
+
+class ConversionRegistry(object):
+    """Index of the MappedModels of a MappedModule by protocol buffer
+    message name, message descriptor and Django model class so that
+    conversions never have to scan the list of mapped models.
+    """
+
+    def __init__(self, mapped_models):
+        '''Create a ConversionRegistry
+
+        Args:
+        mapped_models - (list) MappedModel objects to index.  When two
+                        mapped models share a key the first one wins.
+        '''
+        self.by_msg_name = {}
+        self.by_descriptor = {}
+        self.by_dj_model = {}
+        # Django classes resolved through their MRO (proxies, subclasses
+        # and deferred classes) are cached here, including misses
+        self.__resolved_dj_types = {}
+        for mapped_model in mapped_models:
+            self.by_msg_name.setdefault(mapped_model.pbandj_pb_msg.name, mapped_model)
+            self.by_dj_model.setdefault(mapped_model.dj_model, mapped_model)
+
+    def for_msg_name(self, msg_name):
+        """Get the MappedModel for a protocol buffer message name or None
+        """
+        return self.by_msg_name.get(msg_name)
+
+    def for_message(self, msg):
+        """Get the MappedModel for a protocol buffer message or None.
+        Descriptors are indexed on first use since the pb2 module may not
+        exist yet when the registry is created.
+        """
+        descriptor = msg.DESCRIPTOR
+        try:
+            return self.by_descriptor[descriptor]
+        except KeyError:
+            mapped_model = self.by_msg_name.get(descriptor.name)
+            self.by_descriptor[descriptor] = mapped_model
+            return mapped_model
+
+    def for_dj_type(self, dj_type):
+        """Get the MappedModel for a Django model class or None.  Classes
+        that aren't mapped themselves resolve to the closest mapped class
+        in their MRO.
+        """
+        try:
+            return self.by_dj_model[dj_type]
+        except KeyError:
+            pass
+        try:
+            return self.__resolved_dj_types[dj_type]
+        except KeyError:
+            mapped_model = None
+            for base in dj_type.__mro__[1:]:
+                mapped_model = self.by_dj_model.get(base)
+                if mapped_model is not None:
+                    break
+            self.__resolved_dj_types[dj_type] = mapped_model
+            return mapped_model
+
+
+class LRUCache(object):
+    """A dict like cache holding at most max_size items.  The least
+    recently used item is dropped to make room for a new one.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.__items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __contains__(self, key):
+        return key in self.__items
+
+    def get(self, key, default=None):
+        items = self.__items
+        try:
+            val = items.pop(key)
+        except KeyError:
+            return default
+        items[key] = val
+        return val
+
+    def put(self, key, val):
+        items = self.__items
+        items.pop(key, None)
+        items[key] = val
+        if len(items) > self.max_size:
+            items.popitem(last=False)
+
+    def discard(self, key):
+        self.__items.pop(key, None)
+
+    def clear(self):
+        self.__items.clear()
+
+
+class ConversionSession(object):
+    """Identity map of related objects for a batch of conversions.  While
+    a session is active in a thread, related objects reached through
+    ForeignKey and ManyToMany fields are fetched and converted once per
+    (model, pk) and the Django instance or message is reused after that.
+
+    Ex.
+    with converter.session():
+        msgs = [converter.djtopb(obj) for obj in objs]
+    """
+
+    def __init__(self, converter, max_size=10000):
+        '''Create a ConversionSession
+
+        Args:
+        converter - (Converter) converter the session is used with
+        max_size - (int) Number of Django instances and of messages kept.
+                   The least recently used are dropped beyond that.
+        '''
+        self.converter = converter
+        self.instances = LRUCache(max_size)
+        self.messages = LRUCache(max_size)
+        self.__outer = None
+
+    def __enter__(self):
+        self.__outer = self.converter._set_session(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.converter._set_session(self.__outer)
+        self.__outer = None
+        return False
+
+    def instance(self, dj_model, pk):
+        """Get the Django instance for (dj_model, pk) or None
+        """
+        return self.instances.get((dj_model, pk))
+
+    def add_instance(self, dj_model, pk, obj):
+        self.instances.put((dj_model, pk), obj)
+
+    def message(self, dj_model, pk):
+        """Get the converted message for (dj_model, pk) or None
+        """
+        return self.messages.get((dj_model, pk))
+
+    def add_message(self, dj_model, pk, msg):
+        # Keep a copy since msg belongs to the message it was converted into
+        cached = type(msg)()
+        cached.CopyFrom(msg)
+        self.messages.put((dj_model, pk), cached)
+
+    def clear(self):
+        self.instances.clear()
+        self.messages.clear()
+
+
+# Conversion helpers are called as helper(input_type, output_type, val)
+
+class SaveNode(object):
+    """An object of a message graph saved by Converter.pbtodj_save_many
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+        # (ForeignKey attname, SaveNode) pairs set from the node's pk
+        # once it is saved
+        self.parents = []
+        # (Django ManyToManyField, SaveNode or pk) pairs of through rows
+        self.m2m = []
+        # Another object of the graph needs the pk of this one
+        self.needs_pk = False
+        # The pk is already in the database
+        self.existing = False
+        self.level = None
+
+
+class MessagePool(object):
+    """Free lists of cleared protocol buffer messages per message type.
+    Converter.djtopb_many and iter_djtopb fill messages from the pool
+    rather than creating one per object when called with pooled=True.
+    Threads can share a pool since dict.setdefault, list.pop and
+    list.append are atomic.
+    """
+
+    def __init__(self, max_size=16):
+        '''Create a MessagePool
+
+        Args:
+        max_size - (int) Most free messages kept per message type
+        '''
+        self.max_size = max_size
+        self.__free = {}
+
+    def acquire(self, msg_type):
+        """Get an empty message of msg_type
+        """
+        try:
+            return self.__free[msg_type].pop()
+        except (KeyError, IndexError):
+            return msg_type()
+
+    def release(self, msg):
+        """Clear a message and put it back in the pool.  The message must
+        not be used afterwards.
+        """
+        free = self.__free.setdefault(type(msg), [])
+        if len(free) < self.max_size:
+            msg.Clear()
+            free.append(msg)
+
+    def clear(self):
+        self.__free = {}
+
+
+def normalize_mask(mask):
+    """Get a field mask as a sorted tuple of unique field paths.  A field
+    mask lists the fields to convert by name with the fields of nested
+    messages addressed by dotted paths like 'fkey_test.val'.  Naming a
+    message field converts all of it.
     
-    def __init__(self, mapped_module):
+    Args:
+    mask - (list or str) field paths or None for no mask
+    """
+    if mask is None:
+        return None
+    if isinstance(mask, basestring):
+        mask = [mask]
+    return tuple(sorted(set(mask)))
+
+def mask_tree(mask):
+    """Split a normalized field mask into {field name: sub mask} where the
+    sub mask is None when the whole field is converted
+    """
+    tree = {}
+    for path in mask:
+        name, dot, rest = path.partition('.')
+        if not rest:
+            tree[name] = None
+        elif tree.get(name, ()) is not None:
+            tree.setdefault(name, []).append(rest)
+    return dict((name, sub_mask if sub_mask is None else tuple(sub_mask))
+                for name, sub_mask in tree.items())
+
+def double_to_decimal(input_type, output_type, val):
+    return decimal.Decimal(str(val))
+
+def decimal_to_double(input_type, output_type, val):
+    return float(decimal.Decimal(val))
+
+FLOAT32 = struct.Struct('<f')
+
+def float32_to_float(input_type, output_type, val):
+    """Get the shortest float a 32 bit float field holding val could have
+    been set from.  Messages widen float fields to the nearest double so
+    -1.2345 is read back as -1.2345000505447388.
+    """
+    for digits in (6, 7, 8):
+        shortest = float('%.*g' % (digits, val))
+        try:
+            if FLOAT32.unpack(FLOAT32.pack(shortest))[0] == val:
+                return shortest
+        except OverflowError:
+            break
+    return val
+
+# Decimal values sent as sint64 counts of 10 ** -decimal_places of the
+# Django DecimalField.  See types.DECIMAL_SCALED
+def decimal_to_scaled(val, decimal_places):
+    """Get a Decimal as an int count of 10 ** -decimal_places rounding
+    half to even when it has more places
+    """
+    if not isinstance(val, decimal.Decimal):
+        val = decimal.Decimal(str(val))
+    # The digits of a Decimal are kept as a string so reading them from
+    # str() is cheaper than as_tuple()
+    text = str(val)
+    if not 'E' in text:
+        whole, point, fraction = text.partition('.')
+        shift = decimal_places - len(fraction)
+        if shift >= 0:
+            return int(whole + fraction) * 10 ** shift
+    sign, digits, exponent = val.as_tuple()
+    if not isinstance(exponent, (int, long)):
+        raise ValueError("Can't send %s as a scaled integer" % val)
+    scaled = 0
+    for digit in digits:
+        scaled = scaled * 10 + digit
+    shift = exponent + decimal_places
+    if shift >= 0:
+        scaled *= 10 ** shift
+    else:
+        scaled, remainder = divmod(scaled, 10 ** -shift)
+        half = 5 * 10 ** (-shift - 1)
+        if remainder > half or (remainder == half and scaled % 2):
+            scaled += 1
+    if sign:
+        return -scaled
+    return scaled
+
+def scaled_to_decimal(val, decimal_places):
+    """Get the Decimal for an int count of 10 ** -decimal_places
+    """
+    return decimal.Decimal('%dE%d' % (val, -decimal_places))
+
+# Date and time values are sent as strings in these formats.  The helpers
+# below build them with isoformat and parse them at fixed offsets since
+# strftime/strptime are slow.  Anything else goes through strftime/strptime.
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+DATE_FORMAT = "%Y-%m-%d"
+TIME_FORMAT = "%H:%M:%S.%f"
+
+DIGITS = '0123456789'
+
+def all_digits(text):
+    """True if text is ASCII digits only.  int() also takes signs, spaces
+    and other digits, which strptime rejects.
+    """
+    return not text.strip(DIGITS)
+
+def datetime_to_string(input_type, output_type, val):
+    if type(val) is datetime:
+        # Like strftime the string has no offset for aware values
+        if val.tzinfo is not None:
+            val = val.replace(tzinfo=None)
+        # isoformat leaves off a zero microsecond
+        if val.microsecond:
+            return val.isoformat(' ')
+        return val.isoformat(' ') + '.000000'
+    return val.strftime(DATETIME_FORMAT)
+
+def date_to_string(input_type, output_type, val):
+    if type(val) is date:
+        return val.isoformat()
+    return val.strftime(DATE_FORMAT)
+
+def time_to_string(input_type, output_type, val):
+    if type(val) is time:
+        if val.tzinfo is not None:
+            val = val.replace(tzinfo=None)
+        if val.microsecond:
+            return val.isoformat()
+        return val.isoformat() + '.000000'
+    return val.strftime(TIME_FORMAT)
+
+def string_to_datetime(input_type, output_type, val):
+    if (len(val) == 26 and val[4] == '-' and val[7] == '-' and val[10] == ' ' and
+        val[13] == ':' and val[16] == ':' and val[19] == '.' and
+        all_digits(val[0:4] + val[5:7] + val[8:10] + val[11:13] +
+                   val[14:16] + val[17:19] + val[20:26])):
+        try:
+            return datetime(int(val[0:4]), int(val[5:7]), int(val[8:10]),
+                            int(val[11:13]), int(val[14:16]), int(val[17:19]),
+                            int(val[20:26]))
+        except ValueError:
+            pass
+    return datetime.strptime(val, DATETIME_FORMAT)
+
+def string_to_date(input_type, output_type, val):
+    if (len(val) == 10 and val[4] == '-' and val[7] == '-' and
+        all_digits(val[0:4] + val[5:7] + val[8:10])):
+        try:
+            return date(int(val[0:4]), int(val[5:7]), int(val[8:10]))
+        except ValueError:
+            pass
+    return datetime.strptime(val, DATE_FORMAT).date()
+
+def string_to_time(input_type, output_type, val):
+    if (len(val) == 15 and val[2] == ':' and val[5] == ':' and val[8] == '.' and
+        all_digits(val[0:2] + val[3:5] + val[6:8] + val[9:15])):
+        try:
+            return time(int(val[0:2]), int(val[3:5]), int(val[6:8]), int(val[9:15]))
+        except ValueError:
+            pass
+    return datetime.strptime(val, TIME_FORMAT).time()
+
+# Date and time values sent as sint64 counts.  See types.TEMPORAL_EPOCH
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+def datetime_to_epoch_micros(input_type, output_type, val):
+    if val.tzinfo is not None:
+        val = val.replace(tzinfo=None) - val.utcoffset()
+    delta = val - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def date_to_epoch_days(input_type, output_type, val):
+    return val.toordinal() - EPOCH_ORDINAL
+
+def time_to_micros(input_type, output_type, val):
+    return ((val.hour * 60 + val.minute) * 60 + val.second) * 1000000 + val.microsecond
+
+def epoch_micros_to_datetime(input_type, output_type, val):
+    val = EPOCH + timedelta(microseconds=val)
+    # The count is UTC
+    if settings.USE_TZ:
+        val = val.replace(tzinfo=timezone.utc)
+    return val
+
+def epoch_days_to_date(input_type, output_type, val):
+    return date.fromordinal(val + EPOCH_ORDINAL)
+
+def micros_to_time(input_type, output_type, val):
+    seconds, microsecond = divmod(val, 1000000)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return time(hour, minute, second, microsecond)
+
+def truncate_string(input_type, output_type, val):
+    """Truncate a string to the max_length of a Django CharField.  The
+    CharField class has no max_length so converters pass the mapped field
+    as output_type.  Compiled plans replace this helper with a slice using
+    the max_length of the field.
+    """
+    return val[0:(getattr(output_type, 'max_length', None) or len(val))]
+
+def file_to_string(input_type, output_type, val):
+    return val.name
+
+def enum_to_char(input_type, output_type, val):
+    return input_type[val]
+
+def char_to_enum(input_type, output_type, val):
+    return output_type[str(val)]
+
+
+class Converter(object):
+
+    def __init__(self, mapped_module, compiled=True, max_depth=None, memo=False, profile=None,
+                 cache=None):
+        '''Create a Converter for a MappedModule
+
+        Args:
+        mapped_module - (MappedModule) module defining the mapped models
+        compiled - (bool) Convert using per model plans compiled on first
+                   use rather than dispatching through convert_field for
+                   every field
+        max_depth - (int) Number of levels of related objects djtopb
+                    converts below the top level object.  Deeper objects
+                    only get their pk.  None for no limit.
+        memo - (bool) Only give the pk of a related object that was already
+               converted into the same top level message.  Keeps the
+               conversion of cyclic relations finite.
+        profile - (bool) Record call counts and times of the compiled plans
+                  in self.profiler.  Generated conversion modules aren't
+                  used while profiling.  Defaults to profiling_enabled().
+                  See profiling.ConversionProfiler
+        cache - (MessageCache) cache djtopb reads serialized messages of
+                top level objects from and stores them in.  Conversions
+                with excludes, max_depth or memo don't use the cache.  See
+                cache.MessageCache
+        '''
         self.mapped_module = mapped_module
-        
+        self.registry = ConversionRegistry(mapped_module.mapped_models)
+        self.compiled = compiled
+        self.max_depth = max_depth
+        self.memo = memo
+        # Plans are compiled for bounded conversion so max_depth and memo
+        # can't change later
+        self.__bounded = max_depth is not None or memo
+        self.__msg_types = {}
+        self.__djtopb_plans = {}
+        self.__pbtodj_plans = {}
+        self.__relation_paths = {}
+        self.__reference_plans = {}
+        self.__values_plans = {}
+        self.__update_plans = {}
+        self.__auto_now_fields = {}
+        # Plans and load lookups pruned to a field mask keyed by
+        # (MappedModel, normalized mask)
+        self.__masked_plans = {}
+        self.__mask_lookups = {}
+        # Related objects loaded up front by pbtodj_many for the
+        # current thread keyed by Django model then pk
+        self.__local = threading.local()
+        self.message_pool = MessagePool()
+        self.cache = cache
+        if cache is not None:
+            cache.watch(mapped_module)
+
+        self.__helpers = None
+        # Straight line converters from an ahead of time generated module
+        # keyed by MappedModel
+        self.__aot = {}
+        if profile is None:
+            profile = profiling.profiling_enabled()
+        # None unless profiling so unprofiled plans have no instrumentation
+        self.profiler = profiling.ConversionProfiler() if profile else None
+        if self.profiler is None:
+            self.__load_aot_module()
+
+    @property
+    def helpers(self):
+        """Conversion helpers keyed by (input type, output type).  The table
+        is built on first use so a Converter running entirely from a
+        generated conversion module never builds it.
+        """
+        if self.__helpers is None:
+            self.__helpers = self.__build_helpers()
+        return self.__helpers
+
+    def __build_helpers(self):
         #TODO: Change django type portion of key to type rather than string
         conv_helpers = {}
         
         #Django seems to require float values input as a string
         conv_helpers[(types.PB_TYPE_DOUBLE,
-                       models.DecimalField)] = lambda input_type, output_type, val : decimal.Decimal(str(val))
+                       models.DecimalField)] = double_to_decimal
         
         #Convert Decimal back to a python float which is the same as a double
         #in protocol buffers apparently
         conv_helpers[(models.DecimalField,
-                     types.PB_TYPE_DOUBLE)] = lambda input_type, output_type, val : float(decimal.Decimal(val))
+                     types.PB_TYPE_DOUBLE)] = decimal_to_double
+        
+        #Give Django FloatFields the value a 32 bit float field was set from
+        conv_helpers[(types.PB_TYPE_FLOAT,
+                      models.FloatField)] = float32_to_float
         
         #Help convert a Django DateTimeField into a consistent string format
         #for transport
         conv_helpers[(models.DateTimeField,
-                      types.PB_TYPE_STRING)] = lambda input_type, output_type, val : val.strftime("%Y-%m-%d %H:%M:%S.%f")# + "." + str(val.microsecond / 1000000)
+                      types.PB_TYPE_STRING)] = datetime_to_string
         
         #Help convert a Django DateField into a consistent string format for transport
         conv_helpers[(models.DateField,
-                      types.PB_TYPE_STRING)] = lambda input_type, output_type, val : val.strftime("%Y-%m-%d")
+                      types.PB_TYPE_STRING)] = date_to_string
                       
         #Help convert a Django TimeField into a consistent string format for transport
         conv_helpers[(models.TimeField,
-                      types.PB_TYPE_STRING)] = lambda input_type, output_type, val : val.strftime("%H:%M:%S.%f")# + "." + str(val.microsecond / 1000000)
+                      types.PB_TYPE_STRING)] = time_to_string
         
         #Help convert a string into a Django DateTimeField
         conv_helpers[(types.PB_TYPE_STRING,
-                      models.DateTimeField)] = \
-                          lambda input_type, output_type, val : datetime.strptime(val, "%Y-%m-%d %H:%M:%S.%f")
+                      models.DateTimeField)] = string_to_datetime
         
         #Help convert a string into a  Django DateField
         conv_helpers[(types.PB_TYPE_STRING,
-                      models.DateField)] = \
-                          lambda input_type, output_type, val : datetime.strptime(val, "%Y-%m-%d").date()
+                      models.DateField)] = string_to_date
                           
         #Help convert a string into a Django DateTimeField
         conv_helpers[(types.PB_TYPE_STRING,
-                      models.TimeField)] = \
-                          lambda input_type, output_type, val : datetime.strptime(val, "%H:%M:%S.%f").time()
+                      models.TimeField)] = string_to_time
+        
+        #Send Django DateTimeField, DateField and TimeField values as counts
+        #of microseconds or days for types.TEMPORAL_EPOCH
+        conv_helpers[(models.DateTimeField,
+                      types.PB_TYPE_SINT64)] = datetime_to_epoch_micros
+        conv_helpers[(models.DateField,
+                      types.PB_TYPE_SINT64)] = date_to_epoch_days
+        conv_helpers[(models.TimeField,
+                      types.PB_TYPE_SINT64)] = time_to_micros
+        conv_helpers[(types.PB_TYPE_SINT64,
+                      models.DateTimeField)] = epoch_micros_to_datetime
+        conv_helpers[(types.PB_TYPE_SINT64,
+                      models.DateField)] = epoch_days_to_date
+        conv_helpers[(types.PB_TYPE_SINT64,
+                      models.TimeField)] = micros_to_time
         
         #Help convert a string into a  Django CharField by truncating input that is too long.
         conv_helpers[(types.PB_TYPE_STRING,
-                      models.CharField)] = \
-                          lambda input_type, output_type, val : val[0:(output_type.max_length if hasattr(output_type, 'max_length') else len(val))]
+                      models.CharField)] = truncate_string
 
         conv_helpers[(models.FileField,
-                      types.PB_TYPE_STRING)] = \
-                          lambda input_type, output_type, val : val.name
+                      types.PB_TYPE_STRING)] = file_to_string
                           
         conv_helpers[(models.ImageField,
-                      types.PB_TYPE_STRING)] = \
-                          lambda input_type, output_type, val : val.name
+                      types.PB_TYPE_STRING)] = file_to_string
                           
-        conv_helpers[(Enum, models.CharField)] = \
-                          lambda input_type, output_type, val: input_type[val]
-        
-        conv_helpers[(models.CharField, Enum)] = \
-                          lambda input_type, output_type, val: output_type[val]
-
-        self.helpers = conv_helpers
-        
-        self.conversion_methods = {}
+        conv_helpers[(Enum, models.CharField)] = enum_to_char
         
+        conv_helpers[(models.CharField, Enum)] = char_to_enum
         
         for mapped_model in self.mapped_module.mapped_models:
             for pbandj_dj_field, pbandj_pb_field in mapped_model.pb_to_dj_field_map.values():
                 # Add converter to ManyToMany fields mapped to messages
                 if isinstance(pbandj_dj_field, ManyToMany) and isinstance(pbandj_pb_field.pb_type, Message):
-                    self.helpers[(pbandj_dj_field, pbandj_pb_field)] = self.django_many_to_many_field_to_protocol_buffer_message
-                    self.helpers[(pbandj_pb_field, pbandj_dj_field)] = self.protocol_buffer_message_to_django_many_to_many_field
+                    conv_helpers[(pbandj_dj_field, pbandj_pb_field)] = self.django_many_to_many_field_to_protocol_buffer_message
+                    conv_helpers[(pbandj_pb_field, pbandj_dj_field)] = self.protocol_buffer_message_to_django_many_to_many_field
                 # Add converter to ManyToMany fields mapped to fields
                 elif isinstance(pbandj_dj_field, ManyToMany) and isinstance(pbandj_pb_field, field.Field):
-                    self.helpers[(pbandj_dj_field, pbandj_pb_field)] = self.django_many_to_many_field_to_protocol_buffer_int32
-                    self.helpers[(pbandj_pb_field, pbandj_dj_field)] = self.protocol_buffer_int32_to_django_many_to_many_field
+                    conv_helpers[(pbandj_dj_field, pbandj_pb_field)] = self.django_many_to_many_field_to_protocol_buffer_int32
+                    conv_helpers[(pbandj_pb_field, pbandj_dj_field)] = self.protocol_buffer_int32_to_django_many_to_many_field
                 # Add converter to ForeignKey fields mapped to messages
                 elif isinstance(pbandj_dj_field, ForeignKey) and isinstance(pbandj_pb_field.pb_type, Message):
-                    self.helpers[(pbandj_dj_field, pbandj_pb_field)] = self.django_foreign_key_field_to_protocol_buffer_message
-                    self.helpers[(pbandj_pb_field, pbandj_dj_field)] = self.protocol_buffer_message_to_django_foreign_key_field
+                    conv_helpers[(pbandj_dj_field, pbandj_pb_field)] = self.django_foreign_key_field_to_protocol_buffer_message
+                    conv_helpers[(pbandj_pb_field, pbandj_dj_field)] = self.protocol_buffer_message_to_django_foreign_key_field
                 # Add converter to ForeignKey fields mapped to fields    
                 elif isinstance(pbandj_dj_field, ForeignKey) and isinstance(pbandj_pb_field, field.Field):
-                    self.helpers[(pbandj_dj_field, pbandj_pb_field)] = self.django_foreign_key_field_to_protocol_buffer_int32
-                    self.helpers[(pbandj_pb_field, pbandj_dj_field)] = self.protocol_buffer_int32_to_django_foreign_key_field
+                    conv_helpers[(pbandj_dj_field, pbandj_pb_field)] = self.django_foreign_key_field_to_protocol_buffer_int32
+                    conv_helpers[(pbandj_pb_field, pbandj_dj_field)] = self.protocol_buffer_int32_to_django_foreign_key_field
+                # Add converter to DecimalFields sent as scaled integers
+                elif (pbandj_dj_field.dj_type is models.DecimalField and
+                      pbandj_pb_field.pb_type == types.PB_TYPE_SINT64):
+                    conv_helpers[(pbandj_dj_field, pbandj_pb_field)] = self.django_decimal_field_to_protocol_buffer_sint64
+                    conv_helpers[(pbandj_pb_field, pbandj_dj_field)] = self.protocol_buffer_sint64_to_django_decimal_field
                 else:
-                    self.helpers[(pbandj_dj_field, pbandj_pb_field)] = self.generic_django_field_to_generic_protocol_buffer_field
-                    self.helpers[(pbandj_pb_field, pbandj_dj_field)] = self.generic_protocol_buffer_field_to_generic_django_field
+                    conv_helpers[(pbandj_dj_field, pbandj_pb_field)] = self.generic_django_field_to_generic_protocol_buffer_field
+                    conv_helpers[(pbandj_pb_field, pbandj_dj_field)] = self.generic_protocol_buffer_field_to_generic_django_field
             
             # Add converter for each enumerated type
             enums = mapped_model.pbandj_pb_msg.enums
             for enum in enums:
                 # Django -> Protocol Buffer
-                self.helpers[(models.CharField, enum)] = lambda input_type, output_type, val : output_type[str(val)]
+                conv_helpers[(models.CharField, enum)] = char_to_enum
                 # Protocol Buffer -> Django
-                self.helpers[(enum, models.CharField)] =  lambda input_type, output_type, val : input_type[val]
+                conv_helpers[(enum, models.CharField)] = enum_to_char
+        return conv_helpers
+
+    def __load_aot_module(self):
+        """Use the generated conversion module of the mapped module if there
+        is one and it was generated from the current schema
+        """
+        conv_mod = self.mapped_module.load_conv()
+        if conv_mod is None:
+            return
+        if (getattr(conv_mod, 'FORMAT_VERSION', None) != codegen.FORMAT_VERSION or
+            getattr(conv_mod, 'FINGERPRINT', None) != self.mapped_module.schema_fingerprint()):
+            print "Ignoring out of date conversion module", conv_mod.__name__
+            return
+        for msg_name, functions in conv_mod.bind(self).items():
+            mapped_model = self.registry.for_msg_name(msg_name)
+            if mapped_model is not None:
+                self.__aot[mapped_model] = functions
+
+    @property
+    def uses_aot_module(self):
+        """True if conversions run through a generated conversion module
+        """
+        return bool(self.__aot)
                 
     
     def generic_django_field_to_generic_protocol_buffer_field(self, infield, outfield, val):
@@ -144,32 +689,155 @@ class Converter(object):
     
     def generic_protocol_buffer_field_to_generic_django_field(self, infield, outfield, val):
         helper = self.helpers.get((infield.pb_type, outfield.dj_type), lambda val, input_type, output_type : val)
+        if helper is truncate_string:
+            return truncate_string(infield.pb_type, outfield, val)
         result = helper(input_type=infield.pb_type, output_type=outfield.dj_type, val=val)
         return result
     
+    def django_decimal_field_to_protocol_buffer_sint64(self, infield, outfield, val):
+        return decimal_to_scaled(val, infield.decimal_places)
+    
+    def protocol_buffer_sint64_to_django_decimal_field(self, infield, outfield, val):
+        return scaled_to_decimal(val, outfield.decimal_places)
+    
     def django_many_to_many_field_to_protocol_buffer_message(self, infield, outfield, val):
-        return self.djtopb(val)
+        return self.djtopb_related(val)
     
     def protocol_buffer_message_to_django_many_to_many_field(self, infield, outfield, val):
-        return self.pbtodj(val)
+        return self.pbtodj_related(val)
     
     def django_many_to_many_field_to_protocol_buffer_int32(self, infield, outfield, val):
         return val.pk
     
     def protocol_buffer_int32_to_django_many_to_many_field(self, infield, outfield, val):
-        return outfield.related_model.objects.get(pk=val)
+        return self.related_object(outfield.related_dj_model, val)
     
     def django_foreign_key_field_to_protocol_buffer_message(self, infield, outfield, val):
-        return self.djtopb(val)
+        return self.djtopb_related(val)
     
     def protocol_buffer_message_to_django_foreign_key_field(self, infield, outfield, val):
-        return self.pbtodj(val)
+        return self.pbtodj_related(val)
     
     def django_foreign_key_field_to_protocol_buffer_int32(self, infield, outfield, val):
         return val.pk
     
     def protocol_buffer_int32_to_django_foreign_key_field(self, infield, outfield, val):
-        return outfield.related_model.objects.get(pk=val)
+        return self.related_object(outfield.related_dj_model, val)
+    
+    def pk_attname(self, dj_field):
+        """Get the attname of the key column of a ForeignKey if the column
+        holds the pk of the related object or None.  The column of a
+        ForeignKey with a to_field holds the value of that field.
+        """
+        if not isinstance(dj_field, ForeignKey) or dj_field.child_dj_model is None:
+            return None
+        model_field = dj_field.child_dj_model._meta.get_field(dj_field.name)
+        if model_field.rel.field_name != model_field.rel.to._meta.pk.name:
+            return None
+        return model_field.attname
+    
+    def related_model(self, msg_name, pb_field_name):
+        """Get the Django model a relation field of a mapped message
+        refers to
+        """
+        mapped_model = self.registry.for_msg_name(msg_name)
+        return mapped_model.pb_to_dj_field_map[pb_field_name][0].related_dj_model
+    
+    def related_object(self, dj_model, val):
+        """Get the Django object of dj_model with pk val for a relation
+        field holding a pk.  Objects loaded by pbtodj_many are used before
+        querying.
+        """
+        session = getattr(self.__local, 'session', None)
+        if session is not None:
+            obj = session.instance(dj_model, val)
+            if obj is not None:
+                return obj
+        obj = None
+        resolved = getattr(self.__local, 'resolved', None)
+        if resolved is not None:
+            obj = resolved.get(dj_model, {}).get(val)
+        if obj is None:
+            obj = dj_model._default_manager.get(pk=val)
+        if session is not None:
+            session.add_instance(dj_model, val, obj)
+        return obj
+
+    def pbtodj_related(self, msg):
+        """pbtodj for a message nested in a relation field.  Inside a
+        ConversionSession a message with the pk of an object converted
+        earlier gives back that object.
+        """
+        session = getattr(self.__local, 'session', None)
+        if session is None:
+            return self.pbtodj(msg)
+        mapped_model = self.registry.for_message(msg)
+        if mapped_model == None:
+            return self.pbtodj(msg)
+        dj_model = mapped_model.dj_model
+        pk_name = dj_model._meta.pk.name
+        if (not pk_name in mapped_model.pb_to_dj_field_map or
+            not msg.HasField(pk_name)):
+            return self.pbtodj(msg)
+        pk = getattr(msg, pk_name)
+        obj = session.instance(dj_model, pk)
+        if obj is None:
+            obj = self.pbtodj(msg)
+            session.add_instance(dj_model, pk, obj)
+        return obj
+
+    def djtopb_related(self, obj, dest_obj=None, excludes=[], mask=None):
+        """djtopb for an object nested in a relation field.  Objects below
+        max_depth or already converted into the same top level message
+        with memo on only get their pk.
+        """
+        local = self.__local
+        depth = getattr(local, 'depth', None)
+        if depth is None:
+            return self.djtopb(obj, dest_obj, excludes, mask)
+        mapped_model = self.registry.for_dj_type(type(obj))
+        if mapped_model is not None:
+            if ((self.max_depth is not None and depth >= self.max_depth) or
+                (self.memo and (mapped_model, obj.pk) in local.emitted)):
+                return self.djtopb_reference(obj, dest_obj)
+        local.depth = depth + 1
+        try:
+            return self.djtopb(obj, dest_obj, excludes, mask)
+        finally:
+            local.depth = depth
+
+    def djtopb_reference(self, obj, dest_obj=None):
+        """Get a message holding only the pk of a Django object
+        """
+        mapped_model = self.registry.for_dj_type(type(obj))
+        if mapped_model == None:
+            raise Exception("No mapping available for django type %s." % type(obj))
+        if dest_obj is None:
+            dest_obj = self.message_type(mapped_model)()
+        pk_name = mapped_model.dj_model._meta.pk.name
+        if pk_name in mapped_model.pb_to_dj_field_map and obj.pk is not None:
+            setattr(dest_obj, pk_name, obj.pk)
+        return dest_obj
+
+    def session(self, max_size=10000):
+        """Get a new ConversionSession for this converter.
+        See ConversionSession
+        """
+        return ConversionSession(self, max_size)
+
+    @property
+    def current_session(self):
+        """The ConversionSession active in this thread or None
+        """
+        return getattr(self.__local, 'session', None)
+
+    def _set_session(self, session):
+        """Make session the active session of this thread and return the
+        session it replaces
+        """
+        outer = getattr(self.__local, 'session', None)
+        self.__local.session = session
+        return outer
     
     def django_char_field_to_protocol_buffer_enum(self, infield, outfield, val):
         return outfield[str(val)]
@@ -182,6 +850,14 @@ class Converter(object):
            helper by keyword will be input_type and output_type
         '''
         self.helpers[(input_type, output_type)] = helper
+        # Plans and generated converters have helpers baked in so compile
+        # plans again and stop using the generated converters
+        self.__djtopb_plans.clear()
+        self.__pbtodj_plans.clear()
+        self.__values_plans.clear()
+        self.__update_plans.clear()
+        self.__masked_plans.clear()
+        self.__aot.clear()
         
     def convert_field(self, infield, outfield, val, **kwargs):
         '''Convert the input object to the output type and return an object of
@@ -195,6 +871,384 @@ class Converter(object):
 #        print "returning", type(result), result 
         return result
 
+    def message_type(self, mapped_model):
+        """Get the generated protocol buffer message class for a mapped model
+        """
+        try:
+            return self.__msg_types[mapped_model]
+        except KeyError:
+            msg_type = getattr(self.mapped_module.load_pb2(), mapped_model.pbandj_pb_msg.name)
+            self.__msg_types[mapped_model] = msg_type
+            return msg_type
+
+    def djtopb_plan(self, mapped_model):
+        """Get the compiled Django -> protocol buffer plan for a mapped model.
+        The plan is a tuple of (dj field name, step) pairs where calling
+        step(dj_obj, pb_msg) copies one field.
+        """
+        try:
+            return self.__djtopb_plans[mapped_model]
+        except KeyError:
+            plan = self.compile_djtopb_plan(mapped_model)
+            self.__djtopb_plans[mapped_model] = plan
+            return plan
+
+    def pbtodj_plan(self, mapped_model):
+        """Get the compiled protocol buffer -> Django plan for a mapped model.
+        The plan is a dict of pb field name to a (dj field name, convert)
+        pair where convert(val) returns the Django value or convert is None
+        if the value is used as is.
+        """
+        try:
+            return self.__pbtodj_plans[mapped_model]
+        except KeyError:
+            plan = self.compile_pbtodj_plan(mapped_model)
+            self.__pbtodj_plans[mapped_model] = plan
+            return plan
+
+    def compile_djtopb_plan(self, mapped_model):
+        """Resolve the helper, attribute access and field handling for each
+        field of a mapped model once and return them as a plan.
+        See djtopb_plan
+        """
+        plan = []
+        for dj_field, pb_field in mapped_model.pb_to_dj_field_map.values():
+            step = self._djtopb_step(dj_field, pb_field)
+            if step is not None:
+                plan.append((dj_field.name, self._profiled_step(mapped_model, pb_field, step)))
+        relations = mapped_model.pb_to_dj_relation_map
+        for name in mapped_model.converted_relations:
+            dj_relation, pb_field = relations[name]
+            step = self._djtopb_relation_step(dj_relation, pb_field)
+            plan.append((name, self._profiled_step(mapped_model, pb_field, step)))
+        return tuple(plan)
+
+    def _profiled_step(self, mapped_model, pb_field, step):
+        """Wrap a djtopb plan step with the profiler if profiling
+        """
+        if self.profiler is None:
+            return step
+        return self.profiler.wrap_step(mapped_model.pbandj_pb_msg.name, pb_field.name,
+                                       profiling.DJTOPB, step)
+
+    def compile_pbtodj_plan(self, mapped_model):
+        """Resolve the helper and attribute access for each field of a mapped
+        model once and return them as a plan.  See pbtodj_plan
+        """
+        plan = {}
+        for dj_field, pb_field in mapped_model.pb_to_dj_field_map.values():
+            # Repeated fields are relations which can't be set on an
+            # unsaved Django object
+            if pb_field.usage != field.REPEATED:
+                convert = self._value_converter(pb_field, dj_field, pb_field.pb_type, dj_field.dj_type)
+                if self.profiler is not None:
+                    convert = self.profiler.wrap_value(mapped_model.pbandj_pb_msg.name, pb_field.name,
+                                                       profiling.PBTODJ, convert)
+                plan[pb_field.name] = (dj_field.name, convert)
+        return plan
+
+    def value_converter(self, msg_name, pb_field_name, direction):
+        """Get the value converter a compiled plan uses for a field.
+        Returns a function of one value or None if values pass through
+        unchanged.
+        
+        Args:
+        msg_name - (str) Name of a mapped protocol buffer message
+        pb_field_name - (str) Name of a mapped field in the message
+        direction - (str) codegen.DJTOPB or codegen.PBTODJ
+        """
+        mapped_model = self.registry.for_msg_name(msg_name)
+        dj_field, pb_field = mapped_model.pb_to_dj_field_map[pb_field_name]
+        if direction == codegen.DJTOPB:
+            return self._value_converter(dj_field, pb_field, dj_field.dj_type, pb_field.pb_type)
+        return self._value_converter(pb_field, dj_field, pb_field.pb_type, dj_field.dj_type)
+
+    def _value_converter(self, infield, outfield, in_type, out_type):
+        """Get a function of one value doing what convert_field would do
+        for the field pair or None if values pass through unchanged
+        """
+        convert = self._find_value_converter(infield, outfield, in_type, out_type)
+        if convert is None or self.profiler is None:
+            return convert
+        helper = self.helpers[(infield, outfield)]
+        if (helper == self.generic_django_field_to_generic_protocol_buffer_field or
+            helper == self.generic_protocol_buffer_field_to_generic_django_field):
+            helper = self.helpers.get((in_type, out_type))
+        return self.profiler.wrap_helper(getattr(helper, '__name__', repr(helper)), convert)
+
+    def _find_value_converter(self, infield, outfield, in_type, out_type):
+        helper = self.helpers[(infield, outfield)]
+        if (helper != self.generic_django_field_to_generic_protocol_buffer_field and
+            helper != self.generic_protocol_buffer_field_to_generic_django_field):
+            return functools.partial(helper, infield, outfield)
+        conv = self.helpers.get((in_type, out_type))
+        if conv is None:
+            return None
+        if conv is truncate_string:
+            max_length = getattr(outfield, 'max_length', None)
+            if max_length:
+                return lambda val: val[0:max_length]
+            return None
+        # Helpers are documented as taking keyword args but binding the
+        # types positionally is much cheaper when the signature allows it
+        try:
+            positional = inspect.getargspec(conv).args[:3] == ['input_type', 'output_type', 'val']
+        except TypeError:
+            positional = False
+        if positional:
+            return functools.partial(conv, in_type, out_type)
+        return lambda val: conv(input_type=in_type, output_type=out_type, val=val)
+
+    def through_relation(self, dj_field, pb_field):
+        """Get the (accessor name, source field name) of the rows of the
+        through model of a ManyToMany mapped to messages of its custom
+        through model, or None for any other field.  The accessor on the
+        model holding the ManyToMany gets its through rows and the source
+        field of the through model points back at that model.
+        """
+        if (not isinstance(dj_field, ManyToMany) or
+            dj_field.related_through_model is None or dj_field.child_dj_model is None or
+            not isinstance(pb_field.pb_type, Message)):
+            return None
+        m2m_field = dj_field.child_dj_model._meta.get_field(dj_field.name)
+        source = m2m_field.m2m_field_name()
+        accessor = m2m_field.rel.through._meta.get_field(source).related.get_accessor_name()
+        return accessor, source
+
+    def _through_step(self, pb_field, through, mask=None):
+        """Build the step converting the through rows of a ManyToMany with
+        a custom through model.  See through_relation
+        """
+        accessor, source = through
+        get_rows = operator.attrgetter(accessor)
+        pb_name = pb_field.name
+        back_field = (source,)
+        djtopb = self.djtopb_related if self.__bounded else self.djtopb
+        def step(obj, msg):
+            rep_field = getattr(msg, pb_name)
+            for val in get_rows(obj).all():
+                djtopb(val, rep_field.add(), excludes=back_field, mask=mask)
+        return step
+
+    def _djtopb_step(self, dj_field, pb_field):
+        """Build the step copying one field of a Django object to a message
+        """
+        through = self.through_relation(dj_field, pb_field)
+        if through is not None:
+            return self._through_step(pb_field, through)
+        get_val = operator.attrgetter(dj_field.name)
+        pb_name = pb_field.name
+        convert = self._value_converter(dj_field, pb_field, dj_field.dj_type, pb_field.pb_type)
+        is_message = isinstance(pb_field.pb_type, Message)
+        helper = self.helpers[(dj_field, pb_field)]
+        pk_attname = self.pk_attname(dj_field)
+        if helper == self.django_foreign_key_field_to_protocol_buffer_int32 and pk_attname:
+            # The key column already holds the pk so don't fetch the object
+            get_val = operator.attrgetter(pk_attname)
+            convert = None
+        # Related objects are converted straight into the sub message
+        # rather than into a new message that has to be copied over
+        nested = (helper == self.django_foreign_key_field_to_protocol_buffer_message or
+                  helper == self.django_many_to_many_field_to_protocol_buffer_message)
+        djtopb = self.djtopb
+        local = self.__local
+        # Messages cut short by bounded conversion can't be shared
+        # through the session identity map
+        bounded = self.__bounded
+        if bounded:
+            djtopb = self.djtopb_related
+
+        if pb_field.usage == field.REPEATED:
+            # Only ManyToMany relations have values to convert
+            if not isinstance(dj_field, ManyToMany):
+                return None
+            if nested:
+                def step(obj, msg):
+                    rep_field = getattr(msg, pb_name)
+                    session = getattr(local, 'session', None)
+                    if session is None or bounded:
+                        for val in get_val(obj).all():
+                            djtopb(val, rep_field.add())
+                        return
+                    for val in get_val(obj).all():
+                        dest = rep_field.add()
+                        cached = session.message(type(val), val.pk)
+                        if cached is None:
+                            djtopb(val, dest)
+                            session.add_message(type(val), val.pk, dest)
+                        else:
+                            dest.CopyFrom(cached)
+            elif is_message:
+                def step(obj, msg):
+                    rep_field = getattr(msg, pb_name)
+                    for val in get_val(obj).all():
+                        rep_field.add().ParseFromString(convert(val).SerializeToString())
+            else:
+                def step(obj, msg):
+                    rep_field = getattr(msg, pb_name)
+                    for val in get_val(obj).all():
+                        rep_field.append(convert(val))
+        elif nested:
+            get_pk = operator.attrgetter(pk_attname) if pk_attname else None
+            related_dj_model = dj_field.related_dj_model
+            def step(obj, msg):
+                session = getattr(local, 'session', None)
+                if session is None or bounded or get_pk is None:
+                    val = get_val(obj)
+                    if val is not None and val != "":
+                        djtopb(val, getattr(msg, pb_name))
+                    return
+                # Look the related object up by key before fetching it
+                pk = get_pk(obj)
+                if pk is None:
+                    return
+                cached = session.message(related_dj_model, pk)
+                if cached is not None:
+                    getattr(msg, pb_name).CopyFrom(cached)
+                    return
+                val = get_val(obj)
+                if val is not None and val != "":
+                    dest = getattr(msg, pb_name)
+                    djtopb(val, dest)
+                    session.add_message(related_dj_model, pk, dest)
+        elif is_message:
+            def step(obj, msg):
+                val = get_val(obj)
+                if val is not None and val != "":
+                    getattr(msg, pb_name).ParseFromString(convert(val).SerializeToString())
+        elif convert is None:
+            def step(obj, msg):
+                val = get_val(obj)
+                if val is not None and val != "":
+                    setattr(msg, pb_name, val)
+        else:
+            def step(obj, msg):
+                val = get_val(obj)
+                if val is not None and val != "":
+                    setattr(msg, pb_name, convert(val))
+        return step
+
+    def _djtopb_relation_step(self, dj_relation, pb_field):
+        """Build the step converting the objects of a reverse relation.
+        dj_relation is the ForeignKey, OneToOne or ManyToMany field of the
+        related model, which is left out of the related messages so they
+        don't point back at the message being converted.
+        """
+        accessor_name = dj_relation.related_accessor_name
+        if accessor_name is None:
+            raise Exception("No reverse accessor recorded for relation %s.  Regenerate the mapped module" %
+                            pb_field.name)
+        get_related = operator.attrgetter(accessor_name)
+        pb_name = pb_field.name
+        back_field = (dj_relation.name,)
+        is_message = isinstance(pb_field.pb_type, Message)
+        djtopb = self.djtopb_related if self.__bounded else self.djtopb
+        if pb_field.usage != field.REPEATED:
+            # Reverse OneToOne.  A missing related object raises rather
+            # than returning None
+            def step(obj, msg):
+                try:
+                    val = get_related(obj)
+                except ObjectDoesNotExist:
+                    return
+                if is_message:
+                    djtopb(val, getattr(msg, pb_name), excludes=back_field)
+                else:
+                    setattr(msg, pb_name, val.pk)
+        elif is_message:
+            def step(obj, msg):
+                rep_field = getattr(msg, pb_name)
+                for val in get_related(obj).all():
+                    djtopb(val, rep_field.add(), excludes=back_field)
+        else:
+            def step(obj, msg):
+                rep_field = getattr(msg, pb_name)
+                for val in get_related(obj).all():
+                    rep_field.append(val.pk)
+        return step
+
+    def masked_djtopb_plan(self, mapped_model, mask):
+        """Get the djtopb plan of a mapped model pruned to the fields of a
+        normalized field mask.  See djtopb_plan and normalize_mask.
+        """
+        try:
+            return self.__masked_plans[(mapped_model, mask)]
+        except KeyError:
+            pass
+        fields = mapped_model.pb_to_dj_field_map
+        plan = []
+        for name, sub_mask in sorted(mask_tree(mask).items()):
+            if name in mapped_model.converted_relations and sub_mask is None:
+                dj_relation, pb_field = mapped_model.pb_to_dj_relation_map[name]
+                step = self._djtopb_relation_step(dj_relation, pb_field)
+                plan.append((name, self._profiled_step(mapped_model, pb_field, step)))
+                continue
+            if not name in fields:
+                raise Exception("No field %s in message %s" % (name, mapped_model.pbandj_pb_msg.name))
+            dj_field, pb_field = fields[name]
+            if sub_mask is None:
+                step = self._djtopb_step(dj_field, pb_field)
+            else:
+                step = self._masked_djtopb_step(dj_field, pb_field, sub_mask)
+            if step is not None:
+                plan.append((dj_field.name, self._profiled_step(mapped_model, pb_field, step)))
+        plan = tuple(plan)
+        self.__masked_plans[(mapped_model, mask)] = plan
+        return plan
+
+    def _masked_djtopb_step(self, dj_field, pb_field, sub_mask):
+        """Build the step converting the masked fields of the related
+        objects of a relation into its sub messages
+        """
+        helper = self.helpers[(dj_field, pb_field)]
+        if (helper != self.django_foreign_key_field_to_protocol_buffer_message and
+            helper != self.django_many_to_many_field_to_protocol_buffer_message):
+            raise Exception("Field %s isn't a message so %s can't be masked" %
+                            (pb_field.name, ', '.join(sub_mask)))
+        through = self.through_relation(dj_field, pb_field)
+        if through is not None:
+            return self._through_step(pb_field, through, sub_mask)
+        get_val = operator.attrgetter(dj_field.name)
+        pb_name = pb_field.name
+        djtopb = self.djtopb_related if self.__bounded else self.djtopb
+        # Partial messages aren't shared through the session identity map
+        if pb_field.usage == field.REPEATED:
+            def step(obj, msg):
+                rep_field = getattr(msg, pb_name)
+                for val in get_val(obj).all():
+                    djtopb(val, rep_field.add(), mask=sub_mask)
+        else:
+            def step(obj, msg):
+                val = get_val(obj)
+                if val is not None:
+                    djtopb(val, getattr(msg, pb_name), mask=sub_mask)
+        return step
+
+
+    def _run_pbtodj_plan(self, mapped_model, obj, dest_obj):
+        """pbtodj using the compiled plan of the mapped model.  New objects
+        get their values through the model constructor so Django doesn't
+        compute defaults for fields that are set anyway.
+        """
+        aot = self.__aot.get(mapped_model)
+        if aot is not None:
+            values = aot[1](obj)
+        else:
+            plan = self.pbtodj_plan(mapped_model)
+            values = {}
+            for (pb_field, val) in obj.ListFields():
+                entry = plan.get(pb_field.name)
+                if entry is not None:
+                    dj_name, convert = entry
+                    values[dj_name] = val if convert is None else convert(val)
+        if dest_obj is None:
+            return mapped_model.dj_model(**values)
+        if not isinstance(dest_obj, mapped_model.dj_model):
+            raise Exception("dest_obj type %s doesn't match model type %s" % 
+                            (type(dest_obj), mapped_model.dj_model))
+        for dj_name, val in values.items():
+            setattr(dest_obj, dj_name, val)
+        return dest_obj
 
     def pbtodj(self, obj, dest_obj=None):
             """ Take a protocol buffer object whose class was generated by
@@ -206,17 +1260,13 @@ class Converter(object):
                             mapped fields will be copied
             """
             # Find the message mapping
-            pb_msg_name = obj.__class__.__name__
-            
-            mapped_model = None
-            for mapped_model_test in self.mapped_module.mapped_models:
-                if mapped_model_test.pbandj_pb_msg.name == pb_msg_name:
-                    mapped_model = mapped_model_test
-                    break
+            mapped_model = self.registry.for_message(obj)
 
             if mapped_model == None:
-                #print [model.pbandj_pb_msg.name for model in self.mapped_module.mapped_models]
-                raise Exception("No pbandj mapping found for protocol buffer message type %s" % pb_msg_name)
+                raise Exception("No pbandj mapping found for protocol buffer message type %s" % obj.__class__.__name__)
+            
+            if self.compiled:
+                return self._run_pbtodj_plan(mapped_model, obj, dest_obj)
             
             if(not dest_obj is None):
                 if isinstance(dest_obj, mapped_model.dj_model):
@@ -257,7 +1307,7 @@ class Converter(object):
             return dj_obj
     
     
-    def djtopb(self, obj, dest_obj=None, excludes=[]):
+    def djtopb(self, obj, dest_obj=None, excludes=[], mask=None):
         """ Take a django object for which a protocol buffer message
             has been generated and return a related protocol buffer
             message.  Since the python implementation of protocol
@@ -273,27 +1323,70 @@ class Converter(object):
                         Instead of creating a new object this obj
                         will be loaded with data and returned
             excludes - A list of field names to exclude from the conversion.
+            mask - A list of field paths to convert.  See normalize_mask
+            The message of a top level object is read from self.cache when
+            the Converter has one.  See djtopb_serialized
         """
         # Import the message type and instantiate if necessary
         dj_type = type(obj)
-        # Try to get the type using the django class name
-        mapped_model = None
-        for mapped_model_test in self.mapped_module.mapped_models:
-            if mapped_model_test.dj_model == dj_type:
-                mapped_model = mapped_model_test
-                break
-            
+        # Proxies and subclasses of a mapped model resolve through the MRO
+        mapped_model = self.registry.for_dj_type(dj_type)
+
         if mapped_model == None:
             raise Exception("No mapping available for django type %s." % dj_type)
         
-        msg_type = getattr(self.mapped_module.load_pb2(), mapped_model.pbandj_pb_msg.name)
-#        pbandj_model = mapped_model.pbandj_model
-        
         if dest_obj is None:
-            protomsg = msg_type()
+            protomsg = self.message_type(mapped_model)()
         else:
             protomsg = dest_obj
         
+        if self.cache is not None and not getattr(self.__local, 'caching', False):
+            data, converted = self._cached_djtopb(obj, mapped_model, protomsg, excludes, mask)
+            if not converted:
+                protomsg.MergeFromString(data)
+            return protomsg
+        
+        if self.__bounded:
+            local = self.__local
+            if getattr(local, 'depth', None) is None:
+                # Top level object.  Track depth and the objects converted
+                # into this message until it is done
+                local.depth = 0
+                local.emitted = set()
+                try:
+                    return self.djtopb(obj, protomsg, excludes, mask)
+                finally:
+                    local.depth = None
+                    local.emitted = None
+            if obj.pk is not None:
+                local.emitted.add((mapped_model, obj.pk))
+        
+        if mask is not None:
+            # Anything other than a tuple is normalized.  Unsorted tuples
+            # are only cached separately
+            if type(mask) is not tuple:
+                mask = normalize_mask(mask)
+            for dj_name, step in self.masked_djtopb_plan(mapped_model, mask):
+                if not dj_name in excludes:
+                    step(obj, protomsg)
+            return protomsg
+        
+        if self.compiled:
+            aot = self.__aot.get(mapped_model)
+            # Generated converters don't use the identity map of a session
+            # or bound the conversion
+            if (aot is not None and not excludes and not self.__bounded and
+                getattr(self.__local, 'session', None) is None):
+                aot[0](obj, protomsg)
+            elif excludes:
+                for dj_name, step in self.djtopb_plan(mapped_model):
+                    if not dj_name in excludes:
+                        step(obj, protomsg)
+            else:
+                for dj_name, step in self.djtopb_plan(mapped_model):
+                    step(obj, protomsg)
+            return protomsg
+        
         # Get the pb message type and convert the django message 
 #        for mapped_field in mapped_model.pbandj_pb_msg.fields['mapped_fields']['fields']:
         for dj_field, pb_field in mapped_model.pb_to_dj_field_map.values():
@@ -311,6 +1404,11 @@ class Converter(object):
                     
                 rep_field = getattr(protomsg, pb_field.name)
                 
+                through = self.through_relation(dj_field, pb_field)
+                if through is not None:
+                    self._through_step(pb_field, through)(obj, protomsg)
+                    continue
+                
                 # Iterate thorugh and convert each value independantly
                 for val in val_list:
                     try:
@@ -360,4 +1458,910 @@ class Converter(object):
                             #print dj_field.name, type(dj_field), dj_field.dj_type, type(pb_field), pb_field.pb_type, type(val), val #val.pk, val.fk_test,  pb_val
                             traceback.print_exc()
                             raise e
+        for name in mapped_model.converted_relations:
+            if name in excludes:
+                continue
+            dj_relation, pb_field = mapped_model.pb_to_dj_relation_map[name]
+            self._djtopb_relation_step(dj_relation, pb_field)(obj, protomsg)
         return protomsg
+
+
+    def relation_paths(self, mapped_model, excludes=()):
+        """Get the (select_related, prefetch_related) lookups covering every
+        relation djtopb follows for a mapped model, including relations of
+        nested messages.  ForeignKeys mapped to messages are joined with
+        select_related until a ManyToMany or reverse relation is crossed,
+        after which every relation has to be prefetched.  Converted reverse
+        relations are prefetched on their accessor.
+        
+        Args:
+        mapped_model - (MappedModel) model being converted
+        excludes - Names of top level fields that won't be converted
+        """
+        try:
+            select, prefetch = self.__relation_paths[mapped_model]
+        except KeyError:
+            select, prefetch = [], []
+            self._find_relation_paths(mapped_model, '', False, (), select, prefetch)
+            self.__relation_paths[mapped_model] = (select, prefetch)
+        if excludes:
+            excludes = self._excluded_lookups(mapped_model, excludes)
+            select = [path for path in select if not path.split('__')[0] in excludes]
+            prefetch = [path for path in prefetch if not path.split('__')[0] in excludes]
+        return select, prefetch
+
+    def _excluded_lookups(self, mapped_model, excludes):
+        """Get the lookup names of excluded fields.  Reverse relations and
+        ManyToManys with a custom through model are looked up by their
+        accessor rather than the message field name.
+        """
+        excluded = set(excludes)
+        relations = mapped_model.pb_to_dj_relation_map
+        for name in mapped_model.converted_relations:
+            if name in excluded:
+                excluded.add(relations[name][0].related_accessor_name)
+        fields = mapped_model.pb_to_dj_field_map
+        for name in excludes:
+            if name in fields:
+                through = self.through_relation(*fields[name])
+                if through is not None:
+                    excluded.add(through[0])
+        return excluded
+
+    def _find_relation_paths(self, mapped_model, prefix, prefetching, seen, select, prefetch,
+                             back_field=None):
+        seen = seen + (mapped_model,)
+        relations = mapped_model.pb_to_dj_relation_map
+        for name in mapped_model.converted_relations:
+            dj_relation, pb_field = relations[name]
+            path = prefix + dj_relation.related_accessor_name
+            prefetch.append(path)
+            related = self.registry.for_dj_type(dj_relation.child_dj_model)
+            if (isinstance(pb_field.pb_type, Message) and
+                related is not None and not related in seen):
+                self._find_relation_paths(related, path + '__', True, seen, select, prefetch,
+                                          dj_relation.name)
+        for dj_field, pb_field in mapped_model.pb_to_dj_field_map.values():
+            if dj_field.name == back_field:
+                # Left out of messages converted through a reverse relation
+                continue
+            is_message = isinstance(pb_field.pb_type, Message)
+            path = prefix + dj_field.name
+            through = self.through_relation(dj_field, pb_field)
+            if through is not None:
+                # The through rows are prefetched like a reverse relation
+                path = prefix + through[0]
+                prefetch.append(path)
+                related = self.registry.for_dj_type(dj_field.related_through_model)
+                if related is not None and not related in seen:
+                    self._find_relation_paths(related, path + '__', True, seen, select, prefetch,
+                                              through[1])
+                continue
+            if isinstance(dj_field, ManyToMany):
+                prefetch.append(path)
+                nested_prefetching = True
+            elif isinstance(dj_field, ForeignKey) and is_message:
+                if prefetching:
+                    prefetch.append(path)
+                else:
+                    select.append(path)
+                nested_prefetching = prefetching
+            else:
+                # ForeignKeys mapped to ints only read the key column
+                continue
+            if not is_message:
+                continue
+            related_dj_model = mapped_model.dj_model._meta.get_field(dj_field.name).rel.to
+            related = self.registry.for_dj_type(related_dj_model)
+            # Stop at recursive relations rather than planning forever
+            if related is not None and not related in seen:
+                self._find_relation_paths(related, path + '__', nested_prefetching,
+                                          seen, select, prefetch)
+
+    def mask_lookups(self, mapped_model, mask):
+        """Get the (only, select_related, prefetch_related) lookups loading
+        just the columns and relations of a normalized field mask.  Whole
+        related messages are loaded like relation_paths does.  Relations
+        below a ManyToMany are prefetched with all their columns since a
+        prefetch can't be restricted to columns.
+        """
+        try:
+            return self.__mask_lookups[(mapped_model, mask)]
+        except KeyError:
+            pass
+        only, select, prefetch = [], [], []
+        self._find_mask_lookups(mapped_model, mask, '', False, only, select, prefetch)
+        lookups = (only, select, prefetch)
+        self.__mask_lookups[(mapped_model, mask)] = lookups
+        return lookups
+
+    def _find_mask_lookups(self, mapped_model, mask, prefix, prefetching, only, select, prefetch):
+        fields = mapped_model.pb_to_dj_field_map
+        for name, sub_mask in sorted(mask_tree(mask).items()):
+            if name in mapped_model.converted_relations and sub_mask is None:
+                dj_relation, pb_field = mapped_model.pb_to_dj_relation_map[name]
+                path = prefix + dj_relation.related_accessor_name
+                prefetch.append(path)
+                related = self.registry.for_dj_type(dj_relation.child_dj_model)
+                if isinstance(pb_field.pb_type, Message) and related is not None:
+                    sub_select, sub_prefetch = [], []
+                    self._find_relation_paths(related, '', True, (mapped_model,),
+                                              sub_select, sub_prefetch, dj_relation.name)
+                    prefetch.extend(path + '__' + lookup for lookup in sub_select + sub_prefetch)
+                continue
+            if not name in fields:
+                raise Exception("No field %s in message %s" % (name, mapped_model.pbandj_pb_msg.name))
+            dj_field, pb_field = fields[name]
+            is_message = isinstance(pb_field.pb_type, Message)
+            path = prefix + name
+            through = self.through_relation(dj_field, pb_field)
+            if through is not None:
+                path = prefix + through[0]
+                prefetch.append(path)
+                related = self.registry.for_dj_type(dj_field.related_through_model)
+                if related is None:
+                    continue
+                if sub_mask is not None:
+                    self._find_mask_lookups(related, sub_mask, path + '__', True,
+                                            only, select, prefetch)
+                    continue
+                sub_select, sub_prefetch = [], []
+                self._find_relation_paths(related, '', True, (mapped_model,),
+                                          sub_select, sub_prefetch, through[1])
+                prefetch.extend(path + '__' + lookup for lookup in sub_select + sub_prefetch)
+                continue
+            if isinstance(dj_field, ManyToMany):
+                prefetch.append(path)
+                nested_prefetching = True
+            elif isinstance(dj_field, ForeignKey) and is_message:
+                if prefetching:
+                    prefetch.append(path)
+                else:
+                    select.append(path)
+                    only.append(path)
+                nested_prefetching = prefetching
+            else:
+                if not prefetching:
+                    only.append(path)
+                continue
+            if not is_message:
+                continue
+            related_dj_model = mapped_model.dj_model._meta.get_field(dj_field.name).rel.to
+            related = self.registry.for_dj_type(related_dj_model)
+            if related is None:
+                continue
+            if sub_mask is not None:
+                self._find_mask_lookups(related, sub_mask, path + '__', nested_prefetching,
+                                        only, select, prefetch)
+                continue
+            # None of the columns of a whole related message are named in
+            # only() so Django loads all of them
+            sub_select, sub_prefetch = self.relation_paths(related)
+            if nested_prefetching:
+                prefetch.extend(path + '__' + lookup for lookup in sub_select)
+            else:
+                select.extend(path + '__' + lookup for lookup in sub_select)
+            prefetch.extend(path + '__' + lookup for lookup in sub_prefetch)
+
+    def load_lookups(self, mapped_model, excludes=(), mask=None):
+        """Get the (only, defer, select_related, prefetch_related) lookups
+        loading what djtopb reads for a mapped model.  only is None without
+        a mask and defer holds the excluded columns.
+        
+        Args:
+        mapped_model - (MappedModel) model being converted
+        excludes - Names of top level fields that won't be converted
+        mask - (tuple) normalized field mask or None
+        """
+        if mask is None:
+            only = None
+            select, prefetch = self.relation_paths(mapped_model, excludes)
+        else:
+            only, select, prefetch = self.mask_lookups(mapped_model, mask)
+            if excludes:
+                excludes = self._excluded_lookups(mapped_model, excludes)
+                only = [path for path in only if not path.split('__')[0] in excludes]
+                select = [path for path in select if not path.split('__')[0] in excludes]
+                prefetch = [path for path in prefetch if not path.split('__')[0] in excludes]
+        defer = []
+        if excludes:
+            fields = mapped_model.pb_to_dj_field_map
+            pk_name = mapped_model.dj_model._meta.pk.name
+            defer = [name for name in excludes
+                     if name in fields and name != pk_name and
+                     not isinstance(fields[name][0], ManyToMany)]
+        return only, defer, select, prefetch
+
+    def _load_queryset(self, queryset, mapped_model, excludes, mask):
+        """Apply the lookups of load_lookups other than prefetches to a
+        QuerySet.  Returns the QuerySet and the prefetch lookups
+        """
+        only, defer, select, prefetch = self.load_lookups(mapped_model, excludes, mask)
+        if only is not None:
+            queryset = queryset.only(*only)
+        if defer:
+            queryset = queryset.defer(*defer)
+        if select:
+            queryset = queryset.select_related(*select)
+        return queryset, prefetch
+
+    def _cached_djtopb(self, obj, mapped_model, protomsg, excludes, mask):
+        """Get the serialized message of a top level object from
+        self.cache.  Otherwise obj is converted into protomsg and the
+        serialized message is stored if the conversion can be cached.
+        Objects nested in the message are converted rather than looked up
+        one by one.
+        
+        Returns:
+        (serialized message or None, True if protomsg was converted)
+        """
+        cache = self.cache
+        cacheable = (not excludes and not self.__bounded and obj.pk is not None and
+                     cache.watches(mapped_model))
+        if cacheable:
+            if mask is not None and type(mask) is not tuple:
+                mask = normalize_mask(mask)
+            data = cache.get(mapped_model, obj.pk, mask)
+            if data is not None:
+                return data, False
+        local = self.__local
+        local.caching = True
+        try:
+            self.djtopb(obj, protomsg, excludes, mask)
+        finally:
+            local.caching = False
+        if not cacheable:
+            return None, True
+        data = protomsg.SerializeToString()
+        cache.set(mapped_model, obj.pk, mask, data)
+        return data, True
+
+    def djtopb_serialized(self, obj, dest_obj=None, excludes=[], mask=None):
+        """Convert a django object to a serialized protocol buffer message.
+        A message found in self.cache is returned as is.
+        
+        Args:
+        obj - (django Model) The object to be converted
+        dest_obj - (Message) Empty message to convert into when the object
+                   is converted
+        excludes - A list of field names to exclude from the conversion.
+        mask - A list of field paths to convert.  See normalize_mask
+        """
+        mapped_model = self.registry.for_dj_type(type(obj))
+        if (self.cache is None or mapped_model is None or
+            getattr(self.__local, 'caching', False)):
+            return self.djtopb(obj, dest_obj, excludes, mask).SerializeToString()
+        if dest_obj is None:
+            dest_obj = self.message_type(mapped_model)()
+        data, converted = self._cached_djtopb(obj, mapped_model, dest_obj, excludes, mask)
+        if data is None:
+            data = dest_obj.SerializeToString()
+        return data
+
+    def djtopb_many(self, queryset, excludes=[], mask=None, serialize=False, pooled=False):
+        """Convert every object of a QuerySet to a protocol buffer message.
+        Relations followed by the conversion are loaded up front with
+        select_related and prefetch_related so the number of queries
+        doesn't grow with the number of objects.
+        
+        Args:
+        queryset - (QuerySet) objects of a mapped Django model
+        excludes - A list of field names to exclude from the conversion.
+        mask - A list of field paths to convert.  Only the columns and
+               relations of masked fields are loaded.  See normalize_mask
+        serialize - (bool) Return serialized messages rather than messages
+        pooled - (bool) Convert into messages of self.message_pool that are
+                 returned to the pool once serialized.  Needs serialize.
+        
+        Returns:
+        list of messages or serialized messages in queryset order
+        """
+        if pooled and not serialize:
+            raise Exception("Pooled messages are only returned serialized")
+        mapped_model = self.registry.for_dj_type(queryset.model)
+        if mapped_model == None:
+            raise Exception("No mapping available for django type %s." % queryset.model)
+        mask = normalize_mask(mask)
+        queryset, prefetch = self._load_queryset(queryset, mapped_model, excludes, mask)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        if pooled:
+            return list(self._iter_pooled(queryset, mapped_model, excludes, mask, True))
+        if serialize:
+            return [self.djtopb_serialized(obj, excludes=excludes, mask=mask) for obj in queryset]
+        return [self.djtopb(obj, excludes=excludes, mask=mask) for obj in queryset]
+
+    def iter_djtopb(self, queryset, chunk_size=1000, excludes=[], serialize=False, mask=None,
+                    pooled=False, with_pk=False):
+        """Generate protocol buffer messages for the objects of a QuerySet
+        without holding the whole QuerySet in memory.  Objects are read with
+        QuerySet.iterator() and relations are prefetched one chunk at a
+        time, so memory use is bounded by chunk_size rather than the number
+        of objects.
+        
+        Args:
+        queryset - (QuerySet) objects of a mapped Django model
+        chunk_size - (int) Number of objects converted per prefetch
+        excludes - A list of field names to exclude from the conversion.
+        serialize - (bool) Yield serialized messages rather than messages
+        mask - A list of field paths to convert.  See djtopb_many
+        pooled - (bool) Convert into messages of self.message_pool rather
+                 than new ones.  Unless serialize is set a yielded message
+                 is only valid until the next one is generated.
+        with_pk - (bool) Yield (pk, message) pairs
+        """
+        mapped_model = self.registry.for_dj_type(queryset.model)
+        if mapped_model == None:
+            raise Exception("No mapping available for django type %s." % queryset.model)
+        mask = normalize_mask(mask)
+        queryset, prefetch = self._load_queryset(queryset, mapped_model, excludes, mask)
+        objs = queryset.iterator()
+        while True:
+            chunk = list(itertools.islice(objs, chunk_size))
+            if not chunk:
+                return
+            if prefetch:
+                prefetch_related_objects(chunk, prefetch)
+            if pooled:
+                converted = self._iter_pooled(chunk, mapped_model, excludes, mask, serialize)
+            elif serialize:
+                converted = (self.djtopb_serialized(obj, excludes=excludes, mask=mask)
+                             for obj in chunk)
+            else:
+                converted = (self.djtopb(obj, excludes=excludes, mask=mask) for obj in chunk)
+            if with_pk:
+                converted = itertools.izip((obj.pk for obj in chunk), converted)
+            for protomsg in converted:
+                yield protomsg
+            del chunk, converted
+
+    def _iter_pooled(self, objs, mapped_model, excludes, mask, serialize):
+        """Convert objects into messages of self.message_pool.  A message
+        goes back to the pool once it is serialized or once the next
+        object is asked for.
+        """
+        pool = self.message_pool
+        msg_type = self.message_type(mapped_model)
+        for obj in objs:
+            if serialize:
+                protomsg = pool.acquire(msg_type)
+                data = self.djtopb_serialized(obj, protomsg, excludes, mask)
+                pool.release(protomsg)
+                yield data
+            else:
+                protomsg = self.djtopb(obj, pool.acquire(msg_type), excludes, mask)
+                yield protomsg
+                pool.release(protomsg)
+
+    def values_plan(self, mapped_model):
+        """Get the plan djtopb_values converts rows with.  Returns a tuple
+        of (plan, instance fields) where plan is a tuple of (dj field name,
+        pb field name, convert) for every field that can be read from a
+        values_list() row and instance fields are the names of fields that
+        need a model instance, like relations mapped to messages,
+        ManyToMany fields and converted reverse relations.
+        """
+        try:
+            return self.__values_plans[mapped_model]
+        except KeyError:
+            pass
+        plan = []
+        instance_fields = []
+        for dj_field, pb_field in mapped_model.pb_to_dj_field_map.values():
+            if (pb_field.usage == field.REPEATED or
+                isinstance(pb_field.pb_type, Message)):
+                instance_fields.append(dj_field.name)
+                continue
+            helper = self.helpers[(dj_field, pb_field)]
+            if helper == self.django_foreign_key_field_to_protocol_buffer_int32:
+                if not self.pk_attname(dj_field):
+                    # values_list gives the to_field rather than the pk
+                    instance_fields.append(dj_field.name)
+                    continue
+                # values_list gives the key column for a ForeignKey
+                convert = None
+            elif (helper == self.generic_django_field_to_generic_protocol_buffer_field and
+                  self.helpers.get((dj_field.dj_type, pb_field.pb_type)) is file_to_string):
+                # values_list gives the file name rather than a FieldFile
+                convert = None
+            else:
+                convert = self._value_converter(dj_field, pb_field, dj_field.dj_type, pb_field.pb_type)
+            plan.append((dj_field.name, pb_field.name, convert))
+        instance_fields.extend(mapped_model.converted_relations)
+        values_plan = (tuple(plan), tuple(instance_fields))
+        self.__values_plans[mapped_model] = values_plan
+        return values_plan
+
+    def djtopb_values(self, queryset, excludes=[], mask=None):
+        """Convert every object of a QuerySet to a protocol buffer message
+        from values_list() rows rather than model instances.  Models with
+        fields that can't be read from a row (see values_plan) are
+        converted with djtopb_many instead unless those fields are excluded
+        or masked out.
+        
+        Args:
+        queryset - (QuerySet) objects of a mapped Django model
+        excludes - A list of field names to exclude from the conversion.
+        mask - A list of field paths to convert.  Masks with nested paths
+               are converted with djtopb_many.  See normalize_mask
+        
+        Returns:
+        list of messages in queryset order
+        """
+        mapped_model = self.registry.for_dj_type(queryset.model)
+        if mapped_model == None:
+            raise Exception("No mapping available for django type %s." % queryset.model)
+        plan, instance_fields = self.values_plan(mapped_model)
+        mask = normalize_mask(mask)
+        if mask is not None:
+            tree = mask_tree(mask)
+            fields = mapped_model.pb_to_dj_field_map
+            for name, sub_mask in tree.items():
+                if sub_mask is not None or not name in fields:
+                    return self.djtopb_many(queryset, excludes=excludes, mask=mask)
+            plan = [entry for entry in plan if entry[0] in tree]
+            instance_fields = [dj_name for dj_name in instance_fields if dj_name in tree]
+        for dj_name in instance_fields:
+            if not dj_name in excludes:
+                return self.djtopb_many(queryset, excludes=excludes, mask=mask)
+        if excludes:
+            plan = [entry for entry in plan if not entry[0] in excludes]
+        msg_type = self.message_type(mapped_model)
+        columns = [dj_name for dj_name, pb_name, convert in plan]
+        steps = [(pb_name, convert) for dj_name, pb_name, convert in plan]
+        msgs = []
+        for row in queryset.values_list(*columns):
+            protomsg = msg_type()
+            for (pb_name, convert), val in zip(steps, row):
+                if val is not None and val != "":
+                    if convert is not None:
+                        val = convert(val)
+                    setattr(protomsg, pb_name, val)
+            msgs.append(protomsg)
+        return msgs
+
+    def reference_plan(self, mapped_model):
+        """Get the fields of a mapped model's message holding pks of related
+        objects.  Returns a tuple of (int fields, message fields) where int
+        fields is a list of (pb field name, related Django model) and
+        message fields is a list of names of nested message fields.
+        """
+        try:
+            return self.__reference_plans[mapped_model]
+        except KeyError:
+            int_fields = []
+            msg_fields = []
+            for dj_field, pb_field in mapped_model.pb_to_dj_field_map.values():
+                if pb_field.usage == field.REPEATED:
+                    continue
+                helper = self.helpers[(pb_field, dj_field)]
+                if helper == self.protocol_buffer_int32_to_django_foreign_key_field:
+                    int_fields.append((pb_field.name, dj_field.related_dj_model))
+                elif helper == self.protocol_buffer_message_to_django_foreign_key_field:
+                    msg_fields.append(pb_field.name)
+            plan = (int_fields, msg_fields)
+            self.__reference_plans[mapped_model] = plan
+            return plan
+
+    def _collect_references(self, msg, references, graph=False):
+        """Add the pks msg and its nested ForeignKey messages refer to to
+        references, a dict of Django model to set of pks.  With graph the
+        messages of repeated and reverse relation fields, which
+        pbtodj_save_many converts, are followed too.
+        """
+        mapped_model = self.registry.for_message(msg)
+        if mapped_model == None:
+            return
+        int_fields, msg_fields = self.reference_plan(mapped_model)
+        for pb_name, dj_model in int_fields:
+            if msg.HasField(pb_name):
+                references.setdefault(dj_model, set()).add(getattr(msg, pb_name))
+        if not graph:
+            for pb_name in msg_fields:
+                if msg.HasField(pb_name):
+                    self._collect_references(getattr(msg, pb_name), references)
+            return
+        for pb_field, val in msg.ListFields():
+            if pb_field.type != pb_field.TYPE_MESSAGE:
+                continue
+            if pb_field.label != pb_field.LABEL_REPEATED:
+                val = [val]
+            for entry in val:
+                self._collect_references(entry, references, True)
+
+    def _resolve_references(self, msgs, graph=False):
+        """Load the objects msgs refer to by pk with one in_bulk() query
+        per related model.  Returns a dict of Django model to {pk: object}
+        including the objects resolved by an enclosing batch.  See
+        _collect_references
+        """
+        references = {}
+        for msg in msgs:
+            self._collect_references(msg, references, graph)
+        resolved = {}
+        for dj_model, pks in references.items():
+            resolved[dj_model] = dj_model._default_manager.in_bulk(list(pks))
+        outer = getattr(self.__local, 'resolved', None)
+        if outer is not None:
+            for dj_model, objs in outer.items():
+                resolved.setdefault(dj_model, {}).update(objs)
+        return resolved
+
+    def pbtodj_save(self, msg):
+        """Convert a protocol buffer message and save the whole object
+        graph of its nested messages.  See pbtodj_save_many
+        """
+        return self.pbtodj_save_many([msg])[0]
+
+    def pbtodj_save_many(self, msgs):
+        """Convert a batch of protocol buffer messages and save the object
+        graphs of their nested messages in one transaction.  Nested
+        ForeignKey messages, ManyToMany fields and reverse relation fields
+        holding messages are followed.  Objects are inserted in
+        topological order with one bulk_create per model and level, then
+        the ManyToMany through rows are inserted with one bulk_create per
+        field.  ManyToMany fields with a custom through model hold messages
+        of the through model, which are saved as rows of it.
+        
+        Objects referred to by pk anywhere in the graph are loaded with
+        one in_bulk() query per related model.  Messages whose pk is
+        already in the database refer to the existing row, which is left
+        as it is.  bulk_create can't return
+        the pks of new rows, so new objects without a pk that another
+        object refers to are inserted one at a time with save(), which
+        sends the pre_save and post_save signals.  Every other new object
+        and the rows of auto created through models are inserted with
+        bulk_create, which neither calls save() nor sends signals.
+        
+        Args:
+        msgs - (list) messages of mapped models
+        
+        Returns:
+        list of saved Django objects in msgs order
+        """
+        # The nested messages _add_save_node converts refer to objects
+        # loaded with the rest of the batch
+        outer = getattr(self.__local, 'resolved', None)
+        self.__local.resolved = self._resolve_references(msgs, graph=True)
+        try:
+            nodes = collections.OrderedDict()
+            roots = [self._add_save_node(nodes, msg, self.pbtodj(msg)) for msg in msgs]
+        finally:
+            self.__local.resolved = outer
+        atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+        with atomic():
+            self._save_nodes(nodes.values())
+        return [node.obj for node in roots]
+
+    def _add_save_node(self, nodes, msg, obj):
+        """Add the SaveNode of a converted message and of the objects of its
+        nested messages to nodes.  Nodes are keyed by model and pk, or by
+        object without a pk, so objects in the graph more than once are
+        saved once.
+        """
+        dj_model = type(obj)
+        key = (dj_model, obj.pk) if obj.pk is not None else id(obj)
+        node = nodes.get(key)
+        if node is not None:
+            return node
+        node = nodes[key] = SaveNode(obj)
+        mapped_model = self.registry.for_message(msg)
+        fields = mapped_model.pb_to_dj_field_map
+        relations = mapped_model.pb_to_dj_relation_map
+        meta = dj_model._meta
+        for pb_field, val in msg.ListFields():
+            name = pb_field.name
+            if name in fields:
+                dj_field, pbandj_pb_field = fields[name]
+                is_message = isinstance(pbandj_pb_field.pb_type, Message)
+                through = self.through_relation(dj_field, pbandj_pb_field)
+                if through is not None:
+                    # Rows of the through model pointing back at this object
+                    source = dj_field.related_through_model._meta.get_field(through[1])
+                    node.needs_pk = True
+                    for entry in val:
+                        row = self._add_save_node(nodes, entry, self.pbtodj(entry))
+                        row.parents.append((source.attname, node))
+                elif isinstance(dj_field, ManyToMany):
+                    m2m_field = meta.get_field(dj_field.name)
+                    node.needs_pk = True
+                    for entry in val:
+                        if is_message:
+                            related = self._add_save_node(nodes, entry, self.pbtodj_related(entry))
+                            related.needs_pk = True
+                            node.m2m.append((m2m_field, related))
+                        else:
+                            node.m2m.append((m2m_field, entry))
+                elif isinstance(dj_field, ForeignKey) and is_message:
+                    # pbtodj set the object converted from the nested message
+                    related = self._add_save_node(nodes, val, getattr(obj, dj_field.name))
+                    related.needs_pk = True
+                    node.parents.append((meta.get_field(dj_field.name).attname, related))
+            elif name in relations:
+                dj_relation, pbandj_pb_field = relations[name]
+                if not isinstance(pbandj_pb_field.pb_type, Message):
+                    # Related objects can't be created from a pk
+                    continue
+                child_field = dj_relation.child_dj_model._meta.get_field(dj_relation.name)
+                node.needs_pk = True
+                entries = val if pbandj_pb_field.usage == field.REPEATED else [val]
+                for entry in entries:
+                    child = self._add_save_node(nodes, entry, self.pbtodj(entry))
+                    if isinstance(dj_relation, ManyToMany):
+                        child.needs_pk = True
+                        child.m2m.append((child_field, node))
+                    else:
+                        child.parents.append((child_field.attname, node))
+        return node
+
+    def _save_nodes(self, nodes):
+        """Insert the objects and ManyToMany rows of a list of SaveNodes
+        """
+        by_model = collections.defaultdict(list)
+        for node in nodes:
+            if node.obj.pk is not None:
+                by_model[type(node.obj)].append(node)
+        for dj_model, model_nodes in by_model.items():
+            existing = set(dj_model._default_manager.filter(
+                pk__in=[node.obj.pk for node in model_nodes]).values_list('pk', flat=True))
+            for node in model_nodes:
+                node.existing = node.obj.pk in existing
+        
+        levels = collections.defaultdict(collections.OrderedDict)
+        for node in nodes:
+            if not node.existing:
+                level = self._save_level(node, set())
+                levels[level].setdefault(type(node.obj), []).append(node)
+        for level in sorted(levels):
+            for dj_model, model_nodes in levels[level].items():
+                bulk = []
+                for node in model_nodes:
+                    for attname, parent in node.parents:
+                        setattr(node.obj, attname, parent.obj.pk)
+                    if node.needs_pk and node.obj.pk is None:
+                        node.obj.save(force_insert=True)
+                    else:
+                        bulk.append(node.obj)
+                if bulk:
+                    dj_model._default_manager.bulk_create(bulk)
+        
+        rows = collections.OrderedDict()
+        for node in nodes:
+            if node.existing:
+                continue
+            for m2m_field, related in node.m2m:
+                through = m2m_field.rel.through
+                if not through._meta.auto_created:
+                    continue
+                related_pk = related.obj.pk if isinstance(related, SaveNode) else related
+                rows.setdefault(m2m_field, collections.OrderedDict())[(node.obj.pk, related_pk)] = None
+        for m2m_field, pairs in rows.items():
+            through = m2m_field.rel.through
+            source = through._meta.get_field(m2m_field.m2m_field_name()).attname
+            target = through._meta.get_field(m2m_field.m2m_reverse_field_name()).attname
+            through._default_manager.bulk_create(
+                [through(**{source: source_pk, target: target_pk}) for source_pk, target_pk in pairs])
+        
+        if self.cache is not None:
+            # bulk_create doesn't send the signals invalidating the cache
+            for node in nodes:
+                if not node.existing:
+                    self.cache.changed(type(node.obj), node.obj.pk)
+            for m2m_field, pairs in rows.items():
+                for source_pk, target_pk in pairs:
+                    self.cache.changed(m2m_field.rel.to, target_pk)
+
+    def _save_level(self, node, visiting):
+        """Get the insert level of a SaveNode, one more than the highest
+        level of the new objects its ForeignKeys refer to
+        """
+        if node.level is not None:
+            return node.level
+        if node in visiting:
+            raise Exception("ForeignKey cycle between unsaved %s objects" % type(node.obj).__name__)
+        visiting.add(node)
+        level = 0
+        for attname, parent in node.parents:
+            if not parent.existing:
+                level = max(level, self._save_level(parent, visiting) + 1)
+        visiting.discard(node)
+        node.level = level
+        return level
+
+    def pbtodj_many(self, msgs):
+        """Convert a batch of protocol buffer messages to Django objects.
+        Related objects referenced by pk, including from nested messages,
+        are loaded with one in_bulk() query per related model rather than
+        one query per reference.
+        
+        Args:
+        msgs - (list) messages of mapped models
+        
+        Returns:
+        list of unsaved Django objects in msgs order
+        """
+        outer = getattr(self.__local, 'resolved', None)
+        self.__local.resolved = self._resolve_references(msgs)
+        try:
+            return [self.pbtodj(msg) for msg in msgs]
+        finally:
+            self.__local.resolved = outer
+
+    def update_plan(self, mapped_model):
+        """Get the plan pbtodj_update compares and sets fields with.  The
+        plan is a dict of pb field name to (dj field name, attname,
+        convert).  ForeignKeys mapped to ints are compared and set through
+        the key column so the related object isn't fetched.  The pk and
+        repeated fields aren't updated.
+        """
+        try:
+            return self.__update_plans[mapped_model]
+        except KeyError:
+            pass
+        meta = mapped_model.dj_model._meta
+        plan = {}
+        for dj_field, pb_field in mapped_model.pb_to_dj_field_map.values():
+            if pb_field.usage == field.REPEATED or dj_field.name == meta.pk.name:
+                continue
+            attname = meta.get_field(dj_field.name).attname
+            helper = self.helpers[(pb_field, dj_field)]
+            if helper == self.protocol_buffer_int32_to_django_foreign_key_field:
+                convert = None
+            else:
+                convert = self._value_converter(pb_field, dj_field, pb_field.pb_type, dj_field.dj_type)
+            plan[pb_field.name] = (dj_field.name, attname, convert)
+        self.__update_plans[mapped_model] = plan
+        return plan
+
+    def _update_fields(self, msg, dest_obj):
+        """Copy the fields set in msg that differ from dest_obj onto it.
+        Returns the names of the changed fields.
+        """
+        mapped_model = self.registry.for_message(msg)
+        if mapped_model == None:
+            raise Exception("No pbandj mapping found for protocol buffer message type %s" % msg.__class__.__name__)
+        if not isinstance(dest_obj, mapped_model.dj_model):
+            raise Exception("dest_obj type %s doesn't match model type %s" %
+                            (type(dest_obj), mapped_model.dj_model))
+        plan = self.update_plan(mapped_model)
+        changed = []
+        for pb_field, val in msg.ListFields():
+            entry = plan.get(pb_field.name)
+            if entry is None:
+                continue
+            dj_name, attname, convert = entry
+            if convert is not None:
+                val = convert(val)
+            if isinstance(val, models.Model):
+                # Related objects from nested messages compare by pk.  An
+                # object without one would be written as a NULL key.
+                if val.pk is None:
+                    raise Exception("Field %s of %s holds a message without a pk.  Related "
+                                    "objects aren't saved by updates" %
+                                    (pb_field.name, msg.__class__.__name__))
+                if val.pk == getattr(dest_obj, attname):
+                    continue
+                setattr(dest_obj, dj_name, val)
+            else:
+                try:
+                    if val == getattr(dest_obj, attname):
+                        continue
+                except TypeError:
+                    # Naive and aware datetimes don't compare
+                    pass
+                setattr(dest_obj, attname, val)
+            changed.append(dj_name)
+        return changed
+
+    def auto_now_fields(self, dj_model):
+        """Get the fields of a Django model set to the current time
+        whenever the object is saved
+        """
+        try:
+            return self.__auto_now_fields[dj_model]
+        except KeyError:
+            fields = [dj_field for dj_field in dj_model._meta.fields
+                      if getattr(dj_field, 'auto_now', False)]
+            self.__auto_now_fields[dj_model] = fields
+            return fields
+
+    def pbtodj_update(self, msg, dest_obj, save=True):
+        """Update an existing Django object from the fields set in a
+        protocol buffer message.  Only fields whose value changes are
+        written, with save(update_fields=...), and nothing is written if
+        none change.  auto_now fields are written along with the changed
+        fields.
+        
+        Args:
+        msg - (Message) message of a mapped model
+        dest_obj - (django Model) saved object to update
+        save - (bool) Save the changed fields
+        
+        Returns:
+        list of names of the changed fields
+        """
+        changed = self._update_fields(msg, dest_obj)
+        if changed and save:
+            auto_now = [dj_field.name for dj_field in self.auto_now_fields(type(dest_obj))]
+            dest_obj.save(update_fields=changed + auto_now)
+        return changed
+
+    def pbtodj_update_many(self, msgs):
+        """Update the existing rows of a batch of protocol buffer messages
+        from the fields set in each message.  The rows are loaded with one
+        in_bulk() query per model by the pk in the message.  Rows getting
+        the same new values are written with one QuerySet.update() and
+        nothing is written for messages that change nothing.  auto_now
+        fields of the written rows are set to one time per model.  Like
+        bulk_create, updates don't call save() or send save signals.
+        
+        Args:
+        msgs - (list) messages of mapped models holding the pk of a row
+        
+        Returns:
+        list of (Django object, changed field names) pairs in msgs order
+        """
+        pks = collections.defaultdict(set)
+        mapped_models = []
+        for msg in msgs:
+            mapped_model = self.registry.for_message(msg)
+            if mapped_model == None:
+                raise Exception("No pbandj mapping found for protocol buffer message type %s" % msg.__class__.__name__)
+            pk_name = mapped_model.dj_model._meta.pk.name
+            if not msg.HasField(pk_name):
+                raise Exception("Message %s has no %s to update" % (msg.__class__.__name__, pk_name))
+            pks[mapped_model.dj_model].add(getattr(msg, pk_name))
+            mapped_models.append(mapped_model)
+        existing = {}
+        for dj_model, model_pks in pks.items():
+            existing[dj_model] = dj_model._default_manager.in_bulk(list(model_pks))
+        
+        results = []
+        updates = collections.OrderedDict()
+        # {Django model: ((field name, value) of each auto_now field)}
+        auto_now = {}
+        for msg, mapped_model in zip(msgs, mapped_models):
+            dj_model = mapped_model.dj_model
+            pk = getattr(msg, dj_model._meta.pk.name)
+            obj = existing[dj_model].get(pk)
+            if obj is None:
+                raise dj_model.DoesNotExist("No %s with pk %s" % (dj_model.__name__, pk))
+            changed = self._update_fields(msg, obj)
+            results.append((obj, changed))
+            if not changed:
+                continue
+            # Key columns are read so related objects aren't fetched
+            meta = dj_model._meta
+            values = tuple((name, getattr(obj, meta.get_field(name).attname))
+                           for name in sorted(changed))
+            stamps = auto_now.get(dj_model)
+            if stamps is None:
+                # pre_save sets the field of obj to the current time
+                stamps = auto_now[dj_model] = tuple(
+                    (dj_field.name, dj_field.pre_save(obj, False))
+                    for dj_field in self.auto_now_fields(dj_model))
+            else:
+                for name, val in stamps:
+                    setattr(obj, meta.get_field(name).attname, val)
+            values += stamps
+            try:
+                updates.setdefault((dj_model, values), []).append(obj.pk)
+            except TypeError:
+                # Unhashable values are saved one object at a time
+                updates[(dj_model, id(obj))] = (obj, changed + [name for name, val in stamps])
+        
+        atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+        with atomic():
+            for (dj_model, values), update in updates.items():
+                if isinstance(update, list):
+                    dj_model._default_manager.filter(pk__in=update).update(**dict(values))
+                else:
+                    obj, changed = update
+                    obj.save(update_fields=changed)
+        if self.cache is not None:
+            # QuerySet.update() doesn't send the signals invalidating the cache
+            for (dj_model, values), update in updates.items():
+                if isinstance(update, list):
+                    for pk in update:
+                        self.cache.changed(dj_model, pk)
+        return results
@@ -22,6 +22,14 @@ def protocol_buffer_message(*args, **kwargs):
     no_follow_fields - (List) Field names which should not be followed.
                           Only used if follow_related=True
     no_follow_models - (List) Django models not to follow as relations
+    temporal_type - (str) Wire type for date and time fields, one of
+                    types.TEMPORAL_STRING (the default) or
+                    types.TEMPORAL_EPOCH
+    decimal_type - (str) Wire type for decimal fields, one of
+                   types.DECIMAL_DOUBLE (the default) or types.DECIMAL_SCALED
+    reverse_relations - (List) Names of the message fields mapped from
+                        reverse relations to fill when converting to
+                        protocol buffers
     '''
     def wrap(model):
         # Define a custom behavior based on decorator parameters
@@ -29,6 +37,12 @@ def protocol_buffer_message(*args, **kwargs):
         def generate_protocol_buffer(**pbargs):
             ''' Generate a protocol buffer message descriptor
             
+            Args:
+            temporal_type - (str) Wire type for date and time fields used
+                            when the decorator doesn't set one
+            decimal_type - (str) Wire type for decimal fields used when the
+                           decorator doesn't set one
+            
             Returns:
             A pbandj.model.ProtocolBuffer.Message object
             '''
@@ -42,11 +56,16 @@ def protocol_buffer_message(*args, **kwargs):
             if field_number_map:
                 print field_number_map
                 kwargs['pb_field_num_map'] = field_number_map
+            # Decorator settings win over module wide wire types
+            model_kwargs = dict(kwargs)
+            for wire_type in ('temporal_type', 'decimal_type'):
+                if pbargs.get(wire_type):
+                    model_kwargs.setdefault(wire_type, pbargs[wire_type])
             # TODO remove need to pass msg_name as non kwarg
             if kwargs.has_key('msg_name'):
-                return mapper.MappedModel(model, **kwargs)
+                return mapper.MappedModel(model, **model_kwargs)
             else:
-                return mapper.MappedModel(model, **kwargs)
+                return mapper.MappedModel(model, **model_kwargs)
         
         model.generate_protocol_buffer = staticmethod(generate_protocol_buffer)
         model.__PBANDJ = True
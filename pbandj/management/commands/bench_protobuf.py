@@ -0,0 +1,139 @@
+"""
+Benchmark the protocol buffer conversions of the models of an app
+"""
+import json
+import os
+import platform
+import shutil
+import tempfile
+from datetime import datetime
+from importlib import import_module
+
+from optparse import make_option
+
+import django
+import google.protobuf
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import connection, models
+
+from pbandj.modelish import mapper
+from pbandj import benchmark
+from pbandj import util
+
+
+# Module listing the BenchmarkCases of an app in CASES keyed by app name.
+# Apps not listed use <app>.pbandj_bench
+PBANDJ_BENCH_MODULES = getattr(settings, 'PBANDJ_BENCH_MODULES', {})
+PBANDJ_BENCH_MODULE = 'pbandj_bench'
+PBANDJ_BENCH_SIZES = getattr(settings, 'PBANDJ_BENCH_SIZES', benchmark.DEFAULT_SIZES)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default=','.join(str(size) for size in PBANDJ_BENCH_SIZES),
+            help='Comma separated numbers of objects converted by each case'),
+        make_option('--cases', dest='cases', default=None,
+            help='Comma separated names of the cases to run.  All by default'),
+        make_option('--repeat', dest='repeat', type='int', default=3,
+            help='Report the best of this many runs'),
+        make_option('--output', dest='output', default='pbandj_bench.json',
+            help='File the JSON results are written to'),
+        make_option('--label', dest='label', default=None,
+            help='Label stored with the results, like a commit id'),
+        make_option('--no-aot', dest='aot', action='store_false', default=True,
+            help="Don't generate a conversion module"),
+        make_option('--memory', dest='memory', action='store_true', default=False,
+            help='Also measure the peak RSS growth of djtopb_many and iter_djtopb'),
+        make_option('--codecs', dest='codecs', action='store_true', default=False,
+            help='Also time the date/time and decimal codecs'),
+    )
+
+    help = "Benchmark protocol buffer conversions of an app's models on SQLite"
+    args = "[appname]"
+
+    def handle(self, app=None, **options):
+        # Make sure we have an app
+        if not app:
+            print "Please specify an app."
+            return
+        
+        # See if the app exists
+        app = app.split(".")[-1]
+        try:
+            app_module = models.get_app(app)
+        except ImproperlyConfigured:
+            print "There is no enabled application matching '%s'." % app
+            return
+        
+        if connection.vendor != 'sqlite':
+            print "Benchmarks run on SQLite but the default database is %s." % connection.vendor
+            return
+        
+        bench_module = import_module(PBANDJ_BENCH_MODULES.get(app, app + "." + PBANDJ_BENCH_MODULE))
+        cases = bench_module.CASES
+        if options.get('cases'):
+            names = options['cases'].split(',')
+            cases = [case for case in cases if case.name in names]
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        repeat = options['repeat']
+        output = os.path.abspath(options['output'])
+        
+        # Everything runs in a fresh test database and the generated
+        # modules are written to a scratch directory
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        cwd = os.getcwd()
+        scratch = tempfile.mkdtemp()
+        try:
+            os.chdir(scratch)
+            mapped_module = mapper.MappedModule(app)
+            for model in models.get_models(app_module):
+                if hasattr(model, '__PBANDJ'):
+                    mapped_module.add_mapped_model(model.generate_protocol_buffer())
+            util.generate_pb2_module(mapped_module)
+            if options['aot']:
+                util.generate_conv_module(mapped_module)
+            tables = models.get_models(app_module, include_auto_created=True)
+            results = benchmark.run_benchmarks(cases, mapped_module, sizes, repeat, tables,
+                                               log=self.log_result, memory=options['memory'])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(scratch, ignore_errors=True)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        codecs = None
+        if options['codecs']:
+            codecs = benchmark.run_codec_benchmarks(repeat, log=self.log_codec)
+        
+        doc = {'label': options.get('label'),
+               'app': app,
+               'created': datetime.utcnow().isoformat(),
+               'python': platform.python_version(),
+               'django': django.get_version(),
+               'protobuf': getattr(google.protobuf, '__version__', None),
+               'schema_fingerprint': mapped_module.schema_fingerprint(),
+               'sizes': sizes,
+               'repeat': repeat,
+               'results': results,
+               'codecs': codecs}
+        out = open(output, 'w')
+        try:
+            json.dump(doc, out, indent=2, sort_keys=True)
+        finally:
+            out.close()
+        print "Wrote", output
+
+    def log_result(self, result):
+        print '%-24s %7d  djtopb_many %10.0f rows/s %8.1f us  pbtodj_many %10.0f rows/s %8.1f us' % (
+            result['case'], result['size'],
+            result['djtopb_many_rows_per_s'] or 0, result['djtopb_us'],
+            result['pbtodj_many_rows_per_s'] or 0, result['pbtodj_us'])
+        if result.get('djtopb_many_peak_kb') is not None:
+            print '%-24s %7d  djtopb_many peak +%d KB  iter_djtopb peak +%d KB' % (
+                result['case'], result['size'],
+                result['djtopb_many_peak_kb'], result['stream_peak_kb'] or 0)
+
+    def log_codec(self, result):
+        print '%-24s encode %6.2f us (reference %6.2f us)  decode %6.2f us (reference %6.2f us)' % (
+            result['codec'], result['encode_us'], result['reference_encode_us'],
+            result['decode_us'], result['reference_decode_us'])
@@ -14,6 +14,11 @@ from django.db import models
 
 from pbandj.modelish import mapper
 from pbandj import util
+from pbandj.modelish import types
+
+# Wire type for date and time fields of models whose decorator doesn't set
+# one.  See types.TEMPORAL_STRING and types.TEMPORAL_EPOCH
+PBANDJ_TEMPORAL_TYPE = getattr(settings, 'PBANDJ_TEMPORAL_TYPE', types.TEMPORAL_STRING)
 
 
 class Command(BaseCommand):
@@ -24,6 +29,9 @@ class Command(BaseCommand):
 #            help='Set the name of the generated .proto file'),
         make_option('--pb2', dest='pb2', default=None,
             help='Maintain field nubering from existing pb2 module'),                                             
+        make_option('--temporal', dest='temporal', default=PBANDJ_TEMPORAL_TYPE,
+            choices=sorted(types.TEMPORAL_DJ2PB.keys()),
+            help='Wire type for date and time fields'),
     )
 
     help = "Generated Protocol Buffer definitions according to model"
@@ -65,12 +73,14 @@ class Command(BaseCommand):
                 sys.exit(1)
             field_number_map = util.generate_field_number_map(pb2_mod)
         mapped_module = mapper.MappedModule(app)
-        mapped_models = [model.generate_protocol_buffer(old_pb2_mod=pb2_mod, field_number_map=field_number_map) for model in model_list if hasattr(model, '__PBANDJ')]
+        mapped_models = [model.generate_protocol_buffer(old_pb2_mod=pb2_mod, field_number_map=field_number_map,
+                                                        temporal_type=options.get('temporal')) for model in model_list if hasattr(model, '__PBANDJ')]
         for mapped_model in mapped_models:
             mapped_module.add_mapped_model(mapped_model)
         
         proto = mapped_module.generate_proto()
         util.generate_pb2_module(mapped_module)
+        util.generate_conv_module(mapped_module)
         app_path, module_file = os.path.split(app_module.__file__) 
         util.save_module(mapped_module, path=app_path)
 
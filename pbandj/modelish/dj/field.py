@@ -5,10 +5,20 @@ from model import Model
 
 class Field(object):
     
+    # Wire type of temporal values, one of the types.TEMPORAL_* names.
+    # None for the default and for fields pickled before it was recorded
+    temporal_type = None
+    
+    # Wire type of DecimalField values, one of the types.DECIMAL_* names,
+    # and the decimal places of the field.  See temporal_type
+    decimal_type = None
+    decimal_places = None
+    
     def __init__(self, name, dj_type):
         self.name = name
         self.dj_type = dj_type
         self.choices = None
+        self.max_length = None
     
     @staticmethod    
     def from_dj_field(dj_field, **kwargs):
@@ -16,15 +26,30 @@ class Field(object):
         # Add an enumeration for each django field with choices set
         if(dj_field.choices):
             field.choices = dj_field.choices
+        # Keep the length limit so conversion can truncate input strings
+        field.max_length = getattr(dj_field, 'max_length', None)
+        field.temporal_type = kwargs.get('temporal_type')
+        field.decimal_type = kwargs.get('decimal_type')
+        field.decimal_places = getattr(dj_field, 'decimal_places', None)
         return field
         
 
 class ForeignKey(Field):
     
+    # Django model class of the related model.  Defaults to None for
+    # fields pickled before it was recorded
+    related_dj_model = None
+    # Django model class holding the field and the name of the reverse
+    # accessor on the related model.  See related_dj_model
+    child_dj_model = None
+    related_accessor_name = None
+    
     def __init__(self, name, dj_type, child_model, related_model, related_model_field_name):
         Field.__init__(self, name, dj_type)
         self.child_model = Model.from_django_model(child_model)
         self.related_model = Model.from_django_model(related_model)
+        self.related_dj_model = related_model
+        self.child_dj_model = child_model
         self.related_model_field_name = related_model_field_name
     
     @staticmethod    
@@ -41,6 +66,7 @@ class ForeignKey(Field):
         if isinstance(dj_field, dj_models.ForeignKey):
             # By default leave type as a ForeignKey
             field = ForeignKey(dj_field.name, type(dj_field), dj_field.model, dj_field.rel.to, dj_field.related.var_name)
+            field.related_accessor_name = dj_field.related.get_accessor_name()
         else:
             raise PbandjFieldException("Supplied field is not a ForeignKey")
             
@@ -76,6 +102,7 @@ class OneToOne(ForeignKey):
         if isinstance(dj_field, dj_models.OneToOneField):
             # By default leave type as a OneToOne
             field = OneToOne(dj_field.name, type(dj_field), dj_field.model, dj_field.rel.to, dj_field.related.var_name)
+            field.related_accessor_name = dj_field.related.get_accessor_name()
 #        elif isinstance(dj_field, dj_models.OneToOneRel):
 #            field = OneToOne(dj_field.var_name, type(dj_field.field), dj_field.model)
         else:
@@ -96,10 +123,17 @@ class OneToOne(ForeignKey):
     
 class ManyToMany(Field):
     
+    # See ForeignKey.related_dj_model
+    related_dj_model = None
+    child_dj_model = None
+    related_accessor_name = None
+    
     def __init__(self, name, dj_type, child_model, related_model, related_model_field_name):
         Field.__init__(self, name, dj_type)
         self.child_model = Model.from_django_model(child_model)
         self.related_model = Model.from_django_model(related_model)
+        self.related_dj_model = related_model
+        self.child_dj_model = child_model
         self.related_through_model = None
         self.related_model_field_name = related_model_field_name
         
@@ -117,6 +151,7 @@ class ManyToMany(Field):
         if isinstance(dj_field, dj_models.ManyToManyField):
             # By default leave type as a ManyToMany
             field = ManyToMany(dj_field.name, type(dj_field), dj_field.model, dj_field.rel.to, dj_field.related.var_name)
+            field.related_accessor_name = dj_field.related.get_accessor_name()
         else:
             raise PbandjFieldException("Supplied field is not a ManyToManyField")
         
@@ -1,9 +1,12 @@
+import hashlib
 import imp
+import os
+import threading
 
 from dj.field import OneToOne, ForeignKey, ManyToMany
 from dj.model import Model
 from pb import message, field, proto, enum
-from types import DJ2PB
+from types import DJ2PB, dj2pb
 from pbandj.conversion import Converter
     
 
@@ -54,7 +57,9 @@ def model_to_field_map(pbandj_dj_model, pb_field_num_map=None):
                 field_enum = enum.Enum(pbandj_dj_field.name.capitalize() , [a for a,b in pbandj_dj_field.choices], enum_doc)
                 pbandj_pb_field = field.Field(field.OPTIONAL, pbandj_dj_field.name, field_enum, pb_field_num + 1)                  
             else:
-                pbandj_pb_field = field.Field(field.OPTIONAL, pbandj_dj_field.name, DJ2PB.get(pbandj_dj_field.dj_type), pb_field_num + 1)
+                pb_type = dj2pb(pbandj_dj_field.dj_type, pbandj_dj_field.temporal_type,
+                                pbandj_dj_field.decimal_type)
+                pbandj_pb_field = field.Field(field.OPTIONAL, pbandj_dj_field.name, pb_type, pb_field_num + 1)
         
         # Check the field number map for a matching field
         if pbandj_pb_field.field_key in pb_field_num_map.get(pbandj_dj_model.name.upper(), {}).keys():
@@ -126,6 +131,9 @@ class MappedModel(object):
     MAPPED_FIELD_START = 0
     UNMAPPED_FIELD_START = 32768
     
+    # Default for models pickled before relations were converted
+    converted_relations = ()
+    
     def __init__(self, dj_model, pb_field_num_map=None, msg_name=None, **kwargs):
         '''Create a MappedModel
         If a field number map is provided, field numbering will start from
@@ -161,6 +169,14 @@ class MappedModel(object):
         self.pb_to_dj_field_map = fields
         self.pb_to_dj_relation_map = relations
         
+        # Names of the relation fields filled when converting to protocol
+        # buffers
+        self.converted_relations = tuple(kwargs.get('reverse_relations', ()))
+        for name in self.converted_relations:
+            if not name in relations:
+                raise Exception("No relation field %s mapped from Django model %s" %
+                                (name, self.pbandj_dj_model.name))
+        
         self.pbandj_pb_msg = field_map_to_message(msg_name, fields, relations)
     
     
@@ -209,6 +225,11 @@ class MappedModule(object):
     """ Class combining MappedModel objects into a protocol buffer definition
     """
     
+    # Class level defaults so modules pickled before conversion modules
+    # and shared converters existed can still be restored
+    __conv = None
+    __converter = None
+    
     def __init__(self, module_name):
         self.module_name = module_name.strip()
         self.mapped_models = []
@@ -217,10 +238,28 @@ class MappedModule(object):
         self.service_handlers = {}
         self.xtra_proto_imports = []
         self.__pb2 = None
+        self.__converter_lock = threading.Lock()
+        
+    def __getstate__(self):
+        # Loaded modules can't be pickled
+        state = self.__dict__.copy()
+        state.pop('_MappedModule__pb2', None)
+        state.pop('_MappedModule__conv', None)
+        # Nor can locks.  The converter is rebuilt on first use
+        state.pop('_MappedModule__converter', None)
+        state.pop('_MappedModule__converter_lock', None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__pb2 = None
+        self.__converter_lock = threading.Lock()
         
 
     def add_mapped_model(self, mapped_model):
-        self.mapped_models.append(mapped_model)
+        with self.__converter_lock:
+            self.mapped_models.append(mapped_model)
+            self.__converter = None
         
     def add_service(self, service, service_handlers):
         '''Add a pb.Service to the MappedModule
@@ -253,10 +292,25 @@ class MappedModule(object):
         return p
     
     def converter(self):
-        """Convenience method to get a Converter object for
-        this mapped_module
+        """Get the Converter shared by all users of this mapped module.
+        It is built on first use and built again after a model is added
+        or reset_converter is called.  Conversion helpers added to it
+        apply to every user.
+        """
+        converter = self.__converter
+        if converter is None:
+            with self.__converter_lock:
+                converter = self.__converter
+                if converter is None:
+                    converter = self.__converter = Converter(self)
+        return converter
+    
+    def reset_converter(self):
+        """Drop the shared Converter so the next call to converter builds
+        a new one.  Needed after the conversion module is regenerated.
         """
-        return Converter(self)
+        with self.__converter_lock:
+            self.__converter = None
     
     @property
     def proto_filename(self):
@@ -285,4 +339,38 @@ class MappedModule(object):
         if pb2_mod == None:
             print "Unable to load service module " + mod_name
         self.__pb2 = pb2_mod
-        return pb2_mod 
\ No newline at end of file
+        return pb2_mod 
+    
+    @property
+    def conv_module_name(self):
+        return self.module_name + "_pbandj_conv"
+    
+    def schema_fingerprint(self):
+        '''Get a digest of the messages of the mapped models. Generated
+        conversion modules are only used while their fingerprint matches.
+        '''
+        digest = hashlib.md5()
+        for mapped_model in self.mapped_models:
+            digest.update(str(mapped_model.pbandj_pb_msg))
+            digest.update(repr(mapped_model.converted_relations))
+        return digest.hexdigest()
+    
+    def load_conv(self):
+        '''Load and return the generated conversion module related to this
+        mapped module or None if one hasn't been generated.  A module loaded
+        earlier is loaded again if it was generated from another schema.
+        '''
+        if (self.__conv and
+            getattr(self.__conv, 'FINGERPRINT', None) == self.schema_fingerprint()):
+            return self.__conv
+        mod_name = self.conv_module_name
+        if not os.path.exists(mod_name + ".py"):
+            return None
+        print "Importing conversion module for", self.module_name
+        conv_mod = None
+        try:
+            conv_mod = imp.load_source(mod_name, mod_name + ".py")
+        except Exception, e:
+            print "Unable to load conversion module " + mod_name
+        self.__conv = conv_mod
+        return conv_mod
\ No newline at end of file
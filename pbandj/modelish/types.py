@@ -32,7 +32,13 @@ PB_TYPE_SINT32   = _make_type('PB_TYPE_SINT32'  ,'sint32'  ,17)
 PB_TYPE_SINT64   = _make_type('PB_TYPE_SINT64'  ,'sint64'  ,18)
 
 def pbtype_name(type_name):
-    return 'PB_' + type_name.strip().upper()
+    '''Get the name of the pb type wrapper for a descriptor type name
+    like TYPE_STRING or a .proto type name like string
+    '''
+    type_name = type_name.strip().upper()
+    if not type_name.startswith('TYPE_'):
+        type_name = 'TYPE_' + type_name
+    return 'PB_' + type_name
 
 DJ2PB = {models.CharField: PB_TYPE_STRING,
          models.DecimalField: PB_TYPE_DOUBLE,
@@ -64,4 +70,50 @@ DJ2PB = {models.CharField: PB_TYPE_STRING,
          }
 
 
-PB2DJ = dict([(DJ2PB[key], key) for key in DJ2PB])
\ No newline at end of file
+PB2DJ = dict([(DJ2PB[key], key) for key in DJ2PB])
+
+# Wire types for Django DateTimeField, DateField and TimeField values.
+# TEMPORAL_STRING sends formatted strings.  TEMPORAL_EPOCH sends sint64
+# microseconds since the epoch for DateTimeFields, days since the epoch for
+# DateFields and microseconds since midnight for TimeFields.
+TEMPORAL_STRING = 'string'
+TEMPORAL_EPOCH = 'epoch'
+
+TEMPORAL_DJ2PB = {TEMPORAL_STRING: {},
+                  TEMPORAL_EPOCH: {models.DateTimeField: PB_TYPE_SINT64,
+                                   models.DateField: PB_TYPE_SINT64,
+                                   models.TimeField: PB_TYPE_SINT64},
+                  }
+
+# Wire types for Django DecimalField values.  DECIMAL_DOUBLE sends a double.
+# DECIMAL_SCALED sends the sint64 count of 10 ** -decimal_places of the field
+# so no precision is lost.
+DECIMAL_DOUBLE = 'double'
+DECIMAL_SCALED = 'scaled'
+
+DECIMAL_DJ2PB = {DECIMAL_DOUBLE: {},
+                 DECIMAL_SCALED: {models.DecimalField: PB_TYPE_SINT64},
+                 }
+
+
+def dj2pb(dj_type, temporal_type=None, decimal_type=None):
+    '''Get the pb type a Django field type is mapped to
+
+    Args:
+    dj_type - (type) Django field class
+    temporal_type - (str) TEMPORAL_STRING or TEMPORAL_EPOCH.  Defaults to
+                    TEMPORAL_STRING.
+    decimal_type - (str) DECIMAL_DOUBLE or DECIMAL_SCALED.  Defaults to
+                   DECIMAL_DOUBLE.
+    '''
+    if temporal_type is None:
+        temporal_type = TEMPORAL_STRING
+    if decimal_type is None:
+        decimal_type = DECIMAL_DOUBLE
+    if not temporal_type in TEMPORAL_DJ2PB:
+        raise Exception("Unknown temporal type %s" % temporal_type)
+    if not decimal_type in DECIMAL_DJ2PB:
+        raise Exception("Unknown decimal type %s" % decimal_type)
+    return (TEMPORAL_DJ2PB[temporal_type].get(dj_type) or
+            DECIMAL_DJ2PB[decimal_type].get(dj_type) or
+            DJ2PB.get(dj_type))
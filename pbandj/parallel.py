@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# Copyright (C) 2009  Las Cumbres Observatory <lcogt.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''parallel.py - Convert large QuerySets in a pool of worker processes.
+
+The QuerySet is split into pk ranges and each range is converted by a
+multiprocessing worker with its own database connection and a Converter
+built once per worker from the pickled MappedModule.  A range comes back
+as one block of varint length delimited serialized messages, the record
+format of pbandj.stream, which iter_block_records splits again.
+'''
+
+import multiprocessing
+import pickle
+
+from django.db import connections
+
+from conversion import Converter
+from stream import encode_varint, decode_varint
+
+# Objects per pk range when export isn't given a range size
+DEFAULT_RANGE_SIZE = 10000
+
+
+def encode_block(records):
+    """Join serialized messages into a block of varint length delimited
+    records
+    """
+    parts = []
+    for record in records:
+        parts.append(encode_varint(len(record)))
+        parts.append(record)
+    return ''.join(parts)
+
+
+def iter_block_records(block):
+    """Generate the serialized messages of a block from encode_block
+    """
+    pos = 0
+    end = len(block)
+    while pos < end:
+        size, pos = decode_varint(block, pos)
+        yield block[pos:pos + size]
+        pos += size
+
+
+def pk_ranges(queryset, range_size=DEFAULT_RANGE_SIZE):
+    """Split the objects of a QuerySet into inclusive (first pk, last pk)
+    ranges of up to range_size objects in pk order
+    """
+    pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+    return [(pks[i], pks[min(i + range_size, len(pks)) - 1])
+            for i in range(0, len(pks), range_size)]
+
+
+# Converter of a worker process built by _init_worker
+_worker_converter = None
+
+
+def _init_worker(pickled_module, converter_kwargs):
+    global _worker_converter
+    # Connections inherited from the parent can't be shared.  An in
+    # memory SQLite database only exists in the copy the worker was
+    # forked with so its connection is kept.
+    for conn in connections.all():
+        if not (conn.vendor == 'sqlite' and conn.settings_dict['NAME'] in ('', ':memory:')):
+            conn.close()
+    _worker_converter = Converter(pickle.loads(pickled_module), **converter_kwargs)
+
+
+def _export_range(task):
+    return _convert_range(_worker_converter, task)
+
+
+def _convert_range(converter, task):
+    query, first_pk, last_pk, excludes, mask = task
+    queryset = query.model._default_manager.all()
+    queryset.query = query
+    queryset = queryset.filter(pk__gte=first_pk, pk__lte=last_pk).order_by('pk')
+    return encode_block(converter.iter_djtopb(queryset, excludes=excludes,
+                                              serialize=True, mask=mask, pooled=True))
+
+
+def export(mapped_module, queryset, processes=None, range_size=DEFAULT_RANGE_SIZE,
+           ordered=True, excludes=(), mask=None, **converter_kwargs):
+    """Convert the objects of a QuerySet in a pool of worker processes and
+    generate one block of serialized messages per pk range.  See
+    iter_block_records.
+
+    Args:
+    mapped_module - (MappedModule) module mapping the model of queryset
+    queryset - (QuerySet) objects to convert.  Can't be sliced.
+    processes - (int) Number of worker processes.  Defaults to the number
+                of cores.  With 1 the ranges are converted in this process.
+    range_size - (int) Number of objects per pk range
+    ordered - (bool) Generate blocks in pk order rather than as they are
+              done.  The ordering of queryset isn't kept either way.
+    excludes - A list of field names to exclude from the conversion.
+    mask - A list of field paths to convert.  See normalize_mask
+    converter_kwargs - keyword args of the Converter of each worker
+    """
+    if not queryset.query.can_filter():
+        raise Exception("Can't export a sliced QuerySet")
+    tasks = [(queryset.query, first_pk, last_pk, list(excludes), mask)
+             for first_pk, last_pk in pk_ranges(queryset, range_size)]
+    if processes == 1:
+        converter = Converter(mapped_module, **converter_kwargs)
+        results = (_convert_range(converter, task) for task in tasks)
+        return _iter_results(results, None)
+    pickled_module = pickle.dumps(mapped_module, pickle.HIGHEST_PROTOCOL)
+    pool = multiprocessing.Pool(processes, _init_worker, (pickled_module, converter_kwargs))
+    if ordered:
+        results = pool.imap(_export_range, tasks)
+    else:
+        results = pool.imap_unordered(_export_range, tasks)
+    return _iter_results(results, pool)
+
+
+def _iter_results(results, pool):
+    try:
+        for result in results:
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# Copyright (C) 2009  Las Cumbres Observatory <lcogt.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''profiling.py - Call counts and timings of the conversion plans of a
+Converter.
+
+Profiling is off unless a Converter is created with profile=True, the
+PBANDJ_PROFILE setting is True or the PBANDJ_PROFILE environment variable
+is set to 1, true, yes or on.  When it is off plans are compiled without
+any instrumentation.
+'''
+
+import os
+import threading
+from timeit import default_timer
+
+from django.conf import settings
+
+# Conversion directions
+DJTOPB = 'djtopb'
+PBTODJ = 'pbtodj'
+
+ENV_VAR = 'PBANDJ_PROFILE'
+
+
+def profiling_enabled():
+    """True if profiling is switched on by the PBANDJ_PROFILE setting or
+    environment variable
+    """
+    if getattr(settings, 'PBANDJ_PROFILE', False):
+        return True
+    return os.environ.get(ENV_VAR, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+class ConversionProfiler(object):
+    """Accumulates call counts and cumulative times of conversion plan
+    steps per (message name, field name, direction), of conversion helpers
+    per helper name and of field conversions per nesting depth.  Time
+    spent in a step includes the nested conversions and helpers it calls.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Clear the recorded stats
+        """
+        with self.__lock:
+            self.__fields = {}
+            self.__helpers = {}
+            self.__depths = {}
+
+    def snapshot(self):
+        """Get a copy of the recorded stats as a dict with
+        'fields' - {(message name, field name, direction): (calls, seconds)}
+        'helpers' - {helper name: (calls, seconds)}
+        'depths' - {nesting depth: field conversions}
+        """
+        with self.__lock:
+            return {'fields': dict((key, tuple(stats)) for key, stats in self.__fields.items()),
+                    'helpers': dict((key, tuple(stats)) for key, stats in self.__helpers.items()),
+                    'depths': dict(self.__depths)}
+
+    def record(self, stats, key, elapsed):
+        with self.__lock:
+            entry = stats.get(key)
+            if entry is None:
+                entry = stats[key] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def wrap_step(self, msg_name, field_name, direction, step):
+        """Get a step recording the calls of a djtopb plan step
+        """
+        key = (msg_name, field_name, direction)
+        fields = self.__fields
+        local = self.__local
+        record = self.record
+        def profiled_step(obj, msg):
+            depth = getattr(local, 'depth', 0)
+            local.depth = depth + 1
+            start = default_timer()
+            try:
+                return step(obj, msg)
+            finally:
+                record(fields, key, default_timer() - start)
+                local.depth = depth
+                self.record_depth(depth)
+        return profiled_step
+
+    def wrap_value(self, msg_name, field_name, direction, convert):
+        """Get a convert function recording the calls of a pbtodj plan
+        entry.  convert may be None for values used as is.
+        """
+        key = (msg_name, field_name, direction)
+        fields = self.__fields
+        local = self.__local
+        record = self.record
+        def profiled_convert(val):
+            depth = getattr(local, 'depth', 0)
+            local.depth = depth + 1
+            start = default_timer()
+            try:
+                if convert is None:
+                    return val
+                return convert(val)
+            finally:
+                record(fields, key, default_timer() - start)
+                local.depth = depth
+                self.record_depth(depth)
+        return profiled_convert
+
+    def wrap_helper(self, helper_name, convert):
+        """Get a convert function recording the calls of a helper
+        """
+        helpers = self.__helpers
+        record = self.record
+        def profiled_helper(val):
+            start = default_timer()
+            try:
+                return convert(val)
+            finally:
+                record(helpers, helper_name, default_timer() - start)
+        return profiled_helper
+
+    def record_depth(self, depth):
+        with self.__lock:
+            self.__depths[depth] = self.__depths.get(depth, 0) + 1
+
+    def report(self, limit=None):
+        """Get the recorded stats as a table sorted by cumulative time
+
+        Args:
+        limit - (int) Number of fields and helpers listed.  All if None
+        """
+        stats = self.snapshot()
+        lines = []
+        header = '%-48s %-7s %10s %12s %10s' % ('Field', 'Dir', 'Calls', 'Total ms', 'Per us')
+        lines.append(header)
+        lines.append('-' * len(header))
+        fields = sorted(stats['fields'].items(), key=lambda item: -item[1][1])
+        for (msg_name, field_name, direction), (calls, seconds) in fields[:limit]:
+            lines.append('%-48s %-7s %10d %12.3f %10.2f' %
+                         ('%s.%s' % (msg_name, field_name), direction, calls,
+                          seconds * 1e3, seconds * 1e6 / calls))
+        lines.append('')
+        header = '%-56s %10s %12s %10s' % ('Helper', 'Calls', 'Total ms', 'Per us')
+        lines.append(header)
+        lines.append('-' * len(header))
+        helpers = sorted(stats['helpers'].items(), key=lambda item: -item[1][1])
+        for helper_name, (calls, seconds) in helpers[:limit]:
+            lines.append('%-56s %10d %12.3f %10.2f' %
+                         (helper_name, calls, seconds * 1e3, seconds * 1e6 / calls))
+        lines.append('')
+        lines.append('%-10s %10s' % ('Depth', 'Fields'))
+        for depth, count in sorted(stats['depths'].items()):
+            lines.append('%-10d %10d' % (depth, count))
+        return '\n'.join(lines)
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# Copyright (C) 2009  Las Cumbres Observatory <lcogt.net>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''stream.py - Streams of varint length delimited protocol buffer messages.
+
+Each record of a stream is the varint encoded size of a serialized
+message followed by the message, the framing written by writeDelimitedTo
+of the Java and C++ protocol buffer libraries.  StreamWriter writes
+messages or converted Django objects to a file or socket and StreamReader
+reads them back one record at a time in constant memory.
+
+Ex.
+writer = StreamWriter(open('rows.pb', 'wb'), converter)
+writer.write_queryset(MyModel.objects.all())
+writer.close()
+for obj in StreamReader(open('rows.pb', 'rb')).objects(converter, my_pb2.MyModel):
+    obj.save()
+'''
+
+# Bytes read or written at a time unless a stream is given a buffer size
+DEFAULT_BUFFER_SIZE = 65536
+
+# Longest varint encoding of a 64 bit size
+MAX_VARINT_SIZE = 10
+
+
+def encode_varint(value):
+    """Get the protocol buffer varint encoding of a non negative int
+    """
+    bits = value & 0x7f
+    value >>= 7
+    out = []
+    while value:
+        out.append(chr(0x80 | bits))
+        bits = value & 0x7f
+        value >>= 7
+    out.append(chr(bits))
+    return ''.join(out)
+
+
+def decode_varint(buf, pos, end=None):
+    """Decode the varint of buf starting at pos.  Returns (value, position
+    after the varint) or None if buf ends at end before the varint does.
+    """
+    if end is None:
+        end = len(buf)
+    result = 0
+    shift = 0
+    while pos < end:
+        byte = ord(buf[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 7 * MAX_VARINT_SIZE:
+            raise Exception("Malformed varint in stream")
+    return None
+
+
+def _decode_buffer_varint(buf, pos, end):
+    """decode_varint for a bytearray, whose items are ints
+    """
+    result = 0
+    shift = 0
+    while pos < end:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 7 * MAX_VARINT_SIZE:
+            raise Exception("Malformed varint in stream")
+    return None
+
+
+class StreamWriter(object):
+    """Writes varint length delimited messages to a file like object with
+    write() or a socket.  Records are gathered into writes of about
+    buffer_size bytes.
+    """
+
+    def __init__(self, fileobj, converter=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        '''Create a StreamWriter
+
+        Args:
+        fileobj - file like object or socket the stream is written to
+        converter - (Converter) converts the Django objects written with
+                    write_object and write_queryset
+        buffer_size - (int) Bytes gathered before they are written
+        '''
+        self.fileobj = fileobj
+        self.converter = converter
+        self.buffer_size = buffer_size
+        self.count = 0
+        write = getattr(fileobj, 'write', None)
+        self.__write = write if write is not None else fileobj.sendall
+        self.__parts = []
+        self.__pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+        return False
+
+    def write_serialized(self, data):
+        """Write a serialized message as a record
+        """
+        header = encode_varint(len(data))
+        parts = self.__parts
+        parts.append(header)
+        parts.append(data)
+        self.count += 1
+        self.__pending += len(header) + len(data)
+        if self.__pending >= self.buffer_size:
+            self.flush()
+
+    def write(self, msg):
+        """Write a protocol buffer message as a record
+        """
+        self.write_serialized(msg.SerializeToString())
+
+    def write_object(self, obj, excludes=[], mask=None):
+        """Convert a Django object with the converter and write its message.
+        See Converter.djtopb
+        """
+        self.write_serialized(self.converter.djtopb_serialized(obj, excludes=excludes, mask=mask))
+
+    def write_queryset(self, queryset, chunk_size=1000, excludes=[], mask=None):
+        """Convert and write every object of a QuerySet in constant memory.
+        See Converter.iter_djtopb
+
+        Returns:
+        number of records written
+        """
+        count = self.count
+        for data in self.converter.iter_djtopb(queryset, chunk_size, excludes, serialize=True,
+                                               mask=mask, pooled=True):
+            self.write_serialized(data)
+        return self.count - count
+
+    def flush(self):
+        """Write the gathered records
+        """
+        if self.__parts:
+            self.__write(''.join(self.__parts))
+            self.__parts = []
+            self.__pending = 0
+        flush = getattr(self.fileobj, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def close(self):
+        """Flush and close the file or socket
+        """
+        self.flush()
+        self.fileobj.close()
+
+
+class StreamReader(object):
+    """Reads varint length delimited messages from a file like object or
+    a socket.  Data is read buffer_size bytes at a time into one buffer
+    and records are handed out as memoryview slices of it, so a record is
+    only copied when it straddles the end of the buffer.
+    """
+
+    def __init__(self, fileobj, buffer_size=DEFAULT_BUFFER_SIZE):
+        '''Create a StreamReader
+
+        Args:
+        fileobj - file like object or socket the stream is read from
+        buffer_size - (int) Bytes read at a time.  The buffer grows to fit
+                      records larger than this.
+        '''
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.count = 0
+        readinto = getattr(fileobj, 'readinto', None)
+        if readinto is None:
+            readinto = getattr(fileobj, 'recv_into', None)
+        if readinto is None:
+            readinto = self.__read_copy
+        self.__readinto = readinto
+
+    def __read_copy(self, view):
+        # For file like objects with only read()
+        data = self.fileobj.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self):
+        """Generate the serialized messages of the stream as memoryviews.
+        A memoryview is only valid until the next one is generated.
+        """
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        readinto = self.__readinto
+        start = end = 0
+        count = self.count
+        while True:
+            # Sizes under 128 take one byte
+            if start < end and buf[start] < 0x80:
+                header = buf[start], start + 1
+            else:
+                header = _decode_buffer_varint(buf, start, end)
+            if header is not None:
+                size, pos = header
+                if pos + size <= end:
+                    count += 1
+                    self.count = count
+                    yield view[pos:pos + size]
+                    start = pos + size
+                    continue
+                needed = pos - start + size
+            else:
+                needed = end - start + MAX_VARINT_SIZE
+            # Move the partial record to the front of the buffer, or into a
+            # bigger one, and read more of it
+            if needed > len(buf):
+                new_buf = bytearray(max(needed, 2 * len(buf)))
+                new_buf[:end - start] = view[start:end]
+                buf = new_buf
+                view = memoryview(buf)
+            elif start:
+                buf[:end - start] = buf[start:end]
+            end -= start
+            start = 0
+            read = readinto(view[end:])
+            if not read:
+                if end:
+                    raise Exception("Stream ends in the middle of a record")
+                return
+            end += read
+
+    def messages(self, msg_type):
+        """Generate the records of the stream parsed as messages of msg_type
+        """
+        for record in self.records():
+            msg = msg_type()
+            msg.ParseFromString(record)
+            yield msg
+
+    def objects(self, converter, msg_type):
+        """Generate the unsaved Django objects of the records of the stream.
+        See Converter.pbtodj
+        """
+        for msg in self.messages(msg_type):
+            yield converter.pbtodj(msg)
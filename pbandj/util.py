@@ -3,6 +3,7 @@ import pickle
 import os
 from modelish.pb.proto import Proto
 from modelish.pb import field
+import codegen
 from google.protobuf import descriptor_pb2
 
 PB_INTERNAL_TYPE_MAP = descriptor_pb2._FIELDDESCRIPTORPROTO.enum_types_by_name['Type'].values_by_number
@@ -83,6 +84,24 @@ def generate_pb2_module(mapped_module, path="."):
                
     return mapped_module.pb2_module_name
 
+def generate_conv_module(mapped_module, path="."):
+    """ Generate a python module of straight line conversion functions
+    for the models of a mapped module.
+    
+    Args:
+    mapped_module - (MappedModule) - module to generate conversions for
+    path - (str) The path, relative or fully qualified,
+           to the directory where the generated module will
+           be created
+    """
+    source = codegen.conversion_module_source(mapped_module)
+    f = open(os.path.join(path, mapped_module.conv_module_name + ".py"), 'w')
+    f.write(source)
+    f.close()
+    # The shared converter was built before the module existed
+    mapped_module.reset_converter()
+    return mapped_module.conv_module_name
+
 def generate_field_number_map(pb2_module):
     field_number_map = {}
     for name, msg_desc in pb2_module.DESCRIPTOR.message_types_by_name.items():